@@ -1,5 +1,6 @@
 
 import pandas as pd
+from .thread_stats import value_counts
 
 NOISE_MACROS = {'Sin Clasificar'}
 
@@ -26,39 +27,55 @@ def get_categorical_analysis(df: pd.DataFrame):
         cat_col = 'intencion'
 
     # Top subcategories (up to 20)
-    top_intents = human_df[cat_col].value_counts().head(20).to_dict()
+    top_intents = value_counts(human_df[cat_col]).head(20).to_dict()
 
     # Top macros
     top_macros = {}
     if has_cat:
-        top_macros = human_df['macro_yaml'].value_counts().head(10).to_dict()
+        top_macros = value_counts(human_df['macro_yaml']).head(10).to_dict()
 
     # Top Products
     noise = ['', 'ninguno', 'nan', 'none', 'desconocido']
     valid_products_df = df[~df['product_type'].str.lower().isin(noise)]
-    top_products = valid_products_df['product_type'].value_counts().head(10).to_dict()
+    top_products = value_counts(valid_products_df['product_type']).head(10).to_dict()
 
     # Sentiment Distribution (all messages)
-    sentiment_dist = df['sentiment'].value_counts().to_dict()
+    sentiment_dist = value_counts(df['sentiment']).to_dict()
 
     # Cross: Sentiment x Subcategory (top 10 subcategories)
-    top_10_list = human_df[cat_col].value_counts().head(10).index
+    top_10_list = value_counts(human_df[cat_col]).head(10).index
     cross_df = human_df[human_df[cat_col].isin(top_10_list)]
     sentiment_x_intent = cross_df.groupby([cat_col, 'sentiment']).size().unstack(fill_value=0)
     sentiment_x_intent_data = sentiment_x_intent.to_dict(orient='index')
 
-    # Trend Analysis: Split data in two halves by rowid (or date if available)
+    winners, losers = category_trends(human_df[cat_col])
+
+    return {
+        "top_intents": top_intents,
+        "top_macros": top_macros,
+        "top_products": top_products,
+        "sentiment_distribution": sentiment_dist,
+        "sentiment_by_intent": sentiment_x_intent_data,
+        "trends": {
+            "winners": winners,
+            "losers": losers
+        }
+    }
+
+
+def category_trends(cats: pd.Series):
+    """
+    Trend Analysis: splits the category of each message in two halves by
+    position (assuming chronological order in DB) and returns the top 5
+    (winners, losers) by absolute growth.
+    """
     winners = {}
     losers = []
     
-    if len(human_df) > 10:
-        # Simple split by position (assuming chronological order in DB)
-        mid = len(human_df) // 2
-        first_half = human_df.iloc[:mid]
-        second_half = human_df.iloc[mid:]
-        
-        counts1 = first_half[cat_col].value_counts()
-        counts2 = second_half[cat_col].value_counts()
+    if len(cats) > 10:
+        mid = len(cats) // 2
+        counts1 = value_counts(cats.iloc[:mid])
+        counts2 = value_counts(cats.iloc[mid:])
         
         all_cats = set(counts1.index) | set(counts2.index)
         trends = []
@@ -74,14 +91,4 @@ def get_categorical_analysis(df: pd.DataFrame):
         winners = [t for t in trends if t['diff'] > 0][:5]
         losers = sorted([t for t in trends if t['diff'] < 0], key=lambda x: x['diff'])[:5]
 
-    return {
-        "top_intents": top_intents,
-        "top_macros": top_macros,
-        "top_products": top_products,
-        "sentiment_distribution": sentiment_dist,
-        "sentiment_by_intent": sentiment_x_intent_data,
-        "trends": {
-            "winners": winners,
-            "losers": losers
-        }
-    }
+    return winners, losers
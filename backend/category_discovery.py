@@ -190,6 +190,7 @@ def _compute_coverage(df: pd.DataFrame) -> dict:
             macro_counts = (
                 human[human["macro_yaml"].notna() & ~human["macro_yaml"].isin(NOISE_MACROS)]
                 ["macro_yaml"]
+                .astype(str)  # category dtype would also list unobserved macros
                 .value_counts()
                 .head(15)
                 .to_dict()
@@ -252,8 +253,13 @@ def _top_unclassified_terms(df: pd.DataFrame, top_n: int = 30) -> list[dict]:
     word_freq: dict[str, int] = defaultdict(int)
     bigram_freq: dict[str, int] = defaultdict(int)
 
-    for text in uncat["text"].dropna():
-        tokens = _normalize(str(text)).split()
+    if "text_norm" in uncat.columns:
+        # text_norm is precomputed by the ETL (lowercase, no accents); only punctuation is left to drop
+        token_lists = uncat.loc[uncat["text"].notna(), "text_norm"].str.replace(r"[^\w\s]", " ", regex=True).str.split()
+    else:
+        token_lists = (_normalize(str(text)).split() for text in uncat["text"].dropna())
+
+    for tokens in token_lists:
         tokens = [t for t in tokens if len(t) > 2 and t not in stop_words]
         for t in tokens:
             word_freq[t] += 1
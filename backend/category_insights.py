@@ -1,9 +1,11 @@
 import pandas as pd
-from .referrals import detect_referrals
+from .referrals import referral_threads
+from .thread_stats import value_counts
 
-def get_qualitative_insights(df: pd.DataFrame):
+def get_qualitative_insights(df: pd.DataFrame, referral_index: pd.DataFrame = None):
     """
     Returns high-level qualitative insights with the nested structure expected by the frontend.
+    referral_index: DataEngine.referral_index (see referrals.referral_threads).
     """
     if df.empty:
         return {
@@ -28,14 +30,13 @@ def get_qualitative_insights(df: pd.DataFrame):
     total_msgs = len(df)
     
     # Message type counts
-    types = df['type'].value_counts()
+    types = value_counts(df['type'])
     human_cnt = int(types.get('human', 0))
     ai_cnt = int(types.get('ai', 0))
     tool_cnt = int(types.get('tool', 0))
 
     # Referrals
-    referrals_df = detect_referrals(df)
-    referral_convs = int(referrals_df['thread_id'].nunique()) if not referrals_df.empty else 0
+    referral_convs = len(referral_threads(df, referral_index))
     referral_pct = round((referral_convs / total_convs * 100), 1) if total_convs > 0 else 0
 
     # Sentiments
@@ -51,13 +52,13 @@ def get_qualitative_insights(df: pd.DataFrame):
     # Topics (Proxy)
     topics = {}
     if 'macro_yaml' in df.columns:
-        top_topics = df[df['type'] == 'human']['macro_yaml'].value_counts(normalize=True).head(3) * 100
+        top_topics = value_counts(df[df['type'] == 'human']['macro_yaml'], normalize=True).head(3) * 100
         topics = {str(k): round(float(v), 1) for k, v in top_topics.items()}
 
     # Helper for top lists
     def get_top_list(col):
         if col not in df.columns: return []
-        counts = df[df['type'] == 'human'][col].value_counts().head(5)
+        counts = value_counts(df[df['type'] == 'human'][col]).head(5)
         return [{"name": str(k), "count": int(v)} for k, v in counts.items()]
 
     # Build Response
@@ -97,9 +98,10 @@ def get_qualitative_insights(df: pd.DataFrame):
         "topics": topics
     }
 
-def get_category_insights(df: pd.DataFrame, category: str):
+def get_category_insights(df: pd.DataFrame, category: str, referral_index: pd.DataFrame = None):
     """
     Extremely detailed category deep dive.
+    referral_index: DataEngine.referral_index (see referrals.referral_threads).
     """
     if df.empty: return {}
     
@@ -112,11 +114,10 @@ def get_category_insights(df: pd.DataFrame, category: str):
 
     total_msgs = len(cat_df)
     total_convs = int(cat_df['thread_id'].nunique())
-    types = cat_df['type'].value_counts()
+    types = value_counts(cat_df['type'])
     human_cnt = int(types.get('human', 0))
     
-    ref_df = detect_referrals(cat_df)
-    ref_cnt = int(ref_df['thread_id'].nunique()) if not ref_df.empty else 0
+    ref_cnt = len(referral_threads(cat_df, referral_index))
 
     # Frequent messages with representative thread_ids
     def get_freq_msgs(sub_df, limit=5):
@@ -135,13 +136,13 @@ def get_category_insights(df: pd.DataFrame, category: str):
     # Internal Distribution
     subcats = []
     if 'categoria_yaml' in cat_df.columns:
-        counts = cat_df[cat_df['type'] == 'human']['categoria_yaml'].value_counts().head(10)
+        counts = value_counts(cat_df[cat_df['type'] == 'human']['categoria_yaml']).head(10)
         subcats = [{"name": str(k), "count": int(v)} for k, v in counts.items()]
         
     prods = []
     prod_col = 'product_yaml' if 'product_yaml' in cat_df.columns else 'product_type'
     if prod_col in cat_df.columns:
-        counts = cat_df[cat_df['type'] == 'human'][prod_col].value_counts().head(10)
+        counts = value_counts(cat_df[cat_df['type'] == 'human'][prod_col]).head(10)
         prods = [{"name": str(k), "count": int(v)} for k, v in counts.items()]
 
     return {
@@ -1,5 +1,6 @@
 
 import pandas as pd
+from .loader import to_records
 
 def get_conversation_analysis(df: pd.DataFrame, thread_id: str = None):
     """
@@ -9,6 +10,7 @@ def get_conversation_analysis(df: pd.DataFrame, thread_id: str = None):
     if thread_id:
         # Detail view
         # Sort by rowid to ensure relative order from CSV/DB is preserved
+        # (callers holding the engine pass just the thread, see DataEngine.get_thread)
         thread_df = df[df['thread_id'] == thread_id].sort_values(['rowid']).copy()
         
         # Convert dates if present
@@ -16,7 +18,7 @@ def get_conversation_analysis(df: pd.DataFrame, thread_id: str = None):
             thread_df['fecha'] = thread_df['fecha'].dt.strftime('%Y-%m-%d').fillna('')
             
         return {
-            "messages": thread_df.to_dict(orient='records'),
+            "messages": to_records(thread_df),
             "summary": {
                 "total_msgs": len(thread_df),
                 "user_msgs": len(thread_df[thread_df['type'] == 'human']),
@@ -36,14 +38,16 @@ def get_conversation_analysis(df: pd.DataFrame, thread_id: str = None):
     
     # Longest conversations
     longest_threads = thread_lengths.sort_values(ascending=False).head(20)
+    # First msg of each thread for context
+    first_msgs = df.drop_duplicates('thread_id').set_index('thread_id')
     longest_threads_data = []
     for tid, length in longest_threads.items():
-        # Get first msg data for context
-        first_msg = df[df['thread_id'] == tid].iloc[0]
+        first_msg = first_msgs.loc[tid]
+        categoria = first_msg.get('categoria_yaml')
         longest_threads_data.append({
             "thread_id": tid,
             "length": int(length),
-            "intencion": first_msg.get('categoria_yaml') or first_msg.get('intencion', 'N/A'),
+            "intencion": (categoria if pd.notna(categoria) else None) or first_msg.get('intencion', 'N/A'),
             "product": first_msg.get('product_type', 'N/A')
         })
         
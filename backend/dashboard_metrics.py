@@ -1,14 +1,24 @@
 from __future__ import annotations
 
 import pandas as pd
-from .referrals import detect_referrals
-from .failures import get_failures_cached
+from .referrals import referral_threads
+from .failures import detect_failures
+from .thread_facts import build_thread_facts, thread_set
 
+# Referral channel (referrals.REFERRAL_CHANNELS) -> label in the funnel breakdown
+CHANNEL_LABELS = {"serviline": "Servilínea", "digital": "Digital", "office": "Oficina", "other": "Otro"}
 
-def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str = None):
+
+def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str = None, thread_facts: pd.DataFrame = None,
+                        detected_failures: pd.DataFrame = None, referral_index: pd.DataFrame = None):
     """
     Calculates a comprehensive metrics breakdown for the dashboard.
     Each metric has: count, pct, base (what it's calculated from), and explanation.
+    thread_facts: fact table of the threads in df (DataEngine.get_thread_facts);
+    built from df when not given or when a date filter is applied here.
+    detected_failures: detect_failures(df), e.g. DataEngine.get_failure_threads;
+    computed here when not given or when a date filter is applied here.
+    referral_index: DataEngine.referral_index (see referrals.referral_threads).
     """
     if df is None or df.empty:
         return {"metrics": [], "waste_by_category": []}
@@ -25,29 +35,26 @@ def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str
 
     if df.empty:
         return {"metrics": [], "waste_by_category": []}
+    if thread_facts is None or start_date or end_date:
+        thread_facts = build_thread_facts(df)
 
     # ---------------------------------------------------------------
     # COMPUTATIONS
     # ---------------------------------------------------------------
-    total_threads = df['thread_id'].nunique()
+    total_threads = len(thread_facts)
     total_messages = len(df)
 
     # Greeting-only threads: threads where ALL human messages are ≤ 5 words
-    human_df = df[df['type'] == 'human']
-    human_word_counts = human_df.groupby('thread_id')['text'].apply(
-        lambda texts: all(len(str(t).split()) <= 5 for t in texts)
-    )
-    greeting_only_ids = set(human_word_counts[human_word_counts].index)
+    greeting_only_ids = thread_set(thread_facts, 'greeting_only')
     greeting_only = len(greeting_only_ids)
 
     # Active threads: threads with > 2 human messages (excludes greeting-only)
-    human_counts = human_df.groupby('thread_id').size()
-    active_ids = set(human_counts[human_counts > 2].index) - greeting_only_ids
+    active_ids = set(thread_facts.index[thread_facts['human_messages'] > 2]) - greeting_only_ids
     total_active = len(active_ids)
 
     # Referrals (among active)
-    referrals_df = detect_referrals(df)
-    ref_threads = set(referrals_df['thread_id'].unique()) if not referrals_df.empty else set()
+    referred = referral_threads(df, referral_index)
+    ref_threads = set(referred.index)
     active_referred = ref_threads & active_ids
     total_referred = len(active_referred)
 
@@ -56,17 +63,11 @@ def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str
     self_service_count = len(self_service_ids)
 
     # Surveys
-    s_mask = df['text'].str.contains(r'\[survey\]', case=False, na=False)
-    s_df = df[s_mask].copy()
-    surveyed_threads = set(s_df['thread_id'].unique())
+    surveyed_threads = thread_set(thread_facts, 'surveyed')
     total_surveys = len(surveyed_threads)
 
-    t_low = s_df['text'].str.lower()
-    is_not = t_low.str.contains("no me fue útil")
-    is_use = t_low.str.contains("me fue útil") & ~is_not
-
-    useful_threads = set(s_df[is_use]['thread_id'].unique())
-    not_useful_threads = set(s_df[is_not]['thread_id'].unique())
+    useful_threads = thread_set(thread_facts, 'survey_useful')
+    not_useful_threads = thread_set(thread_facts, 'survey_not_useful')
     answered_threads = useful_threads | not_useful_threads
 
     total_useful = len(useful_threads)
@@ -75,27 +76,17 @@ def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str
     total_unanswered = total_surveys - total_answered
 
     # Bot failures (among active)
-    failures_df = get_failures_cached(df)
+    failures_df = detected_failures
+    if failures_df is None or start_date or end_date:
+        failures_df = detect_failures(df)
     failed_threads = set(failures_df['thread_id']) if failures_df is not None and not failures_df.empty else set()
     active_failed = failed_threads & active_ids
     total_failures = len(active_failed)
 
     # Referral channel breakdown (among active referred)
-    CHANNEL_KWS = {
-        "Servilínea": ["servilínea", "servilinea", "línea de atención", "linea de atencion", "llamar al", "marcar al"],
-        "Digital": ["banca móvil", "banca movil", "banca virtual", "portal", "página web", "app bolívar", "descarga la app"],
-        "Oficina": ["oficina", "sucursal", "punto físico"],
-    }
     channel_counts: dict[str, int] = {}
-    if not referrals_df.empty and "referral_response" in referrals_df.columns:
-        for _, row in referrals_df[referrals_df["thread_id"].isin(active_referred)].iterrows():
-            txt = str(row.get("referral_response", "")).lower()
-            ch = "Otro"
-            for channel, kws in CHANNEL_KWS.items():
-                if any(kw in txt for kw in kws):
-                    ch = channel
-                    break
-            channel_counts[ch] = channel_counts.get(ch, 0) + 1
+    for ch in referred.loc[referred.index.isin(active_referred), 'channel'].map(CHANNEL_LABELS):
+        channel_counts[ch] = channel_counts.get(ch, 0) + 1
 
     # Failure criteria breakdown (among active failed)
     criteria_counts: dict[str, int] = {}
@@ -109,10 +100,7 @@ def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str
     # ---------------------------------------------------------------
     # ADVISOR ESCALATION
     # ---------------------------------------------------------------
-    arrived_seeking_advisor = set()
-    if 'categoria_yaml' in human_df.columns:
-        esc_df = human_df[human_df['categoria_yaml'] == 'Escalamiento a Asesor']
-        arrived_seeking_advisor = set(esc_df['thread_id'].unique())
+    arrived_seeking_advisor = thread_set(thread_facts, 'asked_for_advisor')
     total_arrived_seeking = len(arrived_seeking_advisor)
 
     # Organic escalation: redirected but didn't arrive seeking advisor
@@ -126,11 +114,7 @@ def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str
     # ---------------------------------------------------------------
     # PRODUCT vs GENERAL (among active)
     # ---------------------------------------------------------------
-    product_thread_ids: set = set()
-    if 'product_yaml' in df.columns:
-        prod_df = df[(df['type'] == 'human') & df['thread_id'].isin(active_ids)]
-        prod_df = prod_df[prod_df['product_yaml'].notna() & (prod_df['product_yaml'] != '') & (prod_df['product_yaml'] != 'Sin Producto')]
-        product_thread_ids = set(prod_df['thread_id'].unique())
+    product_thread_ids = thread_set(thread_facts, 'has_product') & active_ids
     total_with_product = len(product_thread_ids & active_ids)
     total_general = total_active - total_with_product
 
@@ -346,10 +330,9 @@ def get_extended_funnel(df: pd.DataFrame, start_date: str = None, end_date: str
     # WASTE BY CATEGORY (unchanged)
     # ---------------------------------------------------------------
     waste_by_category = []
-    if total_waste > 0 and 'categoria_yaml' in df.columns:
-        waste_df = df[df['thread_id'].isin(waste_threads)]
-        cat_map = waste_df[waste_df['type'] == 'human'].groupby('thread_id')['categoria_yaml'].first().to_dict()
-        counts = pd.Series(list(cat_map.values())).value_counts().reset_index()
+    if total_waste > 0 and 'first_category' in thread_facts.columns:
+        waste_cats = thread_facts.loc[thread_facts.index.isin(waste_threads), 'first_category'].dropna().sort_index()
+        counts = pd.Series(list(waste_cats)).value_counts().reset_index()
         counts.columns = ['category', 'count']
         for _, row in counts.head(10).iterrows():
             waste_by_category.append({
@@ -1,14 +1,25 @@
 
+import numpy as np
 import pandas as pd
 import sqlite3
 import os
+import threading
 import time
-from .loader import load_data, DB_PATH
-from .referrals import detect_referrals
-from .failures import detect_failures
+from contextlib import closing
+from .loader import load_engine_data, ensure_database, DB_PATH
+from .snapshot import snapshot_key
+from .referrals import detect_referrals, build_referral_index, referral_threads
+from .failures import detect_failures, update_failures, failures_stamp, read_failures_stamp, write_failures_stamp
+from .metrics_cube import build_cube, slice_cube
+from .thread_facts import build_thread_facts, mark_outcomes
+from .message_index import build_message_index, value_positions, intersect, in_threads_of
+from .search_index import ensure_search_index, search_rowids, search_snippets
+from .text_features import NO_SURVEY
+from .response_cache import invalidate_caches, response_cache
 
 class DataEngine:
     _instance = None
+    _instance_lock = threading.Lock()
 
     def __init__(self):
         if DataEngine._instance is not None:
@@ -18,60 +29,223 @@ class DataEngine:
             self.df = None
             self.referrals_df = None
             self.failures_df = None
+            # Referral messages of df (referrals.build_referral_index); text never changes with HITL
+            self.referral_index = None
+            self.thread_lengths = pd.Series(dtype=int)
+            self.empty_msg_threads = set()
+            self.servilinea_threads = set()
+            self.thread_order = np.empty(0, dtype=np.intp)
+            self.thread_offsets = {}
+            self.date_indexes = {}
+            self.message_index = None
+            self.search_ready = False
+            # etl_metadata build_id of the database df was loaded from (FTS rowids are only valid for it)
+            self.build_id = None
+            self.cube = None
+            self.thread_facts = None
+            # Bumped on every reload / HITL update; part of the response cache key
+            self.data_version = 0
             self.etl_state = {
                 "is_running": False,
                 "start_time": None,
                 "last_status": None  # "success" | "error" | None
             }
-            
-            self._initialize()
+            # Initial load, run in the background (see start_loading)
+            self.load_state = {
+                "state": "idle",  # "idle" | "loading" | "ready" | "error"
+                "stage": None,
+                "start_time": None,
+                "ready_time": None,
+                "error": None
+            }
+            self._load_lock = threading.Lock()
 
     @staticmethod
     def get_instance():
+        """
+        Returns the engine, creating it on first use (thread-safe). Never blocks
+        on data loading: the first call starts it in the background, check
+        is_ready() before relying on the data.
+        """
         if DataEngine._instance is None:
-            DataEngine()
+            with DataEngine._instance_lock:
+                if DataEngine._instance is None:
+                    DataEngine()
+        DataEngine._instance.start_loading()
         return DataEngine._instance
 
+    def start_loading(self):
+        """Starts the initial load in a daemon thread, once."""
+        with self._load_lock:
+            if self.load_state["state"] != "idle":
+                return
+            self.load_state.update({"state": "loading", "start_time": time.time()})
+        threading.Thread(target=self._load_in_background, name="data-engine-load", daemon=True).start()
+
+    def _load_in_background(self):
+        try:
+            self._initialize()
+        except Exception as e:
+            print(f"Data Engine failed to initialize: {e}")
+            self.load_state.update({"state": "error", "stage": None, "error": str(e)})
+
+    def _mark_ready(self):
+        if self.load_state["state"] != "ready":
+            self.load_state.update({"state": "ready", "ready_time": time.time(), "error": None})
+        self.load_state["stage"] = None
+
+    def is_ready(self):
+        return self.load_state["state"] == "ready"
+
+    def wait_until_ready(self, timeout=None):
+        """Blocks until the initial load finished (scripts, tests). Returns is_ready()."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.load_state["state"] in ("idle", "loading"):
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.05)
+        return self.is_ready()
+
+    def get_load_status(self):
+        status = dict(self.load_state)
+        end = status["ready_time"] or time.time()
+        status["elapsed_seconds"] = round(end - status["start_time"], 2) if status["start_time"] else 0
+        return status
+
     def _initialize(self):
         print("initializing Data Engine...")
         start_time = time.time()
         
-        # 1. Load Core Data
-        df = load_data()
-        
-        # 2. Pre-compute Thread Metadata (In-Memory)
-        thread_lengths = df.groupby('thread_id').size() if not df.empty else pd.Series(dtype=int)
+        # 1. Load Core Data — messages, referrals and failures all through one
+        # connection, so an ETL swapping the database file meanwhile cannot mix
+        # tables from two different builds.
+        self.load_state["stage"] = "database"
+        ensure_database()
+        conn = self._get_db_conn()
+        try:
+            self.load_state["stage"] = "messages"
+            df, thread_facts = load_engine_data(conn)
+            build_id = self._db_build_id(conn)
+            self.load_state["stage"] = "referrals"
+            referrals_df, servilinea_threads = self._load_or_compute_referrals(df, conn)
+            referral_index = build_referral_index(df)
+            self.load_state["stage"] = "failures"
+            failures_df = self._load_or_compute_failures(df, conn)
+            self.load_state["stage"] = "search"
+            search_ready = self._ensure_search_index(conn)
+        finally:
+            conn.close()
         
-        # Empty messages check
-        empty_msg_threads = set()
-        if not df.empty and 'text' in df.columns:
-            empty_msg_threads = set(df[df['text'].str.strip() == '']['thread_id'].unique())
+        # 2. Thread Metadata (fact table precomputed with the snapshot)
+        thread_facts = mark_outcomes(thread_facts, referrals_df, failures_df)
+        thread_lengths = thread_facts['messages']
+        empty_msg_threads = set(thread_facts.index[thread_facts['has_empty']])
         
-        # 3. Load or Compute Derived Analysis (Persisted)
-        referrals_df, servilinea_threads = self._load_or_compute_referrals(df)
-        failures_df = self._load_or_compute_failures(df)
+        thread_order, thread_offsets = self._build_thread_index(df)
+        date_indexes = {
+            'messages': self._build_date_index(df),
+            'referrals': self._build_date_index(referrals_df),
+            'failures': self._build_date_index(failures_df),
+        }
+        message_index = build_message_index(df)
+        self.load_state["stage"] = "aggregates"
+        cube = build_cube(df)
         
-        # 4. Atomic Swap
+        # 3. Atomic Swap
         self.df = df
+        self.thread_order = thread_order
+        self.thread_offsets = thread_offsets
+        self.date_indexes = date_indexes
+        self.message_index = message_index
+        self.search_ready = search_ready
+        self.build_id = build_id
+        self.cube = cube
+        self.thread_facts = thread_facts
         self.thread_lengths = thread_lengths
         self.empty_msg_threads = empty_msg_threads
         self.referrals_df = referrals_df
+        self.referral_index = referral_index
         self.servilinea_threads = servilinea_threads
         self.failures_df = failures_df
+        self._bump_data_version()
         
+        self._mark_ready()
         print(f"Data Engine initialized in {time.time() - start_time:.2f}s")
     
+    @staticmethod
+    def _build_thread_index(df):
+        """
+        Thread index over df: row positions grouped by thread (stable sort, so
+        each thread keeps its rowid order) and thread_id -> (start, end) offsets
+        into that array.
+        """
+        if df.empty or 'thread_id' not in df.columns:
+            return np.empty(0, dtype=np.intp), {}
+        codes, uniques = pd.factorize(df['thread_id'])
+        order = np.argsort(codes, kind='stable')
+        ends = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+        starts = np.concatenate(([0], ends[:-1]))
+        return order, dict(zip(uniques, zip(starts.tolist(), ends.tolist())))
+
+    @staticmethod
+    def _build_date_index(frame):
+        """
+        Date index over frame['fecha']: row positions sorted by date (stable,
+        missing dates left out) and the matching sorted dates, so a date range
+        is two searchsorted calls instead of a full-length mask.
+        """
+        if frame is None or frame.empty or 'fecha' not in frame.columns:
+            return None
+        dates = pd.to_datetime(frame['fecha']).to_numpy()
+        order = np.argsort(dates, kind='stable')
+        order = order[~np.isnat(dates[order])]
+        return order, dates[order]
+
+    @staticmethod
+    def _date_positions(frame, date_index, start_date=None, end_date=None):
+        """
+        Sorted positions of the rows of frame with start_date <= fecha <= end_date
+        (both inclusive); None when the range covers every row.
+        """
+        if not (start_date or end_date) or frame is None or frame.empty or date_index is None:
+            return None
+        order, dates = date_index
+        lo = np.searchsorted(dates, np.datetime64(pd.to_datetime(start_date)), side='left') if start_date else 0
+        hi = np.searchsorted(dates, np.datetime64(pd.to_datetime(end_date)), side='right') if end_date else len(dates)
+        if lo == 0 and hi == len(frame):
+            return None
+        return np.sort(order[lo:hi])
+
+    @classmethod
+    def _slice_by_date(cls, frame, date_index, start_date=None, end_date=None):
+        """Rows of frame with start_date <= fecha <= end_date (both inclusive), in frame order."""
+        positions = cls._date_positions(frame, date_index, start_date, end_date)
+        if positions is None:
+            return frame
+        if len(positions) and positions[-1] - positions[0] == len(positions) - 1:
+            return frame.iloc[positions[0]:positions[-1] + 1]
+        return frame.iloc[positions]
+
     def _get_db_conn(self):
         return sqlite3.connect(DB_PATH)
 
-    def _load_or_compute_referrals(self, df):
+    @staticmethod
+    def _restore_types(derived_df):
+        """Gives tables read back from SQLite the same dtypes as a fresh detect_* result."""
+        if 'fecha' in derived_df.columns:
+            derived_df['fecha'] = pd.to_datetime(derived_df['fecha'])
+        for col in derived_df.columns:
+            if col != 'fecha' and derived_df[col].isnull().any():
+                derived_df[col] = derived_df[col].astype(object).where(pd.notnull(derived_df[col]), None)
+        return derived_df
+
+    def _load_or_compute_referrals(self, df, conn):
         referrals_df = pd.DataFrame()
         servilinea_threads = set()
         
-        conn = self._get_db_conn()
         try:
             print("Loading referrals from DB...")
-            referrals_df = pd.read_sql("SELECT * FROM referrals", conn)
+            referrals_df = self._restore_types(pd.read_sql("SELECT * FROM referrals", conn))
             if referrals_df.empty and not df.empty:
                  raise Exception("Empty referrals table") # Force re-compute
         except Exception:
@@ -82,8 +256,6 @@ class DataEngine:
                 # Index
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_ref_thread_id ON referrals (thread_id)")
                 conn.commit()
-        finally:
-            conn.close()
             
         # Cache Servilinea Threads Set
         if not referrals_df.empty:
@@ -91,51 +263,241 @@ class DataEngine:
             
         return referrals_df, servilinea_threads
 
-    def _load_or_compute_failures(self, df):
-        failures_df = pd.DataFrame()
-        conn = self._get_db_conn()
-        try:
+    def _load_or_compute_failures(self, df, conn):
+        """
+        Failures table for df. The persisted table is reused when its stamp
+        (see failures) matches the data and rules loaded now; when only HITL
+        corrections are missing, just the corrected threads are recomputed.
+        """
+        key = snapshot_key(conn)
+        current = failures_stamp(key['build_id'], key['hitl_rowid']) if key else None
+        stored = read_failures_stamp(conn)
+        if current is not None and stored == current:
             print("Loading failures from DB...")
-            failures_df = pd.read_sql("SELECT * FROM failures", conn)
-            if failures_df.empty and not df.empty:
-                 raise Exception("Empty failures table")
-            # Ensure schema has new columns; recompute if missing
-            if 'last_ai_message' not in failures_df.columns:
-                raise Exception("Schema outdated — missing last_ai_message")
-        except Exception:
-            print("Failures not found in DB. Computing...")
+            return self._read_failures(conn)
+        if (current is not None and stored is not None and stored.get('rules') == current['rules']
+                and stored.get('build_id') == current['build_id']
+                and isinstance(stored.get('hitl_rowid'), int) and stored['hitl_rowid'] <= current['hitl_rowid']):
+            threads = [r[0] for r in conn.execute(
+                "SELECT DISTINCT m.thread_id FROM hitl_corrections h JOIN messages m ON m.id = h.message_id "
+                "WHERE h.rowid > ?", (stored['hitl_rowid'],)
+            ).fetchall()]
+            print(f"Failures: recomputing {len(threads)} threads corrected since the last detection...")
+            failures_df = update_failures(self._read_failures(conn), df, threads)
+        else:
+            print("Failures missing or stale in DB (data or rules changed). Computing...")
             failures_df = detect_failures(df)
-            if not failures_df.empty:
-                # Convert list/dict columns if any (failures usually flat)
-                failures_df.to_sql('failures', conn, if_exists='replace', index=False)
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_fail_thread_id ON failures (thread_id)")
-                conn.commit()
-        finally:
-            conn.close()
+        # Rewritten whole; _read_failures returns it in detect_failures order (by thread_id)
+        conn.execute("DROP TABLE IF EXISTS failures")
+        if not failures_df.empty:
+            failures_df.to_sql('failures', conn, if_exists='replace', index=False)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_fail_thread_id ON failures (thread_id)")
+        if current is not None:
+            write_failures_stamp(conn, current)
+        conn.commit()
         return failures_df
 
+    @staticmethod
+    def _table_exists(conn, table):
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone() is not None
+
+    def _read_failures(self, conn):
+        if not self._table_exists(conn, 'failures'):
+            return pd.DataFrame()
+        return self._restore_types(pd.read_sql("SELECT * FROM failures ORDER BY thread_id", conn))
+
+    @staticmethod
+    def _ensure_search_index(conn):
+        try:
+            return ensure_search_index(conn)
+        except Exception as e:
+            print(f"Search index unavailable, falling back to scanning texts: {e}")
+            return False
+
+    @staticmethod
+    def _db_build_id(conn):
+        """ETL build_id of the database behind conn (None on databases that predate it)."""
+        try:
+            row = conn.execute("SELECT value FROM etl_metadata WHERE key = 'build_id'").fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def _search_positions(self, search):
+        """
+        Sorted positions of the messages whose text matches `search` (full-text
+        index) plus, as a hash lookup, every message of the thread named `search`.
+        None when the database file is no longer the build df was loaded from
+        (an ETL swapped it before the reload): its rowids would name other rows.
+        """
+        with closing(self._get_db_conn()) as conn:
+            if self._db_build_id(conn) != self.build_id:
+                return None
+            rowids = np.asarray(search_rowids(conn, search), dtype=np.int64)
+        df_rowids = self.df['rowid'].to_numpy()
+        positions = np.minimum(np.searchsorted(df_rowids, rowids), len(df_rowids) - 1)
+        positions = positions[df_rowids[positions] == rowids]
+        thread_positions = self._thread_positions(search.strip())
+        if len(thread_positions):
+            positions = np.union1d(positions, thread_positions)
+        return positions
+
+    def get_search_snippets(self, search, rowids):
+        """
+        {rowid: highlighted fragment} of the given messages for `search` ({}
+        without the index, or when the database is not the build df came from).
+        """
+        if not self.search_ready or not search:
+            return {}
+        with closing(self._get_db_conn()) as conn:
+            if self._db_build_id(conn) != self.build_id:
+                return {}
+            return search_snippets(conn, search, [int(r) for r in rowids])
+
     def get_messages(self, start_date=None, end_date=None):
         if self.df is None:
             return pd.DataFrame()
-            
-        df_filtered = self.df
-        if (start_date or end_date) and not df_filtered.empty and 'fecha' in df_filtered.columns:
-            mask = pd.Series(True, index=df_filtered.index)
-            if start_date:
-                mask &= (df_filtered['fecha'] >= pd.to_datetime(start_date))
-            if end_date:
-                mask &= (df_filtered['fecha'] <= pd.to_datetime(end_date))
-            df_filtered = df_filtered[mask]
-        return df_filtered
-
-    def get_referrals(self):
-        return self.referrals_df
-
-    def get_failures(self):
-        return self.failures_df
+        return self._slice_by_date(self.df, self.date_indexes.get('messages'), start_date, end_date)
+
+    def get_referrals(self, start_date=None, end_date=None):
+        return self._slice_by_date(self.referrals_df, self.date_indexes.get('referrals'), start_date, end_date)
+
+    def get_failures(self, start_date=None, end_date=None):
+        return self._slice_by_date(self.failures_df, self.date_indexes.get('failures'), start_date, end_date)
+
+    def get_referral_threads(self, start_date=None, end_date=None):
+        """
+        Threads with a referral message in the date range, with the fecha and
+        channel of the first one (referrals.referral_threads), from the referral
+        index instead of a keyword search over the messages.
+        """
+        if self.df is None:
+            return referral_threads(pd.DataFrame())
+        return referral_threads(self.get_messages(start_date, end_date), self.referral_index)
+
+    def get_failure_threads(self, start_date=None, end_date=None):
+        """
+        detect_failures over the messages of the date range: the repetition and
+        sentiment criteria look at the whole range, so a range is detected on
+        its messages, once per data version (kept in the response cache).
+        """
+        return response_cache.get_or_compute(
+            "detect_failures", {"start_date": start_date, "end_date": end_date},
+            lambda: detect_failures(self.get_messages(start_date, end_date)),
+        )
+
+    def get_cube(self, start_date=None, end_date=None):
+        """Daily metrics cube (see metrics_cube) for a date range; None if it can't be built."""
+        if self.df is None:
+            return None
+        cube = self.cube
+        if cube is None:
+            # Dropped by a HITL update; rebuilt on first use
+            cube = self.cube = build_cube(self.df)
+        return slice_cube(cube, start_date, end_date)
+
+    def get_thread_facts(self, start_date=None, end_date=None):
+        """
+        Thread fact table (see thread_facts) of the threads with messages in the
+        date range. The full-range table is kept in memory; a range is rebuilt
+        from its messages, so first category, counts and flags only look at
+        messages inside the range, like the per-message code did.
+        """
+        if self.df is None:
+            return build_thread_facts(None)
+        if start_date or end_date:
+            return mark_outcomes(build_thread_facts(self.get_messages(start_date, end_date)),
+                                 self.referrals_df, self.failures_df)
+        facts = self.thread_facts
+        if facts is None:
+            # Dropped by a HITL update; rebuilt on first use
+            facts = self.thread_facts = mark_outcomes(build_thread_facts(self.df), self.referrals_df, self.failures_df)
+        return facts
+
+    def find_messages(self, equals=None, start_date=None, end_date=None, thread_id=None,
+                      exclude_empty=False, survey_result=None, search=None):
+        """
+        Sorted positions in self.df of the messages matching every given filter,
+        from the message index instead of masks over the whole frame:
+
+            equals         {column: value} exact matches (see message_index.INDEXED_COLUMNS)
+            start/end_date date range, both inclusive
+            thread_id      one thread
+            exclude_empty  drop blank messages
+            survey_result  'useful' / 'not_useful' / 'unknown': threads with a survey
+                           answer of that status inside the thread / date scope
+            search         full-text query (see search_index) or exact thread id
+        """
+        if self.df is None or self.df.empty:
+            return np.empty(0, dtype=np.intp)
+        index = self.message_index
+        if index is None:
+            # Dropped by a HITL update; rebuilt on first use
+            index = self.message_index = build_message_index(self.df)
+
+        scope = []
+        if thread_id:
+            scope.append(self._thread_positions(thread_id))
+        dates = self._date_positions(self.df, self.date_indexes.get('messages'), start_date, end_date)
+        if dates is not None:
+            scope.append(dates)
+
+        position_sets = list(scope)
+        for col, value in (equals or {}).items():
+            position_sets.append(value_positions(index, col, value))
+        if exclude_empty and 'non_empty' in index:
+            position_sets.append(index['non_empty'])
+        search_positions = None
+        if search and self.search_ready and 'rowid' in self.df.columns:
+            search_positions = self._search_positions(search)
+        if search_positions is not None:
+            position_sets.append(search_positions)
+        positions = intersect(position_sets) if position_sets else np.arange(index['size'])
+
+        if survey_result:
+            # [survey] messages with that survey_status ('none' is no survey, not an answer)
+            answers = (value_positions(index, 'survey_status', survey_result)
+                       if survey_result != NO_SURVEY else np.empty(0, dtype=np.intp))
+            positions = in_threads_of(index, intersect(scope + [answers]), positions)
+        if search and search_positions is None:
+            # No usable full-text index: scan the remaining rows (regex on text or thread_id)
+            candidates = self.df.iloc[positions]
+            text_match = candidates['text'].str.contains(search, case=False, na=False)
+            thread_match = candidates['thread_id'].str.contains(search, case=False, na=False)
+            positions = positions[(text_match | thread_match).to_numpy()]
+        return positions
+
+    def _thread_positions(self, thread_id):
+        bounds = self.thread_offsets.get(thread_id)
+        if bounds is None:
+            return self.thread_order[:0]
+        return self.thread_order[bounds[0]:bounds[1]]
+
+    def get_thread(self, thread_id):
+        """All messages of one thread in rowid order, without scanning the frame."""
+        if self.df is None:
+            return pd.DataFrame()
+        positions = self._thread_positions(thread_id)
+        if len(positions) and positions[-1] - positions[0] == len(positions) - 1:
+            # Contiguous rows: plain slice, no copy
+            return self.df.iloc[positions[0]:positions[-1] + 1]
+        return self.df.iloc[positions]
+
+    def get_threads(self, thread_ids):
+        """Messages of several threads, grouped by thread in the given order."""
+        if self.df is None:
+            return pd.DataFrame()
+        parts = [self._thread_positions(tid) for tid in thread_ids]
+        return self.df.iloc[np.concatenate(parts) if parts else self.thread_order[:0]]
 
     def get_thread_length(self, thread_id):
         return self.thread_lengths.get(thread_id, 0)
+
+    def get_thread_lengths(self, thread_ids):
+        """get_thread_length() for a Series of thread ids."""
+        return thread_ids.map(self.thread_lengths).fillna(0).astype(int)
     
     def is_servilinea(self, thread_id):
         return thread_id in self.servilinea_threads
@@ -158,6 +520,11 @@ class DataEngine:
             "end": dates.max().strftime('%Y-%m-%d')
         }
 
+    def _bump_data_version(self):
+        """New data in memory: responses cached for the previous version are dropped."""
+        self.data_version += 1
+        invalidate_caches(self.data_version)
+
     def reload(self):
         print("Reloading Data Engine...")
         self._initialize()
@@ -175,6 +542,18 @@ class DataEngine:
                 if mask.any():
                     for k, v in updates.items():
                         if k in self.df.columns:
+                            col = self.df[k]
+                            if isinstance(col.dtype, pd.CategoricalDtype) and v is not None and v not in col.cat.categories:
+                                self.df[k] = col.cat.add_categories([v])
                             self.df.loc[mask, k] = v
+                    # Failures of the corrected thread; the persisted table catches up
+                    # on the next load (its stamp is older than this correction)
+                    failures_df = update_failures(self.failures_df, self.df, self.df.loc[mask, 'thread_id'].unique())
+                    self.date_indexes = {**self.date_indexes, 'failures': self._build_date_index(failures_df)}
+                    self.failures_df = failures_df
+                    self.cube = None
+                    self.thread_facts = None
+                    self.message_index = None
+                    self._bump_data_version()
             else:
                 print("Warning: 'id' column not found in DataEngine dataframe")
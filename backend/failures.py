@@ -1,6 +1,61 @@
-
+"""
+Failed-conversation detection and the stamp of the persisted failures table.
+
+A thread fails when the bot answers with an incapacity phrase, the user
+repeats a message, or most of its messages are negative. Every criterion is
+one vectorized pass (a single compiled alternation over the AI texts, a
+duplicated() over the human ones, a grouped mean over the sentiments), and
+each thread's result only depends on its own messages, so a subset of
+threads can be recomputed on its own (update_failures).
+
+The failures table in SQLite carries a stamp in etl_metadata:
+
+    {"build_id": ..., "hitl_rowid": ..., "rules": FAILURE_RULES_HASH}
+
+i.e. the ETL build and last HITL correction of the messages it was computed
+from, and the detection rules. The DataEngine reuses the table when the
+stamp matches the database, recomputes the threads corrected since
+hitl_rowid when only corrections are missing, and everything otherwise (new
+phrases, criteria or data).
+"""
+import hashlib
+import json
+import re
+
+import numpy as np
 import pandas as pd
 
+from .thread_stats import dominant_values
+
+# Phrases of a bot message that admits it cannot help (matched on the lowercased text)
+FAILURE_KEYWORDS = [
+    "no puedo", "no tengo información", "no estoy seguro",
+    "te recomiendo comunicarte", "no me es posible", "fuera de mi alcance",
+    "no cuento con", "lo siento, no", "no tengo acceso",
+    "intenta más tarde", "error", "no disponible", "no entiendo"
+]
+CRITERIA_LABELS = [
+    "Respuesta de incapacidad del bot",
+    "Usuario repite pregunta",
+    "Sentimiento negativo predominante",
+]
+# Share of negative messages above which a thread counts as failed
+NEGATIVE_RATIO = 0.5
+# Bump when the criteria change; the phrases are hashed on their own
+FAILURE_RULES_VERSION = '2'
+FAILURE_RULES_HASH = hashlib.sha1(
+    json.dumps([FAILURE_RULES_VERSION, FAILURE_KEYWORDS, CRITERIA_LABELS, NEGATIVE_RATIO]).encode('utf-8')
+).hexdigest()[:16]
+FAILURES_STAMP_KEY = 'failures_stamp'
+
+_FAILURE_RE = re.compile('|'.join(re.escape(kw) for kw in FAILURE_KEYWORDS))
+# criteria label of every combination of the three flags (bit i = CRITERIA_LABELS[i])
+_CRITERIA_BY_CODE = np.array([
+    ", ".join(label for bit, label in enumerate(CRITERIA_LABELS) if code & (1 << bit))
+    for code in range(1 << len(CRITERIA_LABELS))
+], dtype=object)
+
+
 def detect_failures(df: pd.DataFrame):
     """
     Identifies conversations where the bot likely failed.
@@ -9,90 +64,62 @@ def detect_failures(df: pd.DataFrame):
     2. User repeats the same message (sign of frustration).
     3. High proportion of negative sentiment.
     """
-    
-    # 1. Bot keywords
-    failure_keywords = [
-        "no puedo", "no tengo información", "no estoy seguro", 
-        "te recomiendo comunicarte", "no me es posible", "fuera de mi alcance", 
-        "no cuento con", "lo siento, no", "no tengo acceso", 
-        "intenta más tarde", "error", "no disponible", "no entiendo"
-    ]
-    
-    # Create a mask for bot messages detecting failure keywords
-    # Ensure text is string and handle NaNs
-    bot_msgs = df[df['type'] == 'ai'].copy()
-    if bot_msgs.empty:
+    if df.empty or not (df['type'] == 'ai').any():
         return pd.DataFrame()
-        
-    bot_msgs['failure_keyword'] = bot_msgs['text'].astype(str).str.lower().apply(
-        lambda x: any(kw in x for kw in failure_keywords)
-    )
-    
-    failed_threads_keywords = bot_msgs[bot_msgs['failure_keyword']]['thread_id'].unique()
-
-    # 2. User repetition (heuristic: same text > 1 time in thread by human)
-    human_msgs = df[df['type'] == 'human'].copy()
-    if not human_msgs.empty:
-        # Group by thread and text, count occurrences
-        repetition = human_msgs.groupby(['thread_id', 'text']).size().reset_index(name='count')
-        failed_threads_repetition = repetition[repetition['count'] > 1]['thread_id'].unique()
-    else:
-        failed_threads_repetition = []
+    return _detect_thread_failures(df)
 
-    # 3. Accumulated Negative Sentiment (> 50% of messages are negative)
+
+def _detect_thread_failures(df):
+    """detect_failures without the whole-frame guard: each thread only depends on its own rows."""
+    # 1. Bot keywords: one compiled alternation over the AI texts
+    is_ai = (df['type'] == 'ai').to_numpy(dtype=bool)
+    bot_text = df['text'][is_ai].astype(str).str.lower()
+    keyword_hit = bot_text.str.contains(_FAILURE_RE, na=False).to_numpy(dtype=bool)
+    failed_threads_keywords = df['thread_id'][is_ai][keyword_hit].unique()
+
+    # 2. User repetition: same text more than once in the thread by the human
+    human = df.loc[(df['type'] == 'human') & df['thread_id'].notna() & df['text'].notna(), ['thread_id', 'text']]
+    failed_threads_repetition = human.loc[human.duplicated(keep=False), 'thread_id'].unique()
+
+    # 3. Accumulated Negative Sentiment (> 50% of the messages with a sentiment are negative)
     if 'sentiment' in df.columns:
-        sentiment_counts = df.groupby(['thread_id', 'sentiment']).size().unstack(fill_value=0)
-        if 'negativo' in sentiment_counts.columns:
-            sentiment_counts['total'] = sentiment_counts.sum(axis=1)
-            sentiment_counts['neg_ratio'] = sentiment_counts['negativo'] / sentiment_counts['total']
-            failed_threads_sentiment = sentiment_counts[sentiment_counts['neg_ratio'] > 0.5].index.tolist()
-        else:
-            failed_threads_sentiment = []
+        rated = df['sentiment'].notna()
+        negative = (df['sentiment'][rated] == 'negativo').astype(float)
+        neg_ratio = negative.groupby(df['thread_id'][rated], sort=False, observed=True).mean()
+        failed_threads_sentiment = neg_ratio.index[neg_ratio > NEGATIVE_RATIO]
     else:
         failed_threads_sentiment = []
 
     # Combine all
     all_failed_threads = list(set(failed_threads_keywords) | set(failed_threads_repetition) | set(failed_threads_sentiment))
-    
+
     if not all_failed_threads:
         return pd.DataFrame()
 
     # Optimization: Fully Vectorized Approach
     # 1. Filter relevant messages once
-    relevant_df = df[df['thread_id'].isin(all_failed_threads)].copy()
-    
-    # 2. Aggregations per thread
-    # Sort by time/index to ensure first/last are correct (assuming index is somewhat chronological or use sort_values)
-    # relevant_df = relevant_df.sort_index() 
-    
+    relevant_df = df[df['thread_id'].isin(all_failed_threads)]
+
+    # 2. Aggregations per thread (rows keep their rowid order, so first/last follow the conversation)
     grouped = relevant_df.groupby('thread_id')
-    
+
     # Category and Date — use categoria_yaml (YAML source of truth), fallback to intencion
     cat_col = 'categoria_yaml' if 'categoria_yaml' in relevant_df.columns else 'intencion'
     first_vals = grouped[[cat_col, 'product_type', 'fecha']].first()
     if cat_col == 'categoria_yaml':
         first_vals = first_vals.rename(columns={'categoria_yaml': 'intencion'})
-    
+
     # Message Count
     msg_counts = grouped.size().rename('msg_count')
-    
+
     # Last User Message
     last_user_msgs = relevant_df[relevant_df['type'] == 'human'].groupby('thread_id')['text'].last().rename('last_user_message')
-    
-    # Sentiment (Approximate mode or just most frequent)
-    # A fast way to get mode is `agg(pd.Series.mode)`, but validation is needed. 
-    # Let's fallback to 'first' if mode fails or is complex, or use a custom fast aggregator.
-    # For speed, let's take the sentiment of the last message or the most frequent if easy.
-    # We will use a lambda but care for performance.
-    def get_mode(x):
-        m = x.mode()
-        return m.iloc[0] if not m.empty else "neutral"
-        
-    # Optimizing sentiment mode:
-    # calculating mode on groupby can be slow. 
-    # Alternative: Count values, sort, take top.
-    # For now, let's try the simple lambda, if it's slow we'll optimize.
-    sentiments = grouped['sentiment'].agg(get_mode).rename('sentiment')
+
+    # Sentiment: most frequent per thread ("neutral" when the thread has none)
+    sentiments = (
+        dominant_values(relevant_df, 'sentiment')['value']
+        .reindex(msg_counts.index).fillna("neutral").rename('sentiment')
+    )
 
     # Last AI Message — what the bot said (for understanding WHY it failed)
     ai_in_failed = relevant_df[relevant_df['type'] == 'ai']
@@ -107,19 +134,11 @@ def detect_failures(df: pd.DataFrame):
     # 3. Construct Result DataFrame
     result = pd.concat([first_vals, msg_counts, last_user_msgs, last_ai_msgs, sentiments, was_redir], axis=1)
 
-    # 4. Add Criteria
-    kw_set = set(failed_threads_keywords)
-    rep_set = set(failed_threads_repetition)
-    sent_set = set(failed_threads_sentiment)
-
-    def get_criteria(tid):
-        c = []
-        if tid in kw_set: c.append("Respuesta de incapacidad del bot")
-        if tid in rep_set: c.append("Usuario repite pregunta")
-        if tid in sent_set: c.append("Sentimiento negativo predominante")
-        return ", ".join(c)
-
-    result['criteria'] = result.index.map(get_criteria)
+    # 4. Add Criteria: a bit per criterion, decoded with a lookup table
+    code = np.zeros(len(result), dtype=np.intp)
+    for bit, threads in enumerate([failed_threads_keywords, failed_threads_repetition, failed_threads_sentiment]):
+        code |= result.index.isin(threads).astype(np.intp) << bit
+    result['criteria'] = _CRITERIA_BY_CODE[code]
 
     # Reset index to have thread_id as column
     result = result.reset_index()
@@ -132,19 +151,64 @@ def detect_failures(df: pd.DataFrame):
 
     return result
 
-# Simple cache system
-_failures_cache = None
-_last_df_len = 0
-
-def get_failures_cached(df: pd.DataFrame):
-    global _failures_cache, _last_df_len
-    
-    # Simple invalidation strategy: if DF length changes, re-compute
-    # In a real app with immutable DB loads, this might be enough.
-    if _failures_cache is not None and len(df) == _last_df_len:
-        return _failures_cache
-        
-    print("Computing failures analysis...")
-    _failures_cache = detect_failures(df)
-    _last_df_len = len(df)
-    return _failures_cache
+
+def update_failures(failures_df: pd.DataFrame, df: pd.DataFrame, thread_ids):
+    """
+    failures_df with the rows of thread_ids recomputed from their messages in
+    df, in detect_failures order (by thread_id).
+    """
+    thread_ids = list(thread_ids)
+    if not thread_ids:
+        return failures_df
+    fresh = _detect_thread_failures(df[df['thread_id'].isin(thread_ids)])
+    kept = failures_df
+    if failures_df is not None and not failures_df.empty:
+        kept = failures_df[~failures_df['thread_id'].isin(thread_ids)]
+    parts = [part for part in (kept, fresh) if part is not None and not part.empty]
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True).sort_values('thread_id', kind='stable', ignore_index=True)
+
+
+def failures_stamp(build_id, hitl_rowid):
+    """Stamp of a failures table computed from the data (build_id, hitl_rowid) with the current rules."""
+    return {'build_id': build_id, 'hitl_rowid': int(hitl_rowid), 'rules': FAILURE_RULES_HASH}
+
+
+def parse_failures_stamp(value):
+    """Stamp stored in etl_metadata (None if missing or unreadable)."""
+    try:
+        stamp = json.loads(value) if value else None
+    except (TypeError, ValueError):
+        return None
+    return stamp if isinstance(stamp, dict) else None
+
+
+def read_failures_stamp(conn):
+    """Stamp of the failures table in the database behind conn (None if it has none)."""
+    try:
+        row = conn.execute("SELECT value FROM etl_metadata WHERE key = ?", (FAILURES_STAMP_KEY,)).fetchone()
+    except Exception:
+        return None
+    return parse_failures_stamp(row[0]) if row else None
+
+
+def write_failures_stamp(conn, stamp):
+    conn.execute("CREATE TABLE IF NOT EXISTS etl_metadata (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute(
+        "INSERT INTO etl_metadata (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (FAILURES_STAMP_KEY, json.dumps(stamp) if stamp else None),
+    )
+
+
+def carry_failures_stamp(metadata, build_id):
+    """
+    Stamp for a new build that kept the previous build's failures rows (an
+    incremental ETL only recomputes the touched threads): still valid for the
+    corrections and rules it was computed with, or None if it was not valid.
+    """
+    stamp = parse_failures_stamp(metadata.get(FAILURES_STAMP_KEY))
+    if stamp is None or stamp.get('build_id') != metadata.get('build_id'):
+        return None
+    return {**stamp, 'build_id': build_id}
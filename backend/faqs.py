@@ -101,7 +101,8 @@ def get_faqs_by_category(df: pd.DataFrame, top_n: int = 5):
     ].copy()
 
     # Filter out noise phrases (greetings, fillers, thanks — even combined)
-    human_df = human_df[~human_df['text'].apply(_is_noise)]
+    noise = human_df['is_noise'] if 'is_noise' in human_df.columns else human_df['text'].apply(_is_noise)
+    human_df = human_df[~noise]
     # Also filter phrases shorter than 4 characters (e.g., "si", "no", "ok")
     human_df = human_df[human_df['text'].str.strip().str.len() >= 4]
 
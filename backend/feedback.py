@@ -7,11 +7,22 @@ import re
 import unicodedata
 from pydantic import BaseModel
 from typing import Optional
+from datetime import datetime
+
+from .loader import DB_SWAP_LOCK
+from .pagination import encode_cursor, decode_cursor
 
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "chat_data.db")
 YAML_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "categorias.yml")
 PRODUCTOS_YAML_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "productos.yml")
 
+# Manual corrections from the feedback panel. The ETL re-applies them after
+# every rebuild, so they survive re-ingestion of the CSV.
+HITL_TABLE = 'hitl_corrections'
+# Sort signature of the review queue (see pagination)
+FEEDBACK_SORT = 'fecha:desc,rowid'
+HITL_FIELDS = ['categoria_yaml', 'macro_yaml', 'sentiment', 'product_yaml', 'product_macro_yaml']
+
 class CategorizeRequest(BaseModel):
     message_id: str
     new_category: str
@@ -26,37 +37,107 @@ def clean_text_for_nlp(text):
     text = re.sub(r'[^\w\s\^\$]', '', text)
     return text.strip()
 
-def get_feedback_messages(page: int = 1, limit: int = 20):
+def ensure_hitl_table(conn):
+    """
+    Creates the hitl_corrections table. On databases that predate it, the
+    corrections recorded in messages (hitl_reviewed = 1) are copied over once.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (HITL_TABLE,)
+    ).fetchone()
+    if exists:
+        return
+    conn.execute(f"""
+        CREATE TABLE {HITL_TABLE} (
+            message_id TEXT NOT NULL,
+            categoria_yaml TEXT,
+            macro_yaml TEXT,
+            sentiment TEXT,
+            product_yaml TEXT,
+            product_macro_yaml TEXT,
+            corrected_at TEXT NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_hitl_message_id ON {HITL_TABLE} (message_id)")
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(messages)").fetchall()]
+    if 'hitl_reviewed' in cols:
+        conn.execute(f"""
+            INSERT INTO {HITL_TABLE} (message_id, categoria_yaml, macro_yaml, corrected_at)
+            SELECT id, categoria_yaml, macro_yaml, datetime('now')
+            FROM messages WHERE hitl_reviewed = 1 AND categoria_yaml IS NOT NULL
+        """)
+    conn.commit()
+
+def load_hitl_corrections(conn):
+    """
+    Latest correction per message, indexed by message_id. Each field keeps its
+    most recent non-null value, so a later category-only correction does not
+    erase an earlier product correction.
+    """
+    ensure_hitl_table(conn)
+    df = pd.read_sql(f"SELECT message_id, {', '.join(HITL_FIELDS)} FROM {HITL_TABLE} ORDER BY rowid", conn)
+    return df.groupby('message_id').last()
+
+def get_feedback_messages(page: int = 1, limit: int = 20, cursor: Optional[str] = None, include_total: bool = True):
+    """
+    Page of the HITL review queue, newest first (ties and undated rows by rowid).
+    With `cursor` (the `next_cursor` of the previous page) the page starts right
+    after the last row already returned, so reviewed messages leaving the queue
+    do not shift it, and the query seeks instead of skipping `offset` rows.
+    """
     conn = sqlite3.connect(DB_PATH)
+
+    conditions = ["requires_review = 1"]
+    params = []
     offset = (page - 1) * limit
+    if cursor:
+        last_fecha, last_rowid = decode_cursor(cursor, FEEDBACK_SORT)
+        if last_fecha is None:
+            conditions.append("(fecha IS NULL AND rowid > ?)")
+            params.append(last_rowid)
+        else:
+            conditions.append("(fecha < ? OR fecha IS NULL OR (fecha = ? AND rowid > ?))")
+            params.extend([last_fecha, last_fecha, last_rowid])
+        offset = 0
 
-    query = """
+    query = f"""
         SELECT
-            id, thread_id, text, fecha, sentiment,
+            rowid AS _rowid, id, thread_id, text, fecha, sentiment,
             categoria_yaml, macro_yaml,
             product_yaml, product_macro_yaml,
             requires_review
         FROM messages
-        WHERE requires_review = 1
-        ORDER BY fecha DESC
+        WHERE {' AND '.join(conditions)}
+        ORDER BY fecha DESC, rowid
         LIMIT ? OFFSET ?
     """
-    df = pd.read_sql(query, conn, params=(limit, offset))
+    # One extra row tells whether there is a next page
+    df = pd.read_sql(query, conn, params=(*params, limit + 1, offset))
 
-    count_query = "SELECT COUNT(*) as total FROM messages WHERE requires_review = 1"
-    total = pd.read_sql(count_query, conn).iloc[0]['total']
+    total = None
+    if include_total:
+        count_query = "SELECT COUNT(*) as total FROM messages WHERE requires_review = 1"
+        total = int(pd.read_sql(count_query, conn).iloc[0]['total'])
 
     conn.close()
 
+    next_cursor = None
+    if len(df) > limit:
+        df = df.iloc[:limit]
+        last = df.iloc[-1]
+        next_cursor = encode_cursor(FEEDBACK_SORT, [last['fecha'], int(last['_rowid'])])
+    df = df.drop(columns=['_rowid'])
+
     # Replace NaN with None so FastAPI can serialize to JSON.
     # df.where() alone doesn't work for float columns — use explicit object cast.
     df = df.astype(object).where(df.notna(), other=None)
 
     return {
         "data": df.to_dict(orient="records"),
-        "total": int(total),
+        "total": total,
         "page": page,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": next_cursor
     }
 
 def update_yaml_category(category_name: str, new_keyword: str):
@@ -131,7 +212,8 @@ def get_product_options():
         data = yaml.safe_load(f)
     return [p.get('nombre') for p in data.get('productos', []) if p.get('nombre')]
 
-def process_categorization(req: CategorizeRequest):
+def _save_categorization(req: CategorizeRequest):
+    """Writes one correction to messages and hitl_corrections. Returns (macro, product_macro)."""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
@@ -142,6 +224,7 @@ def process_categorization(req: CategorizeRequest):
         conn.commit()
 
     macro = _get_macro_for_category(req.new_category)
+    product_macro = None
 
     # Build SET clause dynamically
     set_parts = ["requires_review = 0", "hitl_reviewed = 1", "categoria_yaml = ?", "macro_yaml = ?", "intencion = ?"]
@@ -164,8 +247,22 @@ def process_categorization(req: CategorizeRequest):
 
     query = f"UPDATE messages SET {', '.join(set_parts)} WHERE id = ?"
     cursor.execute(query, tuple(params))
+
+    # Record the correction so the next ETL run re-applies it
+    ensure_hitl_table(conn)
+    cursor.execute(
+        f"INSERT INTO {HITL_TABLE} (message_id, {', '.join(HITL_FIELDS)}, corrected_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (req.message_id, req.new_category, macro, req.new_sentiment or None,
+         req.new_product or None, product_macro,
+         datetime.now().isoformat(timespec='seconds')),
+    )
     conn.commit()
     conn.close()
+    return macro, product_macro
+
+def process_categorization(req: CategorizeRequest):
+    with DB_SWAP_LOCK:
+        macro, product_macro = _save_categorization(req)
 
     # Update DataEngine in memory
     from .engine import DataEngine
@@ -36,17 +36,21 @@ def analyze_gaps_and_referrals(df: pd.DataFrame):
     
     gaps_list = []
     if not gap_msgs.empty:
+        # Most recent human message before each fallback, same thread (one as-of join)
+        humans = df.loc[df['type'] == 'human', ['thread_id']]
+        human_pos = humans.assign(pos=humans.index, human_idx=humans.index)
+        gap_pos = gap_msgs[['thread_id']].assign(pos=gap_msgs.index, gap_idx=gap_msgs.index)
+        preceding = pd.merge_asof(
+            gap_pos.sort_values('pos'), human_pos.sort_values('pos'),
+            on='pos', by='thread_id', direction='backward', allow_exact_matches=False
+        ).set_index('gap_idx')['human_idx']
+
         for idx, gap_row in gap_msgs.iterrows():
             thread_id = gap_row['thread_id']
-            # Find the most recent human message before this fallback
-            preceding = df[
-                (df['thread_id'] == thread_id) & 
-                (df['type'] == 'human') & 
-                (df.index < idx)
-            ].tail(1)
+            human_idx = preceding.get(idx)
             
-            if not preceding.empty:
-                human_msg = preceding.iloc[0]
+            if pd.notna(human_idx):
+                human_msg = df.loc[int(human_idx)]
                 gaps_list.append({
                     "user_request": human_msg['text'],
                     "ai_response": gap_row['text'],
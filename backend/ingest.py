@@ -1,11 +1,14 @@
 import time
 import sys
 import pandas as pd
+import numpy as np
 import os
 import sqlite3
 import yaml
 import re
-import unicodedata
+import csv
+import io
+import warnings
 # try:
 #     from pysentimiento import create_analyzer
 #     HAS_PYSENTIMIENTO = True
@@ -13,13 +16,110 @@ import unicodedata
 HAS_PYSENTIMIENTO = False
 
 import json
+import hashlib
+import uuid
+import multiprocessing
 import concurrent.futures
 from functools import partial
 
+from .keyword_matcher import (
+    get_category_matcher, get_product_matcher, classify_texts, file_hash,
+    strip_greeting_prefix as _strip_greeting_prefix,
+    SHORT_REPLY_KEYWORDS as _SHORT_REPLY_KEYWORDS,
+)
+from .loader import prepare_messages, load_data, patch_snapshot, DB_SWAP_LOCK
+from .feedback import load_hitl_corrections, ensure_hitl_table, HITL_TABLE, HITL_FIELDS
+from .text_features import add_text_features, survey_status, SURVEY_STATUSES, NO_SURVEY
+from .thread_stats import dominant_values
+from .snapshot import write_snapshot, snapshot_key, HAS_PYARROW
+from .referrals import detect_referrals
+from .failures import detect_failures, failures_stamp, carry_failures_stamp, FAILURES_STAMP_KEY
+from .search_index import build_search_index, search_index_exists, add_to_search_index, remove_from_search_index
+
 DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "data-asistente.csv")
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "chat_data.db")
 YAML_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "categorias.yml")
 PRODUCTOS_YAML_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "productos.yml")
+# The ETL builds the new database here and renames it over DB_PATH when done
+SHADOW_DB_PATH = DB_PATH + '.shadow'
+# Tables that outlive a full rebuild (not derived from the CSV)
+CARRY_OVER_TABLES = ['hitl_corrections', 'classification_memo']
+# A full run stores the CSV row at position i under rowid (i + 1) * ROWID_GAP, in
+# raw_messages and messages alike: rowid order is CSV order, and an incremental
+# run gives new rows rowids in the gaps instead of renumbering the stored ones.
+ROWID_GAP = 1 << 20
+# SQL condition on the rows of the threads an incremental run re-derives
+TOUCHED = "thread_id IN (SELECT thread_id FROM temp.touched_threads)"
+# Processes used for keyword classification (ETL_WORKERS env var, default: all cores).
+# 1 classifies in-process.
+CLASSIFY_WORKERS = int(os.environ.get('ETL_WORKERS', 0)) or (os.cpu_count() or 1)
+# Below this many distinct texts, starting the pool costs more than it saves
+PARALLEL_MIN_TEXTS = 5_000
+# Keyword classification results persisted across runs, keyed by text and rules version.
+# Bump MEMO_VERSION whenever the matching logic itself changes.
+MEMO_TABLE = 'classification_memo'
+MEMO_VERSION = '1'
+MEMO_COLUMNS = ['categoria_yaml', 'macro_yaml', 'requires_review', 'product_yaml', 'product_macro_yaml']
+# Rows the parser rejects (wrong field count) are copied here verbatim instead of being dropped
+QUARANTINE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "quarantine.csv")
+
+# Columns the pipeline reads from the CSV export; anything else is discarded per chunk.
+INGEST_COLUMNS = [
+    'id', 'thread_id', 'text', 'type', 'fecha', 'intencion', 'product_type',
+    'product_detail', 'segment', 'sentiment', 'input_tokens', 'output_tokens',
+    'client_ip', 'created_at',
+]
+# Records parsed per chunk. Bounds the parser's buffers, not the result: the cleaned
+# chunks are concatenated into one DataFrame holding every INGEST_COLUMNS row.
+CHUNK_SIZE = 50_000
+
+# Explicit schema of the messages table, in column order. Booleans are INTEGER 0/1.
+MESSAGE_TYPES = ('human', 'ai', 'tool')
+SENTIMENTS = ('positivo', 'neutral', 'negativo')
+
+
+def _enum_check(col, values):
+    # OR chain rather than IN (...): SQLite rebuilds the IN list for every inserted row
+    return "CHECK (" + " OR ".join(f"{col} = '{v}'" for v in values) + ")"
+
+
+MESSAGES_SCHEMA = [
+    ('id', 'TEXT'),
+    ('thread_id', 'TEXT'),
+    ('text', 'TEXT'),
+    ('type', 'TEXT ' + _enum_check('type', MESSAGE_TYPES)),
+    ('fecha', 'TEXT'),
+    ('intencion', 'TEXT'),
+    ('product_type', 'TEXT'),
+    ('product_detail', 'TEXT'),
+    ('segment', 'TEXT'),
+    ('sentiment', 'TEXT ' + _enum_check('sentiment', SENTIMENTS)),
+    ('input_tokens', 'INTEGER'),
+    ('output_tokens', 'INTEGER'),
+    ('client_ip', 'TEXT'),
+    ('created_at', 'TEXT'),
+    ('timestamp', 'TEXT'),
+    ('hora', 'INTEGER'),
+    ('product_yaml', 'TEXT'),
+    ('product_macro_yaml', 'TEXT'),
+    ('categoria_yaml', 'TEXT'),
+    ('macro_yaml', 'TEXT'),
+    ('requires_review', 'INTEGER'),
+    ('hitl_reviewed', 'INTEGER'),
+    ('is_servilinea', 'INTEGER'),
+    ('text_norm', 'TEXT'),
+    ('is_noise', 'INTEGER'),
+    ('is_system_leak', 'INTEGER'),
+    ('is_pure_greeting', 'INTEGER'),
+    ('word_count', 'INTEGER'),
+    ('survey_status', 'TEXT ' + _enum_check('survey_status', SURVEY_STATUSES)),
+]
+# Indexes created after the bulk load, one per real SQL access path
+MESSAGES_INDEXES = {
+    'idx_thread_id': 'messages (thread_id)',                 # incremental deletes / derived-table reloads
+    'idx_message_id': 'messages (id)',                       # HITL updates by id
+    'idx_review_queue': 'messages (requires_review, fecha)', # feedback queue: WHERE requires_review = 1 ORDER BY fecha
+}
 
 # Homologation table: CSV intencion value → (categoria_yaml, macro_yaml)
 # Keys are lowercase. Values must match exact names in categorias.yml.
@@ -48,20 +148,6 @@ INTENCION_HOMOLOGACION = {
     'centrales de riesgo':                          ('Centrales de Riesgo',               'Gestión Personal'),
 }
 
-def _clean_for_nlp(text):
-    if pd.isna(text): return ""
-    text = str(text).lower()
-    text = ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
-    text = re.sub(r'[^\w\s]', '', text)
-    return text.strip()
-
-def _load_categories():
-    if not os.path.exists(YAML_PATH):
-        return []
-    with open(YAML_PATH, 'r', encoding='utf-8') as f:
-        data = yaml.safe_load(f)
-    return data.get('categorias', [])
-
 def _build_product_homologation():
     """
     Reads productos.yml and builds a dict: alias_lowercase → (nombre, macro).
@@ -82,174 +168,64 @@ def _build_product_homologation():
         mapping[nombre.lower()] = (nombre, macro)
     return mapping
 
-def _load_products():
-    """Returns list of product dicts from productos.yml."""
-    if not os.path.exists(PRODUCTOS_YAML_PATH):
-        return []
-    with open(PRODUCTOS_YAML_PATH, 'r', encoding='utf-8') as f:
-        data = yaml.safe_load(f)
-    return data.get('productos', [])
-
-def _match_product_nlp(text, products):
+def _iter_csv_blocks(path, chunk_size=CHUNK_SIZE):
     """
-    Returns (nombre, macro) for the first product whose palabras_clave match the text.
-    Supports regex patterns (keywords starting with ^ or ending with $).
-    Returns (None, None) if no match.
+    Streams the CSV as (header_line, [record_bytes, ...]) blocks of at most
+    chunk_size records, without decoding or parsing the content.
+
+    Records are split on newlines that fall outside quoted fields (tracked by
+    quote parity, which RFC 4180 escaping "" preserves), so a message text with
+    embedded line breaks is never cut in half between two blocks.
     """
-    if not text or not text.strip():
-        return None, None
-    clean = _clean_for_nlp(text)
-    lower = text.lower().strip()
-    for prod in products:
-        nombre = prod.get('nombre', '')
-        macro  = prod.get('macro', nombre)
-        for kw in prod.get('palabras_clave', []):
-            if not kw:
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if header.startswith(b'\xef\xbb\xbf'):
+            header = header[3:]
+        records, pending, in_quotes = [], [], False
+        for line in f:
+            pending.append(line)
+            if line.count(b'"') & 1:
+                in_quotes = not in_quotes
+            if in_quotes:
                 continue
-            kw_str = str(kw)
-            if kw_str.startswith('^') or kw_str.endswith('$') or '\\b' in kw_str:
-                try:
-                    if re.search(kw_str, lower):
-                        return nombre, macro
-                except re.error:
-                    pass
-            else:
-                kw_clean = _clean_for_nlp(kw_str)
-                if kw_clean and kw_clean in clean:
-                    return nombre, macro
-    return None, None
-
-# Noise keywords that should be categorized as "Saludos" or "Sin Sentido" without review.
-# These are applied BEFORE general keyword matching.
-NOISE_KEYWORDS = {
-    'saludos': ['hola', 'buen dia', 'buenos dias', 'buenas tardes', 'buenas noches', 'saludos', 'hey', 'hi', 'hello'],
-    'agradecimiento': ['gracias', 'muchas gracias', 'mil gracias', 'ok', 'vale', 'listo', 'entendido', 'bien gracias', 'perfecto gracias'],
-    'despedida': ['chao', 'adios', 'hasta luego', 'nos vemos', 'bye']
-}
-
-# Greeting prefixes to strip before categorizing.  Sorted longest-first so
-# "hola buenas tardes" is tried before "hola".
-_GREETING_PREFIXES = sorted([
-    "hola buenas tardes", "hola buenas noches", "hola buenos dias",
-    "hola buen dia", "buenas tardes", "buenas noches", "buenos dias",
-    "buen dia", "buenas", "hola", "saludos", "que tal", "como estas",
-    "hey", "hi", "hello",
-], key=len, reverse=True)
-
-# Short replies that should NOT be propagated as real intent.
-# These go to Retroalimentación (Sin Clasificar) instead of whatever the
-# AI thought the thread was about.
-_SHORT_REPLY_KEYWORDS = {
-    'si', 'no', 'si por favor', 'no gracias', 'bueno', 'dale', 'ya',
-    'claro', 'correcto', 'exacto', 'eso', 'asi es', 'ajam', 'okey',
-    'igualmente', 'super', 'genial', 'excelente', 'obvio', 'porfa',
-    'aja', 'listo gracias', 'dale gracias', 'buenas noches', 'buenas tardes',
-    'buenos dias', 'buen dia', 'buenas',
-}
-
+            records.append(b''.join(pending))
+            pending = []
+            if len(records) >= chunk_size:
+                yield header, records
+                records = []
+        if pending:  # unterminated quote at EOF: hand it to the parser as-is
+            records.append(b''.join(pending))
+        if records:
+            yield header, records
+
+
+def _parse_fecha(raw):
+    """
+    Parses export timestamps ("2026-02-01 21:00:46.674505 UTC") to tz-aware UTC.
+    Fast path: fixed ISO 8601 format after dropping the literal " UTC" suffix.
+    Only the values it rejects go through the slow flexible parser.
+
+    Timestamps with and without fractional seconds both parse. The old
+    inferred format turned the latter into NaT (fecha NULL, hora 0), which
+    also kept them out of the content dedup of _derive_messages: they now
+    collapse with the other copies of the same message in the same hour.
+    """
+    parsed = pd.to_datetime(raw.str.removesuffix(' UTC'), format='ISO8601', utc=True, errors='coerce')
+    retry = parsed.isna() & raw.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(raw[retry], format='mixed', utc=True, errors='coerce')
+    return parsed
 
-def _strip_greeting_prefix(text_lower: str) -> str:
-    """Remove a leading greeting from text to expose the real intent."""
-    for prefix in _GREETING_PREFIXES:
-        if text_lower.startswith(prefix):
-            remainder = text_lower[len(prefix):].lstrip(' ,.:;!?')
-            if remainder:  # only strip if there IS something after the greeting
-                return remainder
-    return text_lower
-
-
-def _categorize_text(text, categories):
-    """
-    Returns (categoria_yaml, macro_yaml, requires_review).
-    - categoria_yaml: subcategory name matched, or None
-    - macro_yaml: macro group of matched category, or None
-    - requires_review: 1 if no match found (needs HITL), 0 otherwise
-    """
-    if not text or not text.strip():
-        return None, None, 0
-
-    original_lower = text.lower().strip()
-
-    # Rule 0: Survey responses — [survey] tag means this is an automated survey vote,
-    # NOT a real user intent. Must be caught BEFORE keyword matching to prevent
-    # "[survey] No me fue útil la información" from matching "Evaluación General".
-    if '[survey]' in original_lower:
-        return "Encuesta", "Experiencia", 0
-
-    # Rule 1: Very short messages (noise/junk)
-    if len(original_lower) < 3 and not original_lower.isdigit():
-        return "Sin Sentido", "Sin Clasificar", 0
-
-    # Rule 2: Explicit Noise Keywords (Greetings/Acknowledgements)
-    # MUST be exact match to avoid catching "Hola quiero mi saldo" as Saludos
-    for cat_name, keywords in NOISE_KEYWORDS.items():
-        if original_lower in keywords:
-            if cat_name == 'saludos':
-                return "Saludos", "Sin Clasificar", 0
-            return "Evaluación General", "Experiencia", 0
-
-    # Rule 2b: Short affirmative/negative replies → Retroalimentación
-    if original_lower in _SHORT_REPLY_KEYWORDS:
-        return "Retroalimentación", "Sin Clasificar", 0
-
-    # Rule 2c: Strip greeting prefix to expose real intent.
-    # "hola buenas quiero transferir" → try matching on "quiero transferir"
-    stripped = _strip_greeting_prefix(original_lower)
-
-    # Build cleaned versions for NLP matching
-    clean = _clean_for_nlp(stripped)
-    clean_original = _clean_for_nlp(original_lower)
-
-    # Rule 3: General Keyword Matching
-    # Try matching on stripped text first, then original if different
-    texts_to_try = [stripped, original_lower] if stripped != original_lower else [original_lower]
-    for try_text in texts_to_try:
-        try_clean = _clean_for_nlp(try_text)
-        for cat in categories:
-            nombre = cat.get('nombre', '')
-            macro = cat.get('macro', nombre)
-            if nombre in ["Saludos", "Sin Sentido", "Encuesta"]:
-                continue
-            min_len = cat.get('min_len', 1)
-            if len(try_text.strip()) < min_len:
-                continue
-            for kw in cat.get('palabras_clave', []):
-                if not kw:
-                    continue
-                kw_str = str(kw)
-                if kw_str.startswith('^') or kw_str.endswith('$'):
-                    try:
-                        if re.search(kw_str, try_text):
-                            return nombre, macro, 0
-                    except re.error:
-                        pass
-                else:
-                    kw_clean = _clean_for_nlp(kw_str)
-                    if kw_clean and kw_clean in try_clean:
-                        return nombre, macro, 0
-
-    # No match → needs human review
-    return None, None, 1
-
-def ingest_data():
-    if not os.path.exists(DATA_PATH):
-        raise FileNotFoundError(f"Data file not found at {DATA_PATH}")
 
-    print("Loading data from CSV...")
-    df = pd.read_csv(DATA_PATH, engine='python', on_bad_lines='skip')
+def _clean_chunk(df):
+    """Row-wise cleaning applied to each parsed chunk before it is kept in memory."""
+    df = df[[c for c in INGEST_COLUMNS if c in df.columns]]
 
-    print("Cleaning data...")
     # Fix encoding in text columns
-    text_columns = ['text', 'intencion', 'product_type', 'product_detail', 'segment']
-    for col in text_columns:
+    for col in ['text', 'intencion', 'product_type', 'product_detail', 'segment']:
         if col in df.columns:
-            def clean_text(x):
-                if pd.isna(x): return ""
-                s = str(x).strip()
-                if s.lower() == 'nan': return ""
-                return s
-
-            df[col] = df[col].apply(clean_text)
+            s = df[col].fillna('').astype(str).str.strip()
+            df[col] = s.mask(s.str.lower() == 'nan', '')
 
     # Normalize sentiment values (keep NaN for now — fillna happens after propagation below)
     if 'sentiment' in df.columns:
@@ -266,45 +242,219 @@ def ingest_data():
 
     # Parse dates - crucial for SQLite storage
     if 'fecha' in df.columns:
-        # Parse flexibly — CSV may have full timestamps like "2026-02-01 21:00:46.674505 UTC"
-        df['fecha'] = pd.to_datetime(df['fecha'], utc=True, errors='coerce')
         # Convert UTC → Colombia (UTC-5) for all date/time fields
-        df['fecha'] = df['fecha'].dt.tz_convert('America/Bogota')
-        # Preserve full timestamp as ISO string for precise ordering (local time)
-        df['timestamp'] = df['fecha'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        fecha = _parse_fecha(df['fecha']).dt.tz_convert('America/Bogota')
+        # Preserve full timestamp as ISO string for precise ordering (local time).
+        # numpy formats in C; Series.dt.strftime is a per-element Python loop.
+        local = fecha.dt.tz_localize(None).to_numpy(dtype='datetime64[s]')
+        valid = fecha.notna()
+        timestamp = pd.Series(np.datetime_as_string(local, unit='s'), index=df.index)
+        df['timestamp'] = timestamp.str.replace('T', ' ', regex=False).where(valid)
         # Extract hour in local time
-        df['hora'] = df['fecha'].dt.hour
+        df['hora'] = fecha.dt.hour
         # Store date as string YYYY-MM-DD (local date) for consistency in SQLite
-        df['fecha'] = df['fecha'].dt.strftime('%Y-%m-%d')
+        df['fecha'] = timestamp.str.slice(0, 10).where(valid)
 
     # Ensure numeric columns
-    numeric_cols = ['hora', 'input_tokens', 'output_tokens']
-    for col in numeric_cols:
+    for col in ['hora', 'input_tokens', 'output_tokens']:
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(int)
 
     # Ensure thread_id is string
     if 'thread_id' in df.columns:
         df['thread_id'] = df['thread_id'].astype(str)
+    return df
+
+
+def _read_csv_chunked(path, chunk_size=CHUNK_SIZE):
+    """
+    Reads the export in bounded chunks with pandas' C parser and returns
+    (cleaned DataFrame, number of quarantined records). Only the parsing is
+    bounded by chunk_size: the cleaned chunks are all kept and concatenated.
+
+    Each block is parsed on its own with a blank sentinel row in front: the C
+    parser does not validate the field count of the first data row of a read,
+    so the sentinel guarantees every real record is checked. Records with too
+    many fields are written verbatim to QUARANTINE_PATH.
+    """
+    if os.path.exists(QUARANTINE_PATH):
+        os.remove(QUARANTINE_PATH)
+
+    chunks, quarantined, total = [], 0, 0
+    quarantine = None
+    for header, records in _iter_csv_blocks(path, chunk_size):
+        n_fields = len(next(csv.reader([header.decode('utf-8', errors='replace')])))
+        sentinel = b',' * (n_fields - 1) + b'\n'
+        buf = io.BytesIO(header + sentinel + b''.join(records))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', pd.errors.ParserWarning)
+            chunk = pd.read_csv(buf, engine='c', dtype=str, index_col=False,
+                                on_bad_lines='warn', encoding_errors='replace')
+        chunk = chunk.iloc[1:]
+
+        # "Skipping line N" counts the header as line 1 and the sentinel as line 2
+        bad = [int(m) - 3 for w in caught
+               for m in re.findall(r'Skipping line (\d+)', str(w.message))]
+        if bad:
+            if quarantine is None:
+                quarantine = open(QUARANTINE_PATH, 'wb')
+                quarantine.write(header)
+            for i in bad:
+                quarantine.write(records[i] if records[i].endswith(b'\n') else records[i] + b'\n')
+            quarantined += len(bad)
+
+        total += len(records)
+        chunks.append(_clean_chunk(chunk))
+        print(f"  Parsed {total} records ({quarantined} quarantined)...")
+
+    if quarantine is not None:
+        quarantine.close()
+        print(f"  Quarantined {quarantined} malformed records → {QUARANTINE_PATH}")
+    if not chunks:
+        return pd.DataFrame(columns=INGEST_COLUMNS), 0
+    return pd.concat(chunks, ignore_index=True), quarantined
+
+
+def _classify_parallel(section, path, texts, workers):
+    """
+    classify_batch() of the `section` matcher over texts, sharded across a
+    process pool. Each distinct text is classified once; shards are contiguous
+    slices and pool.map keeps their order, so the result is identical to a
+    serial run. Falls back to in-process classification for small inputs,
+    workers <= 1, or if the pool cannot be used.
+    """
+    texts = list(texts)
+    unique = list(dict.fromkeys(texts))
+    results = None
+    if workers > 1 and len(unique) >= PARALLEL_MIN_TEXTS:
+        n_shards = min(len(unique), workers * 4)
+        bounds = np.linspace(0, len(unique), n_shards + 1).astype(int)
+        shards = [unique[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        try:
+            # spawn: the ETL may run in a background thread of the API server, where fork is unsafe
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+            ) as pool:
+                shard_results = pool.map(partial(classify_texts, section, path), shards)
+                results = [r for shard in shard_results for r in shard]
+            print(f"  Classified {len(unique)} distinct texts in {len(shards)} shards on {workers} processes.")
+        except Exception as e:
+            print(f"  Parallel classification unavailable ({e}). Classifying serially...")
+            results = None
+    if results is None:
+        results = classify_texts(section, path, unique)
+    lookup = dict(zip(unique, results))
+    return [lookup[t] for t in texts]
+
+
+def _rules_hash():
+    """Identifies the classification rules: both YAML contents plus MEMO_VERSION."""
+    key = MEMO_VERSION + file_hash(YAML_PATH) + file_hash(PRODUCTOS_YAML_PATH)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _classify_human_texts(texts, workers, conn):
+    """
+    Category and product keyword classification of human texts, memoized in
+    MEMO_TABLE of `conn`. Both matchers only look at the lowercased, stripped
+    text, so its sha1 is the memo key; rows of any other rules version are
+    dropped on entry, which invalidates the memo whenever a YAML changes.
+    Only texts not seen before under the current rules are classified.
+
+    Returns a frame with MEMO_COLUMNS, indexed like `texts`.
+    """
+    keys = texts.fillna('').astype(str).str.lower().str.strip()
+    first = ~keys.duplicated()
+    unique = pd.DataFrame({
+        'text': texts[first].values,
+        'text_hash': [hashlib.sha1(k.encode('utf-8')).hexdigest() for k in keys[first]],
+    })
+    rules = _rules_hash()
+
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MEMO_TABLE} (
+            text_hash TEXT NOT NULL,
+            rules_hash TEXT NOT NULL,
+            categoria_yaml TEXT,
+            macro_yaml TEXT,
+            requires_review INTEGER,
+            product_yaml TEXT,
+            product_macro_yaml TEXT,
+            PRIMARY KEY (text_hash, rules_hash)
+        )
+    """)
+    conn.execute(f"DELETE FROM {MEMO_TABLE} WHERE rules_hash != ?", (rules,))
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS memo_keys (text_hash TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.memo_keys")
+    conn.executemany("INSERT INTO temp.memo_keys VALUES (?)", ((h,) for h in unique['text_hash']))
+    cached = pd.read_sql(
+        f"SELECT m.text_hash, {', '.join('m.' + c for c in MEMO_COLUMNS)} FROM {MEMO_TABLE} m "
+        "JOIN temp.memo_keys k ON k.text_hash = m.text_hash WHERE m.rules_hash = ?",
+        conn, params=(rules,),
+    )
+
+    misses = unique[~unique['text_hash'].isin(cached['text_hash'])]
+    print(f"  Classification memo: {len(cached)} cached, {len(misses)} new distinct texts.")
+    if not misses.empty:
+        categories = _classify_parallel('categorias', YAML_PATH, misses['text'], workers)
+        products = _classify_parallel('productos', PRODUCTOS_YAML_PATH, misses['text'], workers)
+        fresh = pd.concat([
+            misses[['text_hash']].reset_index(drop=True),
+            pd.DataFrame(categories, columns=MEMO_COLUMNS[:3]),
+            pd.DataFrame(products, columns=MEMO_COLUMNS[3:]),
+        ], axis=1)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {MEMO_TABLE} (text_hash, rules_hash, {', '.join(MEMO_COLUMNS)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(MEMO_COLUMNS))})",
+            [(row[0], rules, *row[1:]) for row in
+             fresh[['text_hash'] + MEMO_COLUMNS].astype(object).itertuples(index=False, name=None)],
+        )
+        cached = pd.concat([cached, fresh], ignore_index=True)
+    conn.commit()
+
+    memo = cached.set_index('text_hash')[MEMO_COLUMNS].astype(object)
+    memo = memo.where(memo.notna(), None)
+    memo['requires_review'] = memo['requires_review'].fillna(0).astype(int)
+    row_hashes = keys.map(dict(zip(keys[first], unique['text_hash'])))
+    return memo.reindex(row_hashes.values).set_index(texts.index)
 
+
+def _derive_messages(df, conn, workers=CLASSIFY_WORKERS):
+    """
+    Runs every derivation step on a frame of raw (cleaned, id-deduplicated)
+    rows: content dedup, sentiment/product/category propagation, HITL
+    preservation, surveys and Servilínea.
+
+    Each step only combines rows of the same thread, so a thread's result does
+    not depend on which other threads are in the frame. The incremental ETL
+    relies on this to re-derive only the threads touched by new rows.
+
+    `conn` is the database being built (classification memo, HITL
+    corrections); `workers` is the process count for keyword classification
+    (1 = serial).
+    """
     # ---------------------------------------------------------
-    # DEDUPLICATION
+    # DEDUPLICATION (by content)
     # ---------------------------------------------------------
     initial_len = len(df)
-    
-    # 1. Deduplicate by ID if exists
-    if 'id' in df.columns:
-        print("Deduplicating by ID...")
-        df = df.drop_duplicates(subset=['id'], keep='first')
-        
-    # 2. Secondary Deduplication by Content (Thread + Text + Time)
+
+    # Secondary Deduplication by Content (Thread + Text + Time)
     # This handles cases where different IDs were generated for the same event
     print("Deduplicating by content (thread_id, text, type, fecha, hora)...")
     content_cols = [c for c in ['thread_id', 'text', 'type', 'fecha', 'hora'] if c in df.columns]
     if content_cols:
          df = df.drop_duplicates(subset=content_cols, keep='first')
-    
-    print(f"Removed {initial_len - len(df)} duplicate records total.")
+
+    print(f"Removed {initial_len - len(df)} duplicate records by content.")
+    # ---------------------------------------------------------
+
+    # ---------------------------------------------------------
+    # SURVEY STATUS: the one pass over the texts for the [survey] tag.
+    # Sentiment, survey tagging, the thread facts and every survey report
+    # read this column instead of matching the text again.
+    # ---------------------------------------------------------
+    if 'text' in df.columns:
+        df['survey_status'] = survey_status(df['text'])
     # ---------------------------------------------------------
 
     # ---------------------------------------------------------
@@ -314,17 +464,20 @@ def ingest_data():
     print("Propagating sentiment from AI messages to human messages via thread_id...")
     if 'sentiment' in df.columns and 'thread_id' in df.columns:
         ai_sent_rows = df[(df['type'] == 'ai') & df['sentiment'].notna()]
-        thread_sentiment = ai_sent_rows.groupby('thread_id')['sentiment'].agg(lambda x: x.mode()[0])
+        thread_sentiment = dominant_values(ai_sent_rows, 'sentiment')['value']
         human_mask_sent = df['type'] == 'human'
         # Human rows have no sentiment from CSV — propagate from AI of same thread
         # But exclude survey responses — their sentiment comes from content, not thread mood
-        is_survey = df['text'].str.contains(r'^\[survey\]', case=False, na=False)
+        is_survey = df['survey_status'] != NO_SURVEY
         non_survey_human = human_mask_sent & ~is_survey
         df.loc[non_survey_human, 'sentiment'] = df.loc[non_survey_human, 'thread_id'].map(thread_sentiment)
-        # For survey messages, assign sentiment based on survey content
+        # For survey messages, assign sentiment based on survey content (only their texts are scanned)
         survey_mask = human_mask_sent & is_survey
-        positive_survey = survey_mask & df['text'].str.contains(r'útil|util|positiv|bien|excelente|bueno|buena|gracias|satisf', case=False, na=False)
-        negative_survey = survey_mask & df['text'].str.contains(r'no me|no fue|negativ|mal|insatisf|pésim|pesim|inútil|inutil', case=False, na=False)
+        survey_text = df.loc[survey_mask, 'text']
+        positive_survey = survey_mask.copy()
+        positive_survey[survey_mask] = survey_text.str.contains(r'útil|util|positiv|bien|excelente|bueno|buena|gracias|satisf', case=False, na=False).to_numpy()
+        negative_survey = survey_mask.copy()
+        negative_survey[survey_mask] = survey_text.str.contains(r'no me|no fue|negativ|mal|insatisf|pésim|pesim|inútil|inutil', case=False, na=False).to_numpy()
         df.loc[positive_survey, 'sentiment'] = 'positivo'
         df.loc[negative_survey, 'sentiment'] = 'negativo'
         df.loc[survey_mask & ~positive_survey & ~negative_survey, 'sentiment'] = 'neutral'
@@ -363,6 +516,15 @@ def ingest_data():
                 
         df['sentiment'] = df['sentiment'].fillna('neutral')
 
+    # ---------------------------------------------------------
+    # KEYWORD CLASSIFICATION of human texts (products + categories), used by
+    # steps 1b and 3.1. Memoized across runs; only unseen texts are matched.
+    # ---------------------------------------------------------
+    keyword_results = None
+    if 'text' in df.columns:
+        print("Classifying human messages by keywords...")
+        keyword_results = _classify_human_texts(df.loc[df['type'] == 'human', 'text'], workers, conn)
+
     # ---------------------------------------------------------
     # STEP 1b: PROPAGATE product_type / product_detail from AI rows to human rows
     # Products are set on AI rows in CSV; human rows have empty values.
@@ -373,7 +535,7 @@ def ingest_data():
     # ---------------------------------------------------------
     print("Propagating and homologating products via thread_id...")
     product_homolog = _build_product_homologation()
-    products_list   = _load_products()
+    product_matcher = get_product_matcher(PRODUCTOS_YAML_PATH)
 
     df['product_yaml']       = None
     df['product_macro_yaml'] = None
@@ -386,14 +548,10 @@ def ingest_data():
         # from overriding what the human actually said (e.g. "mi crédito" → Crédito General).
 
         # 1. NLP FIRST: scan human text for product keywords
-        if products_list and 'text' in df.columns:
+        if len(product_matcher) and 'text' in df.columns:
             print("  Running product NLP on human messages (priority)...")
-            nlp_results = df.loc[human_mask_prod, 'text'].apply(
-                lambda t: pd.Series(_match_product_nlp(t, products_list),
-                                    index=['product_yaml', 'product_macro_yaml'])
-            )
-            df.loc[human_mask_prod, 'product_yaml']       = nlp_results['product_yaml']
-            df.loc[human_mask_prod, 'product_macro_yaml'] = nlp_results['product_macro_yaml']
+            df.loc[human_mask_prod, 'product_yaml']       = keyword_results['product_yaml']
+            df.loc[human_mask_prod, 'product_macro_yaml'] = keyword_results['product_macro_yaml']
             nlp_matched = int(df.loc[human_mask_prod, 'product_yaml'].notna().sum())
             print(f"  Product NLP matched: {nlp_matched} human messages")
 
@@ -404,10 +562,7 @@ def ingest_data():
             (df['product_type'] != '') &
             (df['product_type'].str.lower() != 'ninguno')
         ]
-        thread_product = (
-            ai_prod_rows.groupby('thread_id')['product_type']
-            .agg(lambda x: x.mode()[0])
-        )
+        thread_product = dominant_values(ai_prod_rows, 'product_type')['value']
 
         needs_prod_mask = human_mask_prod & df['product_yaml'].isna()
         raw_products = df.loc[needs_prod_mask, 'thread_id'].map(thread_product).str.strip().str.lower()
@@ -426,14 +581,8 @@ def ingest_data():
         #    where "un asesor" should inherit CDT from the same thread's human messages.
         human_with_prod = df[human_mask_prod & df['product_yaml'].notna()]
         if not human_with_prod.empty:
-            thread_human_product = (
-                human_with_prod.groupby('thread_id')['product_yaml']
-                .agg(lambda x: x.mode()[0])
-            )
-            thread_human_macro = (
-                human_with_prod.groupby('thread_id')['product_macro_yaml']
-                .agg(lambda x: x.mode()[0])
-            )
+            thread_human_product = dominant_values(human_with_prod, 'product_yaml')['value']
+            thread_human_macro = dominant_values(human_with_prod, 'product_macro_yaml')['value']
             still_needs = human_mask_prod & df['product_yaml'].isna()
             mapped_prod = df.loc[still_needs, 'thread_id'].map(thread_human_product)
             mapped_macro = df.loc[still_needs, 'thread_id'].map(thread_human_macro)
@@ -457,33 +606,16 @@ def ingest_data():
     df['categoria_yaml'] = None
     df['macro_yaml'] = None
     df['requires_review'] = 0
-    categories = _load_categories()
-
-    # Load ONLY truly manual HITL corrections (reviewed via the feedback panel)
-    manual_corrections = {}
-    if os.path.exists(DB_PATH) and 'id' in df.columns:
-        try:
-            conn_prev = sqlite3.connect(DB_PATH)
-            # Check if hitl_reviewed column exists
-            cols = [r[1] for r in conn_prev.execute("PRAGMA table_info(messages)").fetchall()]
-            if 'hitl_reviewed' in cols:
-                prev = pd.read_sql("SELECT id, categoria_yaml, macro_yaml FROM messages WHERE hitl_reviewed = 1 AND categoria_yaml IS NOT NULL", conn_prev)
-                for _, row in prev.iterrows():
-                    manual_corrections[str(row['id'])] = (row['categoria_yaml'], row.get('macro_yaml'))
-            conn_prev.close()
-        except Exception: pass
+    category_matcher = get_category_matcher(YAML_PATH)
 
     human_mask = df['type'] == 'human'
     
     # 3.1. KEYWORD NLP on human messages (PRIORITY)
-    if categories and 'text' in df.columns:
+    if len(category_matcher) and 'text' in df.columns:
         print("  Running primary keyword NLP on human messages...")
-        results = df.loc[human_mask, 'text'].apply(
-            lambda t: pd.Series(_categorize_text(t, categories), index=['categoria_yaml', 'macro_yaml', 'requires_review'])
-        )
-        df.loc[human_mask, 'categoria_yaml'] = results['categoria_yaml']
-        df.loc[human_mask, 'macro_yaml'] = results['macro_yaml']
-        df.loc[human_mask, 'requires_review'] = results['requires_review'].astype(int)
+        df.loc[human_mask, 'categoria_yaml'] = keyword_results['categoria_yaml']
+        df.loc[human_mask, 'macro_yaml'] = keyword_results['macro_yaml']
+        df.loc[human_mask, 'requires_review'] = keyword_results['requires_review']
 
     # 3.2. AI PROPAGATION FALLBACK (only if NLP failed)
     #   IMPROVEMENT: Only propagate AI intent to messages that have enough
@@ -493,7 +625,7 @@ def ingest_data():
     if 'intencion' in df.columns and 'thread_id' in df.columns:
         print("  Filling gaps via AI intent propagation...")
         ai_rows = df[(df['type'] == 'ai') & df['intencion'].notna() & (df['intencion'] != '')]
-        thread_intencion = ai_rows.groupby('thread_id')['intencion'].agg(lambda x: x.mode()[0])
+        thread_intencion = dominant_values(ai_rows, 'intencion')['value']
 
         needs_fallback_mask = human_mask & (df['categoria_yaml'].isna() | (df['requires_review'] == 1))
 
@@ -547,44 +679,40 @@ def ingest_data():
         categorized_humans = df[human_mask & (df['requires_review'] == 0) & df['categoria_yaml'].notna()]
         if not categorized_humans.empty:
             # Find dominant category per thread (mode)
-            thread_cat_mode = categorized_humans.groupby('thread_id').agg(
-                cat_mode=('categoria_yaml', lambda x: x.mode().iloc[0] if len(x.mode()) > 0 else None),
-                macro_mode=('macro_yaml', lambda x: x.mode().iloc[0] if len(x.mode()) > 0 else None),
-                cat_count=('categoria_yaml', 'size'),
-                cat_agree=('categoria_yaml', lambda x: (x == x.mode().iloc[0]).sum() if len(x.mode()) > 0 else 0),
-            )
+            cat_dominant = dominant_values(categorized_humans, 'categoria_yaml')
+            thread_cat_mode = pd.DataFrame({
+                'cat_mode': cat_dominant['value'],
+                'macro_mode': dominant_values(categorized_humans, 'macro_yaml')['value'],
+                'pct_agree': cat_dominant['share'],
+            })
             # Only propagate if >= 50% of categorized msgs agree on the dominant category
-            thread_cat_mode['pct_agree'] = thread_cat_mode['cat_agree'] / thread_cat_mode['cat_count']
             confident = thread_cat_mode[thread_cat_mode['pct_agree'] >= 0.5]
 
-            propagated = 0
-            for idx in df[still_needs_review].index:
-                tid = df.at[idx, 'thread_id']
-                if tid in confident.index:
-                    row = confident.loc[tid]
-                    cat = row['cat_mode']
-                    macro = row['macro_mode']
-                    if cat and cat not in ('Saludos', 'Sin Sentido', 'Retroalimentación'):
-                        df.at[idx, 'categoria_yaml'] = cat
-                        df.at[idx, 'macro_yaml'] = macro
-                        df.at[idx, 'requires_review'] = 0
-                        propagated += 1
-            print(f"  Intra-thread propagation: rescued {propagated} messages.")
-
-    # 3.3. Preserve ONLY truly manual HITL corrections (from feedback panel)
+            # Rescue = still-unreviewed rows merged with their thread's confident category
+            rescue = df.loc[still_needs_review, ['thread_id']].join(confident, on='thread_id', how='inner')
+            rescue = rescue[
+                rescue['cat_mode'].fillna('').astype(bool)
+                & ~rescue['cat_mode'].isin(['Saludos', 'Sin Sentido', 'Retroalimentación'])
+            ]
+            df.loc[rescue.index, 'categoria_yaml'] = rescue['cat_mode']
+            df.loc[rescue.index, 'macro_yaml'] = rescue['macro_mode']
+            df.loc[rescue.index, 'requires_review'] = 0
+            print(f"  Intra-thread propagation: rescued {len(rescue)} messages.")
+
+    # 3.3. Re-apply manual HITL corrections (feedback panel) from hitl_corrections
     df['hitl_reviewed'] = 0
-    if manual_corrections and 'id' in df.columns:
-        preserved = 0
-        for idx, row in df.iterrows():
-            msg_id = str(row.get('id', ''))
-            if msg_id in manual_corrections:
-                cat, macro = manual_corrections[msg_id]
-                df.at[idx, 'categoria_yaml'] = cat
-                df.at[idx, 'macro_yaml'] = macro
-                df.at[idx, 'requires_review'] = 0
-                df.at[idx, 'hitl_reviewed'] = 1
-                preserved += 1
-        print(f"  Preserved {preserved} true HITL corrections (feedback panel only).")
+    if 'id' in df.columns:
+        corrections = load_hitl_corrections(conn)
+        applied = df[['id']].join(corrections, on='id', how='inner')
+        if not applied.empty:
+            df.loc[applied.index, 'categoria_yaml'] = applied['categoria_yaml']
+            df.loc[applied.index, 'macro_yaml'] = applied['macro_yaml']
+            df.loc[applied.index, 'requires_review'] = 0
+            df.loc[applied.index, 'hitl_reviewed'] = 1
+            for col in ['sentiment', 'product_yaml', 'product_macro_yaml']:
+                corrected = applied[col].notna()
+                df.loc[applied.index[corrected], col] = applied.loc[corrected, col]
+        print(f"  Preserved {len(applied)} true HITL corrections (feedback panel only).")
     
     # Non-human messages: no review needed
     df['requires_review'] = df['requires_review'].fillna(0).astype(int)
@@ -597,8 +725,8 @@ def ingest_data():
     # ---------------------------------------------------------
     print("Detecting survey messages...")
     if 'text' in df.columns:
-        # Check for [survey] tag
-        survey_mask = df['text'].str.contains(r'\[survey\]', case=False, na=False, regex=True)
+        # [survey] tag (survey_status, computed above)
+        survey_mask = df['survey_status'] != NO_SURVEY
         
         # Only apply to messages WITHOUT a valid category yet
         needs_survey_cat = survey_mask & (df['categoria_yaml'].isna() | (df['categoria_yaml'] == 'Sin Sentido'))
@@ -645,35 +773,565 @@ def ingest_data():
         print(f"  Total messages flagged: {int(df['is_servilinea'].sum())}")
     # ---------------------------------------------------------
 
-    print(f"Persisting {len(df)} records to SQLite at {DB_PATH}...")
-
-    conn = sqlite3.connect(DB_PATH)
-    # Use replace to overwrite existing data for now
-    df.to_sql('messages', conn, if_exists='replace', index=False)
-
-    # Create indexes for performance
-    cursor = conn.cursor()
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_thread_id ON messages (thread_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fecha ON messages (fecha)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_type ON messages (type)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_requires_review ON messages (requires_review)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_is_servilinea ON messages (is_servilinea)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_yaml ON messages (product_yaml)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON messages (timestamp)")
-    conn.commit()
-    conn.close()
+    # ---------------------------------------------------------
+    # STEP 5: TEXT FEATURES (text_norm + noise/system/greeting flags)
+    # Computed once here so FAQs, reports and discovery filter on columns
+    # instead of re-normalizing every message per request.
+    # ---------------------------------------------------------
+    print("Computing normalized text and noise flags...")
+    add_text_features(df)
+    # ---------------------------------------------------------
+
+    return df
+
+
+def _fingerprint(df):
+    """64-bit content hash of each cleaned CSV row, stored as a signed SQLite INTEGER."""
+    cols = [c for c in df.columns if c != 'fingerprint']
+    return pd.util.hash_pandas_object(df[cols], index=False).to_numpy().view('int64')
+
+
+def _read_etl_metadata(conn):
+    """Returns the key/value state left by the previous ETL run ({} if none)."""
+    try:
+        return dict(conn.execute("SELECT key, value FROM etl_metadata").fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+
+def _write_etl_metadata(conn, values):
+    conn.execute("CREATE TABLE IF NOT EXISTS etl_metadata (key TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany(
+        "INSERT INTO etl_metadata (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        [(k, None if v is None else str(v)) for k, v in values.items()],
+    )
+
+
+def _table_columns(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _sql_values(s):
+    """Column as a list of plain Python values (NaN → NULL) accepted by sqlite3."""
+    if pd.api.types.is_bool_dtype(s) or pd.api.types.is_integer_dtype(s):
+        return s.tolist()
+    return s.astype(object).where(s.notna(), None).tolist()
+
+
+def _sql_rows(df, columns=None, with_rowid=False):
+    """
+    DataFrame rows as tuples of plain Python values for executemany, built
+    column by column. Columns listed but absent from df are inserted as NULL.
+    with_rowid puts df's index first: the rowid each row is stored under.
+    """
+    columns = list(df.columns) if columns is None else columns
+    values = [_sql_values(df[c]) if c in df.columns else [None] * len(df) for c in columns]
+    if with_rowid:
+        values.insert(0, df.index.tolist())
+    return zip(*values)
+
+
+def _insert_with_rowids(conn, table, frame, rowids, create=False):
+    """
+    Inserts frame into table under the given rowids. Values go through to_sql
+    (a staging table), so they are stored exactly as to_sql stores them;
+    create=True first creates table with the schema to_sql would give it.
+    """
+    if create:
+        conn.execute(pd.io.sql.get_schema(frame, table, con=conn))
+    frame.assign(_rowid=rowids).to_sql('etl_staging', conn, if_exists='replace', index=False)
+    cols = ', '.join(f'"{c}"' for c in frame.columns)
+    conn.execute(f'INSERT INTO "{table}" (rowid, {cols}) SELECT _rowid, {cols} FROM etl_staging')
+    conn.execute("DROP TABLE etl_staging")
+
+
+def _messages_ddl():
+    cols = ",\n    ".join(f"{name} {decl}" for name, decl in MESSAGES_SCHEMA)
+    return f"CREATE TABLE messages (\n    {cols}\n)"
+
+
+def _conform_enums(df):
+    """
+    Keeps `type` and `sentiment` inside the CHECKed enums so one odd CSV value
+    cannot abort the bulk insert: unknown types become NULL, unknown
+    sentiments fall back to 'neutral' (the ETL default). Both are reported.
+    """
+    for col, allowed, fallback in (('type', MESSAGE_TYPES, None), ('sentiment', SENTIMENTS, 'neutral')):
+        if col not in df.columns:
+            continue
+        bad = df[col].notna() & ~df[col].isin(allowed)
+        if bad.any():
+            print(f"  {int(bad.sum())} messages with unexpected {col} "
+                  f"{sorted(df.loc[bad, col].astype(str).unique())[:5]} stored as {fallback!r}.")
+            df.loc[bad, col] = fallback
+    return df
+
+
+def _persist_messages(conn, df, incremental):
+    """
+    Writes derived messages with the explicit MESSAGES_SCHEMA, each under the
+    rowid in df's index: one executemany in a single transaction, indexes
+    built once the rows are in. Incremental runs replace the rows of
+    temp.touched_threads, in the table and in messages_fts, and keep the
+    existing indexes.
+    """
+    _conform_enums(df)
+    columns = [name for name, _ in MESSAGES_SCHEMA]
+    with conn:
+        indexed = False
+        if incremental:
+            indexed = remove_from_search_index(conn, TOUCHED)
+            conn.execute(f"DELETE FROM messages WHERE {TOUCHED}")
+        else:
+            conn.execute("DROP TABLE IF EXISTS messages")
+            conn.execute(_messages_ddl())
+        conn.executemany(
+            f"INSERT INTO messages (rowid, {', '.join(columns)}) VALUES (?, {', '.join('?' * len(columns))})",
+            _sql_rows(df, columns, with_rowid=True),
+        )
+        if indexed:
+            add_to_search_index(conn, TOUCHED)
+        for name, target in MESSAGES_INDEXES.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+
+def _select_changed_rows(conn, raw, metadata):
+    """
+    Returns the rows of `raw` that are new or whose content changed since the
+    last run. Rows newer than the watermark are new by definition; only rows at
+    or before it (late arrivals, re-exported edits) are looked up against the
+    stored fingerprints.
+    """
+    watermark = metadata.get('watermark_timestamp')
+    if watermark:
+        newer = (raw['timestamp'] > watermark).fillna(False).astype(bool)
+    else:
+        newer = pd.Series(True, index=raw.index)
+    older = raw[~newer]
+    if older.empty:
+        return raw[newer]
+
+    conn.execute("DROP TABLE IF EXISTS temp.incoming")
+    conn.execute("CREATE TEMP TABLE incoming (pos INTEGER, id TEXT, fingerprint INTEGER)")
+    conn.executemany(
+        "INSERT INTO incoming VALUES (?, ?, ?)",
+        zip(range(len(older)), older['id'].tolist(), older['fingerprint'].tolist()),
+    )
+    changed_pos = [r[0] for r in conn.execute(
+        "SELECT i.pos FROM incoming i "
+        "LEFT JOIN raw_messages r ON r.id = i.id AND r.fingerprint = i.fingerprint "
+        "WHERE r.id IS NULL"
+    ).fetchall()]
+    conn.execute("DROP TABLE temp.incoming")
+    return pd.concat([older.iloc[changed_pos], raw[newer]])
+
+
+def _stored_rowids(conn, ids):
+    """{id: rowid} of the given ids that raw_messages already holds."""
+    conn.execute("DROP TABLE IF EXISTS temp.lookup_ids")
+    conn.execute("CREATE TEMP TABLE lookup_ids (id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO lookup_ids VALUES (?)", [(i,) for i in ids])
+    found = dict(conn.execute(
+        "SELECT l.id, r.rowid FROM lookup_ids l JOIN raw_messages r ON r.id = l.id"
+    ).fetchall())
+    conn.execute("DROP TABLE temp.lookup_ids")
+    return found
+
+
+def _assign_rowids(conn, raw, changed):
+    """
+    Sets the index of `changed` to the rowids its rows are stored under. Rows
+    raw_messages already holds keep theirs. Each run of consecutive new rows
+    in the CSV is spread evenly between the rowids of the stored rows around
+    it (past the largest rowid at the end of the file), so rowid order stays
+    the CSV order of a full run without moving any stored row. Returns None
+    when a gap is too narrow for its run (a full run renumbers everything).
+    """
+    stored = _stored_rowids(conn, changed['id'])
+    ids = raw['id'].to_numpy()
+    is_new = raw['id'].isin(changed['id']).to_numpy() & ~raw['id'].isin(list(stored)).to_numpy()
+    new_pos = np.flatnonzero(is_new)
+    runs = np.split(new_pos, np.flatnonzero(np.diff(new_pos) != 1) + 1) if len(new_pos) else []
+    neighbors = _stored_rowids(conn, [ids[i] for run in runs for i in (run[0] - 1, run[-1] + 1) if 0 <= i < len(ids)])
+    last = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM raw_messages").fetchone()[0]
+
+    new_rowids = {}
+    for run in runs:
+        steps = np.arange(1, len(run) + 1, dtype=np.int64)
+        if run[-1] + 1 == len(ids):
+            rowids = last + ROWID_GAP * steps
+        else:
+            lo = neighbors[ids[run[0] - 1]] if run[0] > 0 else 0
+            hi = neighbors[ids[run[-1] + 1]]
+            if hi - lo <= len(run):
+                return None
+            rowids = lo + (hi - lo) * steps // (len(run) + 1)
+            # Rows no longer in the CSV keep their rowids: a new row must not land on one
+            taken = {r[0] for r in conn.execute("SELECT rowid FROM raw_messages WHERE rowid > ? AND rowid < ?", (lo, hi))}
+            if taken & set(rowids.tolist()):
+                return None
+        new_rowids.update(zip(ids[run], rowids.tolist()))
+    changed = changed.copy()
+    changed.index = [stored[i] if i in stored else new_rowids[i] for i in changed['id']]
+    return changed
+
+
+def _upsert_raw_rows(conn, rows):
+    """Stores new and changed raw rows under the rowids of their index (changed rows keep their own)."""
+    cols = list(rows.columns)
+    conn.executemany(
+        f"INSERT OR REPLACE INTO raw_messages (rowid, {', '.join(cols)}) VALUES (?, {', '.join('?' * len(cols))})",
+        _sql_rows(rows, with_rowid=True),
+    )
+
+
+def _set_touched_threads(conn, thread_ids):
+    """Loads the re-derived thread ids into temp.touched_threads for set-based SQL."""
+    conn.execute("DROP TABLE IF EXISTS temp.touched_threads")
+    conn.execute("CREATE TEMP TABLE touched_threads (thread_id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO touched_threads VALUES (?)", [(t,) for t in thread_ids])
+
+
+def _read_messages(conn, incremental):
+    """
+    The persisted messages as load_data returns them (all of them, or only
+    those of temp.touched_threads for an incremental run), in rowid order.
+    """
+    query = "SELECT *, rowid FROM messages"
+    if incremental:
+        query += f" WHERE {TOUCHED}"
+    return prepare_messages(pd.read_sql(query + " ORDER BY rowid", conn))
+
+
+def _referral_rowids(referrals, msgs):
+    """Rowid of each referral's first referral message: the order a full run writes them in."""
+    ai = msgs[msgs['type'] == 'ai']
+    first = ai.groupby(['thread_id', 'text'], observed=True, sort=False)['rowid'].min()
+    return first.reindex(pd.MultiIndex.from_arrays([referrals['thread_id'], referrals['referral_response']])).to_numpy()
+
+
+def _persist_derived_tables(conn, msgs, incremental):
+    """
+    Recomputes the referrals and failures tables from the persisted messages
+    msgs (_read_messages). Incremental runs only recompute (and replace) the
+    rows of touched threads.
+
+    Row order of a full run: referrals are stored under the rowid of their
+    first referral message, failures are read back by thread_id (their
+    detect_failures order), so neither table is rewritten to keep it.
+    """
+    for table, detect, rowids, index_sql in [
+        ('referrals', detect_referrals, _referral_rowids,
+         "CREATE INDEX IF NOT EXISTS idx_ref_thread_id ON referrals (thread_id)"),
+        ('failures', detect_failures, None,
+         "CREATE INDEX IF NOT EXISTS idx_fail_thread_id ON failures (thread_id)"),
+    ]:
+        result = detect(msgs) if not msgs.empty else pd.DataFrame()
+        update = incremental and bool(_table_columns(conn, table))
+        if update:
+            conn.execute(f"DELETE FROM {table} WHERE {TOUCHED}")
+        else:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        if not result.empty:
+            if rowids is not None:
+                _insert_with_rowids(conn, table, result, rowids(result, msgs), create=not update)
+            else:
+                result.to_sql(table, conn, if_exists='append', index=False)
+            conn.execute(index_sql)
+        conn.commit()
+        print(f"  {table}: {len(result)} threads {'updated' if incremental else 'computed'}")
+
+
+def _summarize(conn):
+    total, human, ai, categorized, review = conn.execute(
+        "SELECT COUNT(*), "
+        "COALESCE(SUM(type = 'human'), 0), COALESCE(SUM(type = 'ai'), 0), "
+        "COALESCE(SUM(type = 'human' AND requires_review = 0), 0), "
+        "COALESCE(SUM(type = 'human' AND requires_review = 1), 0) "
+        "FROM messages"
+    ).fetchone()
+    return {
+        "total_records": total,
+        "human_messages": human,
+        "ai_messages": ai,
+        "categorized_total": categorized,
+        "needs_review": review,
+    }
+
+
+def _open_shadow_db(incremental):
+    """
+    Creates SHADOW_DB_PATH, the database the ETL writes into. Incremental runs
+    start from a consistent copy of the live database (SQLite backup API); full
+    runs start empty and only carry over CARRY_OVER_TABLES.
+    """
+    for path in (SHADOW_DB_PATH, SHADOW_DB_PATH + '-journal', SHADOW_DB_PATH + '-wal', SHADOW_DB_PATH + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    shadow = sqlite3.connect(SHADOW_DB_PATH)
+    if os.path.exists(DB_PATH):
+        live = sqlite3.connect(DB_PATH)
+        try:
+            ensure_hitl_table(live)  # migrates corrections of pre-table databases
+            if incremental:
+                live.backup(shadow)
+            else:
+                _copy_tables(live, shadow, CARRY_OVER_TABLES)
+        finally:
+            live.close()
+    # Nobody reads the shadow while it is built: skip journaling, fsync once before the swap
+    shadow.execute("PRAGMA journal_mode = OFF")
+    shadow.execute("PRAGMA synchronous = OFF")
+    # Large page cache and in-memory temp b-trees for the bulk load and index builds
+    shadow.execute("PRAGMA cache_size = -262144")
+    shadow.execute("PRAGMA temp_store = MEMORY")
+    ensure_hitl_table(shadow)
+    return shadow
+
+
+def _copy_tables(src, dst, tables):
+    """Copies tables (schema, indexes and rows, rowids included) from src into dst."""
+    for table in tables:
+        ddl = src.execute(
+            "SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type = 'index'",
+            (table,),
+        ).fetchall()
+        if not ddl:
+            continue
+        for _, sql in ddl:
+            dst.execute(sql)
+        cols = ['rowid'] + _table_columns(src, table)
+        dst.executemany(
+            f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            src.execute(f"SELECT {', '.join(cols)} FROM {table}"),
+        )
+    dst.commit()
+
+
+def _sync_hitl_corrections(shadow, since_rowid):
+    """
+    Copies corrections saved in the live database while the shadow was being
+    built (rowid > since_rowid) and applies them to the shadow messages, the
+    same way feedback.process_categorization updated the live table.
+    """
+    if not os.path.exists(DB_PATH):
+        return
+    live = sqlite3.connect(DB_PATH)
+    try:
+        ensure_hitl_table(live)
+        late = live.execute(
+            f"SELECT message_id, {', '.join(HITL_FIELDS)}, corrected_at FROM {HITL_TABLE} "
+            "WHERE rowid > ? ORDER BY rowid", (since_rowid,),
+        ).fetchall()
+    finally:
+        live.close()
+    if not late:
+        return
+    shadow.executemany(
+        f"INSERT INTO {HITL_TABLE} (message_id, {', '.join(HITL_FIELDS)}, corrected_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        late,
+    )
+    shadow.executemany(
+        "UPDATE messages SET requires_review = 0, hitl_reviewed = 1, categoria_yaml = ?, macro_yaml = ?, "
+        "intencion = ?, sentiment = COALESCE(?, sentiment), product_yaml = COALESCE(?, product_yaml), "
+        "product_type = COALESCE(?, product_type), product_macro_yaml = COALESCE(?, product_macro_yaml) "
+        "WHERE id = ?",
+        [(cat, macro, cat, sent, prod, prod, prod_macro, msg_id)
+         for msg_id, cat, macro, sent, prod, prod_macro, _ in late],
+    )
+    shadow.commit()
+    print(f"  Applied {len(late)} HITL corrections saved during the ETL run.")
+
+
+def _swap_shadow_db(shadow, hitl_rowid):
+    """
+    Makes the shadow database the live one: late HITL corrections are merged,
+    WAL is enabled (readers never block on the writer), the file is flushed to
+    disk and renamed over DB_PATH in one atomic step. Connections opened before
+    the swap keep reading the previous file until they close.
+    """
+    with DB_SWAP_LOCK:
+        _sync_hitl_corrections(shadow, hitl_rowid)
+        shadow.execute("PRAGMA journal_mode = WAL")
+        shadow.close()
+        fd = os.open(SHADOW_DB_PATH, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if os.path.exists(DB_PATH):
+            # Leave no WAL content of the old file behind for the new one to pick up
+            live = sqlite3.connect(DB_PATH)
+            try:
+                live.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                live.close()
+        os.replace(SHADOW_DB_PATH, DB_PATH)
+
+
+def ingest_data(incremental=False, workers=None):
+    """
+    Runs the ETL from DATA_PATH into DB_PATH.
+
+    incremental=False rebuilds every table from the CSV. incremental=True
+    compares the CSV against the watermark and per-message fingerprints of the
+    previous run, re-derives only the threads touched by new or changed rows
+    and upserts them into messages, referrals and failures. It falls back to
+    a full run when there is no previous state to compare against.
+
+    Either way the result is built in SHADOW_DB_PATH and then renamed over
+    DB_PATH, so readers of the live database never see a partial ETL.
+
+    workers overrides CLASSIFY_WORKERS for the classification stage.
+    """
+    if not os.path.exists(DATA_PATH):
+        raise FileNotFoundError(f"Data file not found at {DATA_PATH}")
+
+    print(f"Loading and cleaning data from CSV in chunks of {CHUNK_SIZE}...")
+    raw, quarantined = _read_csv_chunked(DATA_PATH)
+
+    # Deduplicate by ID (first occurrence wins). Content dedup is per thread, in _derive_messages.
+    initial_len = len(raw)
+    if 'id' in raw.columns:
+        print("Deduplicating by ID...")
+        raw = raw.drop_duplicates(subset=['id'], keep='first')
+    print(f"Removed {initial_len - len(raw)} duplicate records by ID.")
+    raw['fingerprint'] = _fingerprint(raw)
+
+    metadata = {}
+    if os.path.exists(DB_PATH):
+        live = sqlite3.connect(DB_PATH)
+        try:
+            metadata = _read_etl_metadata(live)
+            if incremental:
+                if not metadata or 'messages' not in {r[0] for r in live.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}:
+                    print("No previous ETL state found. Running a full ingestion instead.")
+                    incremental = False
+                elif 'id' not in raw.columns or raw['id'].isna().any():
+                    print("CSV rows without id cannot be tracked incrementally. Running a full ingestion instead.")
+                    incremental = False
+                elif not set(raw.columns) <= set(_table_columns(live, 'raw_messages')):
+                    print("CSV columns changed since the last run. Running a full ingestion instead.")
+                    incremental = False
+                elif live.execute("SELECT sql FROM sqlite_master WHERE name = 'messages'").fetchone()[0] != _messages_ddl():
+                    print("messages schema changed since the last run. Running a full ingestion instead.")
+                    incremental = False
+                elif metadata.get('rowid_gap') != str(ROWID_GAP):
+                    print("Rows were stored without the current rowid gaps. Running a full ingestion instead.")
+                    incremental = False
+        finally:
+            live.close()
+    elif incremental:
+        print("No previous ETL state found. Running a full ingestion instead.")
+        incremental = False
+
+    print(f"Building the new database in {SHADOW_DB_PATH}...")
+    conn = _open_shadow_db(incremental)
+    try:
+        hitl_rowid = conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {HITL_TABLE}").fetchone()[0]
+        # The shadow starts as a copy of the live database: its snapshot is the one to patch
+        previous_key = snapshot_key(conn) if incremental else None
+
+        if incremental:
+            changed = _assign_rowids(conn, raw, _select_changed_rows(conn, raw, metadata))
+            if changed is None:
+                print("No rowid gap left for the new rows. Running a full ingestion instead.")
+                incremental = False
+        msgs = None
+        if incremental:
+            touched = changed['thread_id'].unique().tolist()
+            print(f"Incremental run: {len(changed)} new/changed rows across {len(touched)} threads "
+                  f"(watermark {metadata.get('watermark_timestamp')}).")
+            if touched:
+                _upsert_raw_rows(conn, changed)
+                _set_touched_threads(conn, touched)
+                # rowid order is CSV order, like the frame of a full run
+                df = pd.read_sql(
+                    f"SELECT rowid AS _rowid, * FROM raw_messages WHERE {TOUCHED} ORDER BY rowid", conn,
+                ).set_index('_rowid').rename_axis(None).drop(columns=['fingerprint'])
+        else:
+            touched = None
+            raw.index = ROWID_GAP * np.arange(1, len(raw) + 1, dtype=np.int64)
+            conn.execute("DROP TABLE IF EXISTS raw_messages")
+            conn.execute(pd.io.sql.get_schema(raw, 'raw_messages', con=conn))
+            conn.executemany(
+                f"INSERT INTO raw_messages (rowid, {', '.join(raw.columns)}) "
+                f"VALUES (?, {', '.join('?' * len(raw.columns))})",
+                _sql_rows(raw, with_rowid=True),
+            )
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_raw_id ON raw_messages (id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_raw_thread_id ON raw_messages (thread_id)")
+            df = raw.drop(columns=['fingerprint'])
+        conn.commit()
+
+        if touched is None or touched:
+            df = _derive_messages(df, conn, workers or CLASSIFY_WORKERS)
+
+            print(f"Persisting {len(df)} records to SQLite at {SHADOW_DB_PATH}...")
+            _persist_messages(conn, df, incremental)
+
+            # Incremental runs updated the rows of the touched threads in place
+            if not (incremental and search_index_exists(conn)):
+                print("Rebuilding the full-text search index...")
+                build_search_index(conn)
+
+            print("Updating referrals and failures...")
+            msgs = _read_messages(conn, incremental)
+            _persist_derived_tables(conn, msgs, incremental)
+
+        # Watermark: newest timestamp seen so far (and the id carrying it)
+        newest = raw.loc[raw['timestamp'].notna()].sort_values(['timestamp', 'id']).tail(1)
+        if not newest.empty and str(newest['timestamp'].iloc[0]) > (metadata.get('watermark_timestamp') or ''):
+            metadata['watermark_timestamp'] = newest['timestamp'].iloc[0]
+            metadata['watermark_id'] = newest['id'].iloc[0]
+        build_id = uuid.uuid4().hex
+        # failures was computed from the messages with corrections up to hitl_rowid;
+        # an incremental run kept the other threads' rows, valid as of the previous stamp
+        stamp = carry_failures_stamp(metadata, build_id) if incremental else failures_stamp(build_id, hitl_rowid)
+        _write_etl_metadata(conn, {
+            'watermark_timestamp': metadata.get('watermark_timestamp'),
+            'watermark_id': metadata.get('watermark_id'),
+            'last_run_mode': 'incremental' if incremental else 'full',
+            'last_run_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'build_id': build_id,
+            'rowid_gap': ROWID_GAP,
+            FAILURES_STAMP_KEY: json.dumps(stamp) if stamp else None,
+        })
+        conn.commit()
+        if not incremental:
+            # Planner statistics for the fresh tables and indexes (an incremental
+            # run changes a few threads and keeps the previous ones)
+            conn.execute("ANALYZE")
+
+        summary_report = _summarize(conn)
+
+        if HAS_PYARROW:
+            print("Writing columnar snapshot of the new database...")
+            key = snapshot_key(conn)
+            if not incremental:
+                write_snapshot(msgs, key)
+            elif not patch_snapshot(previous_key, key, touched, msgs):
+                write_snapshot(load_data(conn), key)
+    except BaseException:
+        conn.close()
+        if os.path.exists(SHADOW_DB_PATH):
+            os.remove(SHADOW_DB_PATH)
+        raise
+
+    print(f"Swapping the new database into {DB_PATH}...")
+    _swap_shadow_db(conn, hitl_rowid)
 
     print("Ingestion complete.")
     
     # usage = ai_client.get_usage_report() # REMOVED
     
-    summary_report = {
-        "total_records": len(df),
-        "human_messages": int((df['type'] == 'human').sum()),
-        "ai_messages": int((df['type'] == 'ai').sum()),
-        "categorized_total": int((df.loc[df['type'] == 'human', 'requires_review'] == 0).sum()),
-        "needs_review": int((df.loc[df['type'] == 'human', 'requires_review'] == 1).sum())
-    }
+    summary_report.update({
+        "quarantined": quarantined,
+        "mode": 'incremental' if incremental else 'full',
+        "threads_rederived": len(touched) if touched is not None else None,
+    })
 
     print("\n" + "="*40)
     print("       FINAL INGESTION REPORT")
@@ -683,12 +1341,14 @@ def ingest_data():
     print(f"AI Messages:        {summary_report['ai_messages']}")
     print(f"Successfully Categorized: {summary_report['categorized_total']}")
     print(f"Needs Manual Review:      {summary_report['needs_review']}")
-    
-    print(f"Successfully Categorized: {summary_report['categorized_total']}")
-    print(f"Needs Manual Review:      {summary_report['needs_review']}")
+    print(f"Quarantined Lines:        {summary_report['quarantined']}")
+    print(f"Mode:                     {summary_report['mode']}")
     print("="*40 + "\n")
 
     return summary_report
 
 if __name__ == "__main__":
-    ingest_data()
+    workers = None
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    ingest_data(incremental='--incremental' in sys.argv, workers=workers)
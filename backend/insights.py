@@ -4,9 +4,10 @@ from .metrics import get_general_kpis
 from .categorical import get_categorical_analysis
 from .referrals import detect_referrals
 
-def get_insights_data(df: pd.DataFrame) -> Dict[str, Any]:
+def get_insights_data(df: pd.DataFrame, referral_index: pd.DataFrame = None) -> Dict[str, Any]:
     """
     Aggregates data for the Insights dashboard.
+    referral_index: DataEngine.referral_index (see referrals.referral_threads).
     """
     if df.empty:
         return {}
@@ -19,7 +20,7 @@ def get_insights_data(df: pd.DataFrame) -> Dict[str, Any]:
     cats = get_categorical_analysis(df)
     
     # 3. Referrals Analysis
-    referrals_df = detect_referrals(df)
+    referrals_df = detect_referrals(df, referral_index)
     
     # Top Referral Reasons
     top_reasons = []
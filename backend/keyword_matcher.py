@@ -0,0 +1,325 @@
+"""
+Compiled keyword matchers for categorias.yml and productos.yml.
+
+The ETL used to test every `palabras_clave` entry against every message,
+re-cleaning each keyword on every call. Here the substring keywords of a YAML
+file are compiled once into an Aho-Corasick automaton over the cleaned text,
+and the regex keywords into precompiled patterns. A message is scanned once
+and the lowest-priority (earliest in the YAML) match wins, exactly like the
+original first-match loop.
+
+Matchers are cached per file content hash, so editing a YAML (e.g. a HITL
+keyword update) transparently rebuilds them on the next ETL.
+"""
+import hashlib
+import os
+import re
+import unicodedata
+
+import yaml
+
+
+def clean_for_nlp(text):
+    if text is None or text != text:  # None / NaN
+        return ""
+    text = str(text).lower()
+    text = ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
+    text = re.sub(r'[^\w\s]', '', text)
+    return text.strip()
+
+
+# Noise keywords that should be categorized as "Saludos" or "Sin Sentido" without review.
+# These are applied BEFORE general keyword matching.
+NOISE_KEYWORDS = {
+    'saludos': ['hola', 'buen dia', 'buenos dias', 'buenas tardes', 'buenas noches', 'saludos', 'hey', 'hi', 'hello'],
+    'agradecimiento': ['gracias', 'muchas gracias', 'mil gracias', 'ok', 'vale', 'listo', 'entendido', 'bien gracias', 'perfecto gracias'],
+    'despedida': ['chao', 'adios', 'hasta luego', 'nos vemos', 'bye']
+}
+
+# Greeting prefixes to strip before categorizing.  Sorted longest-first so
+# "hola buenas tardes" is tried before "hola".
+GREETING_PREFIXES = sorted([
+    "hola buenas tardes", "hola buenas noches", "hola buenos dias",
+    "hola buen dia", "buenas tardes", "buenas noches", "buenos dias",
+    "buen dia", "buenas", "hola", "saludos", "que tal", "como estas",
+    "hey", "hi", "hello",
+], key=len, reverse=True)
+
+# Short replies that should NOT be propagated as real intent.
+# These go to Retroalimentación (Sin Clasificar) instead of whatever the
+# AI thought the thread was about.
+SHORT_REPLY_KEYWORDS = {
+    'si', 'no', 'si por favor', 'no gracias', 'bueno', 'dale', 'ya',
+    'claro', 'correcto', 'exacto', 'eso', 'asi es', 'ajam', 'okey',
+    'igualmente', 'super', 'genial', 'excelente', 'obvio', 'porfa',
+    'aja', 'listo gracias', 'dale gracias', 'buenas noches', 'buenas tardes',
+    'buenos dias', 'buen dia', 'buenas',
+}
+
+# Categories assigned by the rules above, never by keyword matching
+_RULE_ONLY_CATEGORIES = ("Saludos", "Sin Sentido", "Encuesta")
+
+
+def strip_greeting_prefix(text_lower: str) -> str:
+    """Remove a leading greeting from text to expose the real intent."""
+    for prefix in GREETING_PREFIXES:
+        if text_lower.startswith(prefix):
+            remainder = text_lower[len(prefix):].lstrip(' ,.:;!?')
+            if remainder:  # only strip if there IS something after the greeting
+                return remainder
+    return text_lower
+
+
+def file_hash(path):
+    """sha1 of a file's bytes ('' if it does not exist). Identifies a rules version."""
+    if not os.path.exists(path):
+        return ""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class _Automaton:
+    """
+    Aho-Corasick automaton. Each pattern carries a priority; every node keeps
+    the sorted priorities of all patterns ending there (own + via fail links).
+    """
+
+    def __init__(self, patterns):
+        goto, outputs = [{}], [set()]
+        for pattern, priority in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    outputs.append(set())
+                node = nxt
+            outputs[node].add(priority)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for node in queue:  # BFS: parents are always resolved before children
+            for ch, child in goto[node].items():
+                queue.append(child)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0)
+                outputs[child] |= outputs[fail[child]]
+
+        self.goto = goto
+        self.fail = fail
+        self.outputs = [tuple(sorted(o)) for o in outputs]
+
+    def best(self, text, limit, accept=None):
+        """
+        Lowest priority < limit among patterns occurring in text, or limit.
+        `accept(priority)` can veto a candidate (e.g. min_len rules).
+        """
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for p in outputs[node]:
+                if p >= limit:
+                    break
+                if accept is None or accept(p):
+                    limit = p
+                    break
+        return limit
+
+
+class _CompiledRules:
+    """Substring automaton + ordered regex list for one list of YAML entries."""
+
+    def __init__(self, entries, is_regex):
+        substrings, regexes = [], []
+        for priority, entry in enumerate(entries):
+            for kw in entry.get('palabras_clave', None) or []:
+                if not kw:
+                    continue
+                kw_str = str(kw)
+                if is_regex(kw_str):
+                    try:
+                        regexes.append((priority, re.compile(kw_str)))
+                    except re.error:
+                        pass
+                else:
+                    kw_clean = clean_for_nlp(kw_str)
+                    if kw_clean:
+                        substrings.append((kw_clean, priority))
+        self.size = len(entries)
+        self.automaton = _Automaton(substrings)
+        # Only the first pattern per priority matters for "any keyword matches"
+        self.regexes = sorted(regexes, key=lambda r: r[0])
+
+    def first_match(self, clean_text, regex_text, allowed=None):
+        """Index of the first entry (YAML order) with a matching keyword, or None."""
+        best = self.automaton.best(clean_text, self.size, allowed)
+        for priority, pattern in self.regexes:
+            if priority >= best:
+                break
+            if allowed is not None and not allowed(priority):
+                continue
+            if pattern.search(regex_text):
+                best = priority
+                break
+        return best if best < self.size else None
+
+
+class CategoryMatcher:
+    """
+    Compiled form of categorias.yml. classify() returns the same
+    (categoria_yaml, macro_yaml, requires_review) as the original rule chain:
+    survey tag → very short → noise → short reply → greeting strip →
+    first category (YAML order) whose keyword matches the stripped text,
+    then the original text. Regex keywords are those starting with ^ or
+    ending with $; everything else is a substring of the cleaned text.
+    """
+
+    def __init__(self, categories, version=""):
+        self.version = version
+        self.count = len(categories)
+        entries = [c for c in categories if c.get('nombre', '') not in _RULE_ONLY_CATEGORIES]
+        self.names = [c.get('nombre', '') for c in entries]
+        self.macros = [c.get('macro', c.get('nombre', '')) for c in entries]
+        self.min_len = [c.get('min_len', 1) for c in entries]
+        self.rules = _CompiledRules(entries, lambda kw: kw.startswith('^') or kw.endswith('$'))
+        self._noise = {kw: cat for cat, kws in NOISE_KEYWORDS.items() for kw in kws}
+
+    def __len__(self):
+        return self.count
+
+    def classify(self, text):
+        if not text or not text.strip():
+            return None, None, 0
+
+        original_lower = text.lower().strip()
+
+        # Rule 0: Survey responses — [survey] tag means this is an automated survey vote,
+        # NOT a real user intent. Must be caught BEFORE keyword matching to prevent
+        # "[survey] No me fue útil la información" from matching "Evaluación General".
+        if '[survey]' in original_lower:
+            return "Encuesta", "Experiencia", 0
+
+        # Rule 1: Very short messages (noise/junk)
+        if len(original_lower) < 3 and not original_lower.isdigit():
+            return "Sin Sentido", "Sin Clasificar", 0
+
+        # Rule 2: Explicit Noise Keywords (Greetings/Acknowledgements)
+        # MUST be exact match to avoid catching "Hola quiero mi saldo" as Saludos
+        noise = self._noise.get(original_lower)
+        if noise == 'saludos':
+            return "Saludos", "Sin Clasificar", 0
+        if noise is not None:
+            return "Evaluación General", "Experiencia", 0
+
+        # Rule 2b: Short affirmative/negative replies → Retroalimentación
+        if original_lower in SHORT_REPLY_KEYWORDS:
+            return "Retroalimentación", "Sin Clasificar", 0
+
+        # Rule 2c: Strip greeting prefix to expose real intent.
+        # "hola buenas quiero transferir" → try matching on "quiero transferir"
+        stripped = strip_greeting_prefix(original_lower)
+
+        # Rule 3: General Keyword Matching
+        # Try matching on stripped text first, then original if different
+        texts_to_try = [stripped, original_lower] if stripped != original_lower else [original_lower]
+        for try_text in texts_to_try:
+            length = len(try_text.strip())
+            min_len = self.min_len
+            match = self.rules.first_match(clean_for_nlp(try_text), try_text,
+                                           lambda p: length >= min_len[p])
+            if match is not None:
+                return self.names[match], self.macros[match], 0
+
+        # No match → needs human review
+        return None, None, 1
+
+    def classify_batch(self, texts):
+        """classify() over an iterable; each distinct text is classified once."""
+        seen = {}
+        results = []
+        for text in texts:
+            if text not in seen:
+                seen[text] = self.classify(text)
+            results.append(seen[text])
+        return results
+
+
+class ProductMatcher:
+    """
+    Compiled form of productos.yml palabras_clave. match() returns
+    (nombre, macro) of the first product (YAML order) with a matching keyword.
+    Keywords starting with ^, ending with $ or containing \\b are regexes
+    searched in the lowercased text; the rest are substrings of the cleaned text.
+    """
+
+    def __init__(self, products, version=""):
+        self.version = version
+        self.names = [p.get('nombre', '') for p in products]
+        self.macros = [p.get('macro', p.get('nombre', '')) for p in products]
+        self.rules = _CompiledRules(
+            products, lambda kw: kw.startswith('^') or kw.endswith('$') or '\\b' in kw)
+
+    def __len__(self):
+        return len(self.names)
+
+    def match(self, text):
+        if not text or not text.strip():
+            return None, None
+        match = self.rules.first_match(clean_for_nlp(text), text.lower().strip())
+        if match is None:
+            return None, None
+        return self.names[match], self.macros[match]
+
+    def classify_batch(self, texts):
+        """match() over an iterable; each distinct text is matched once."""
+        seen = {}
+        results = []
+        for text in texts:
+            if text not in seen:
+                seen[text] = self.match(text)
+            results.append(seen[text])
+        return results
+
+
+# Compiled matchers keyed by YAML path → rebuilt only when the file content changes
+_matchers = {}
+
+
+def _get_matcher(path, section, factory):
+    version = file_hash(path)
+    cached = _matchers.get(path)
+    if cached is not None and cached.version == version:
+        return cached
+    entries = []
+    if version:
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = (yaml.safe_load(f) or {}).get(section, [])
+    matcher = factory(entries, version)
+    _matchers[path] = matcher
+    return matcher
+
+
+def get_category_matcher(path):
+    """CategoryMatcher for categorias.yml at `path`, built once per file version."""
+    return _get_matcher(path, 'categorias', CategoryMatcher)
+
+
+def get_product_matcher(path):
+    """ProductMatcher for productos.yml at `path`, built once per file version."""
+    return _get_matcher(path, 'productos', ProductMatcher)
+
+
+def classify_texts(section, path, texts):
+    """
+    classify_batch() of the 'categorias' or 'productos' matcher at `path`.
+    Module-level so process-pool workers can run it on a shard of texts.
+    """
+    getter = get_category_matcher if section == 'categorias' else get_product_matcher
+    return getter(path).classify_batch(texts)
@@ -2,15 +2,93 @@
 import pandas as pd
 import sqlite3
 import os
+import threading
+
+from .text_features import add_text_features, FLAG_COLUMNS, TEXT_FEATURE_COLUMNS
+from .snapshot import snapshot_key, read_snapshot, write_snapshot
+from .thread_facts import build_thread_facts, update_thread_facts
 
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "chat_data.db")
 DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "data-asistente.csv")
+# Held by in-process writers of DB_PATH (HITL corrections) and by the ETL while it
+# swaps the freshly built database into place, so no write lands in the old file.
+DB_SWAP_LOCK = threading.Lock()
+
+# Low-cardinality text columns kept dictionary-encoded (category dtype) in memory:
+# integer codes make groupby / == filters cheaper and shrink the frame.
+CATEGORICAL_COLUMNS = [
+    'type', 'sentiment', 'intencion', 'product_type', 'segment',
+    'categoria_yaml', 'macro_yaml', 'product_yaml', 'product_macro_yaml', 'survey_status',
+]
 
-def load_data():
+def prepare_messages(df):
     """
-    Loads data from SQLite database. 
-    If DB doesn't exist, it tries to run ingestion from CSV.
+    Normalizes rows read from the messages table to the in-memory shape every
+    analysis module expects (datetime fecha, int counters, no NaN).
     """
+    # Post-load processing
+    # SQLite stores dates as strings, so we MUST parse them back to datetime objects
+    # for the temporal analysis to work.
+    if 'fecha' in df.columns:
+        df['fecha'] = pd.to_datetime(df['fecha'])
+
+    # Ensure numeric columns are int and no NaNs
+    numeric_cols = ['hora', 'input_tokens', 'output_tokens', 'word_count']
+    for col in numeric_cols:
+        if col in df.columns:
+            df[col] = df[col].fillna(0).astype(int)
+    
+    # Fill NaNs with empty string for text columns to match previous logic
+    # (SQL might return None for NULLs)
+    text_cols = ['text', 'intencion', 'product_type', 'product_detail', 'segment', 'sentiment', 'thread_id', 'type']
+    for col in text_cols:
+        if col in df.columns:
+            df[col] = df[col].fillna("")
+
+    # Text features are computed by the ETL; databases built before that get them here.
+    # SQLite stores the flags as 0/1, the analysis modules expect booleans.
+    if 'text' in df.columns and not set(TEXT_FEATURE_COLUMNS) <= set(df.columns):
+        add_text_features(df)
+    for col in FLAG_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].fillna(0).astype(bool)
+
+    # Final safety check: Replace any remaining NaNs (floats) with None
+    # We must be careful not to convert datetime to object if possible, 
+    # but for JSON serialization of other columns, we need to get rid of NaN.
+    # Identify columns that have NaN
+    # Note: timestamp columns with NaT are also problematic for some JSON encoders, 
+    # but standard pandas to_dict usually handles them or we process them in main.py.
+    
+    # We already handled numeric_cols (int) and text_cols (str).
+    # If there are other columns (e.g. floats), fill them with 0.0 or None.
+    
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    # Let's use `object` conversion ONLY for columns that are NOT fecha
+    for col in df.columns:
+        if col != 'fecha' and col not in CATEGORICAL_COLUMNS:
+             # If column has NaN, replace with None
+             if df[col].isnull().any():
+                 df[col] = df[col].astype(object).where(pd.notnull(df[col]), None)
+    return df
+
+def to_records(df):
+    """
+    df.to_dict(orient='records') for frames holding CATEGORICAL_COLUMNS: category
+    values come back as plain strings and missing ones as None (not NaN).
+    """
+    cat_cols = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    if cat_cols:
+        df = df.astype({c: object for c in cat_cols})
+        for col in cat_cols:
+            df[col] = df[col].where(df[col].notna(), None)
+    return df.to_dict(orient='records')
+
+def ensure_database():
+    """Runs the ingestion when there is no database yet but the CSV exists."""
     if not os.path.exists(DB_PATH):
         if os.path.exists(DATA_PATH):
             print("Database not found. Running ingestion...")
@@ -40,53 +118,77 @@ def load_data():
         else:
             raise FileNotFoundError(f"Database not found at {DB_PATH} and no CSV to ingest.")
 
-    print(f"Loading data from SQLite: {DB_PATH}...")
-    conn = sqlite3.connect(DB_PATH)
+def load_data(conn=None):
+    """
+    Loads data from SQLite database. 
+    If DB doesn't exist, it tries to run ingestion from CSV.
+    Pass `conn` to read through an already open connection (same database
+    file as the caller's other reads, even if the ETL swaps it meanwhile).
+    """
+    own_conn = conn is None
+    if own_conn:
+        ensure_database()
+        conn = sqlite3.connect(DB_PATH)
+
+    # The file behind conn: the ETL reads its shadow database through here
+    source = DB_PATH if own_conn else (conn.execute("PRAGMA database_list").fetchone()[2] or ':memory:')
+    print(f"Loading data from SQLite: {source}...")
     try:
         # Load with rowid to preserve insertion order (which proxies for time)
         df = pd.read_sql("SELECT *, rowid FROM messages ORDER BY rowid", conn)
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
-    # Post-load processing
-    # SQLite stores dates as strings, so we MUST parse them back to datetime objects
-    # for the temporal analysis to work.
-    if 'fecha' in df.columns:
-        df['fecha'] = pd.to_datetime(df['fecha'])
+    df = prepare_messages(df)
 
-    # Ensure numeric columns are int and no NaNs
-    numeric_cols = ['hora', 'input_tokens', 'output_tokens']
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = df[col].fillna(0).astype(int)
-    
-    # Fill NaNs with empty string for text columns to match previous logic
-    # (SQL might return None for NULLs)
-    text_cols = ['text', 'intencion', 'product_type', 'product_detail', 'segment', 'sentiment', 'thread_id', 'type']
-    for col in text_cols:
-        if col in df.columns:
-            df[col] = df[col].fillna("")
+    print(f"Data loaded: {len(df)} records.")
+    return df
 
-    # Final safety check: Replace any remaining NaNs (floats) with None
-    # We must be careful not to convert datetime to object if possible, 
-    # but for JSON serialization of other columns, we need to get rid of NaN.
-    # Identify columns that have NaN
-    # Note: timestamp columns with NaT are also problematic for some JSON encoders, 
-    # but standard pandas to_dict usually handles them or we process them in main.py.
-    
-    # We already handled numeric_cols (int) and text_cols (str).
-    # If there are other columns (e.g. floats), fill them with 0.0 or None.
-    
-    # Let's use `object` conversion ONLY for columns that are NOT fecha
-    for col in df.columns:
-        if col != 'fecha':
-             # If column has NaN, replace with None
-             if df[col].isnull().any():
-                 df[col] = df[col].astype(object).where(pd.notnull(df[col]), None)
+def load_engine_data(conn):
+    """
+    Messages frame plus thread fact table (thread_facts.build_thread_facts) for the
+    DataEngine. Reads the columnar snapshot when it matches the database behind
+    `conn`; otherwise loads from SQLite and refreshes the snapshot.
+    """
+    key = snapshot_key(conn)
+    cached = read_snapshot(key)
+    if cached is not None:
+        df, meta = cached
+        print(f"Data loaded from columnar snapshot: {len(df)} records.")
+        return df, meta
 
+    df = load_data(conn)
+    meta = build_thread_facts(df)
+    write_snapshot(df, key, meta)
+    return df, meta
 
-    print(f"Data loaded: {len(df)} records.")
-    return df
+def replace_threads(df, thread_ids, rows):
+    """
+    load_data's frame after the messages of thread_ids were replaced by `rows`
+    (prepared rows of those threads): same rowid order, dtypes and categories
+    as reading the updated table again.
+    """
+    merged = pd.concat([df[~df['thread_id'].isin(thread_ids)], rows])
+    merged = merged.sort_values('rowid', kind='stable', ignore_index=True)
+    # Categories are rebuilt from the merged values, as load_data would
+    merged = merged.astype({c: object for c in CATEGORICAL_COLUMNS if c in merged.columns}).infer_objects()
+    return prepare_messages(merged)
+
+def patch_snapshot(previous_key, key, thread_ids, rows):
+    """
+    Writes the snapshot for `key` from the one taken for previous_key, with the
+    messages and thread facts of thread_ids replaced by `rows` (the ETL's
+    incremental run). False when there is no snapshot for previous_key.
+    """
+    cached = read_snapshot(previous_key)
+    if cached is None:
+        return False
+    df, facts = cached
+    if thread_ids:
+        df = replace_threads(df, thread_ids, rows)
+        facts = update_thread_facts(facts, df, thread_ids)
+    return write_snapshot(df, key, facts)
 
 # Singleton-like access to data (optional, or just load on startup)
 _df_cache = None
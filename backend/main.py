@@ -5,11 +5,13 @@ from typing import List, Optional
 import pandas as pd
 from fastapi import BackgroundTasks
 from .engine import DataEngine
+from .loader import to_records
 from .metrics import get_general_kpis
-from .failures import detect_failures 
+from .failures import detect_failures
 from .referrals import detect_referrals
 from .categorical import get_categorical_analysis
 from .temporal import get_temporal_analysis
+from .metrics_cube import cube_kpis, cube_temporal, cube_categorical
 from .text_analysis import generate_wordcloud_image
 from .conversations import get_conversation_analysis
 from .summary import get_general_summary, get_uncategorized_threads, get_survey_stats
@@ -23,38 +25,110 @@ from .category_discovery import run_category_discovery
 from .reports import get_volume_report, get_survey_utility_analysis
 from .gaps_analysis import analyze_gaps_and_referrals
 from .dashboard_metrics import get_extended_funnel
+from .thread_facts import thread_set
+from .response_cache import cached_response, response_cache, ordering_cache, response_etag, etag_matches
+from .pagination import encode_cursor, decode_cursor, seek, paginate_table
 from .reports_deep import get_kpis_detailed, get_categories_detailed, get_failures_detailed, get_category_threads, get_products_detailed, get_dimension_report
 import time
-
-app = FastAPI(title="Chatbot Analysis API")
-
-
-# Setup CORS
+from contextlib import asynccontextmanager
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+# Answered while the engine is still loading; every other /api route gets a 503
+ENGINE_EXEMPT_PATHS = {"/api/engine/status", "/api/etl/status"}
+# Also allowed when the initial load failed, so the data can be rebuilt
+ENGINE_RECOVERY_PATHS = {"/api/etl/run", "/api/admin/ingest"}
+# Seconds clients are told to wait before retrying a 503
+LOADING_RETRY_AFTER = 3
+# Read from the live SQLite file, not the engine: an ETL swap changes them before data_version moves
+SQLITE_BACKED_PATHS = {"/api/feedbacks"}
+# GET responses without an ETag: live status, SQLite-backed lists and file exports (they carry a generation time)
+ETAG_EXEMPT_PATHS = ENGINE_EXEMPT_PATHS | SQLITE_BACKED_PATHS
+ETAG_EXEMPT_MARKER = "/export"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start loading without blocking: uvicorn accepts connections right away
+    DataEngine.get_instance()
+    yield
+
+
+app = FastAPI(title="Chatbot Analysis API", lifespan=lifespan)
+
+
+# Registered before the readiness gate, so it runs inside it (only with the data loaded)
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    path = request.url.path
+    if (request.method != "GET" or not path.startswith("/api/")
+            or path in ETAG_EXEMPT_PATHS or ETAG_EXEMPT_MARKER in path):
+        return await call_next(request)
+    params = {k: tuple(request.query_params.getlist(k)) for k in request.query_params.keys()}
+    etag = response_etag(path, params)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.middleware("http")
+async def engine_readiness_gate(request: Request, call_next):
+    path = request.url.path
+    if path.startswith("/api/") and path not in ENGINE_EXEMPT_PATHS:
+        engine = DataEngine.get_instance()
+        if not engine.is_ready():
+            status = engine.get_load_status()
+            if not (status["state"] == "error" and path in ENGINE_RECOVERY_PATHS):
+                return JSONResponse(
+                    status_code=503,
+                    content={"detail": "Data engine is not ready", **status},
+                    headers={"Retry-After": str(LOADING_RETRY_AFTER)},
+                )
+    return await call_next(request)
+
+
+# Setup CORS (added last so it also wraps the 503 responses above)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "http://localhost:3000", "http://127.0.0.1:3000"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "ETag"],
 )
 
 
 @app.get("/api/analysis/conversations")
+@cached_response("/api/analysis/conversations")
 def get_conversations_endpoint(thread_id: Optional[str] = None):
-    df = DataEngine.get_instance().get_messages()
+    engine = DataEngine.get_instance()
+    df = engine.get_thread(thread_id) if thread_id else engine.get_messages()
     return get_conversation_analysis(df, thread_id=thread_id)
 
 @app.get("/api/analysis/categorical")
-def get_categorical_endpoint():
-    df = DataEngine.get_instance().get_messages()
-    return get_categorical_analysis(df)
+@cached_response("/api/analysis/categorical")
+def get_categorical_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
+    engine = DataEngine.get_instance()
+    cube = engine.get_cube(start_date, end_date)
+    if cube is not None:
+        return cube_categorical(cube)
+    return get_categorical_analysis(engine.get_messages(start_date, end_date))
 
 @app.get("/api/analysis/temporal")
-def get_temporal_endpoint():
-    df = DataEngine.get_instance().get_messages()
-    return get_temporal_analysis(df)
+@cached_response("/api/analysis/temporal")
+def get_temporal_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
+    engine = DataEngine.get_instance()
+    cube = engine.get_cube(start_date, end_date)
+    if cube is not None:
+        return cube_temporal(cube)
+    return get_temporal_analysis(engine.get_messages(start_date, end_date))
 
 @app.get("/api/analysis/wordcloud")
+@cached_response("/api/analysis/wordcloud")
 def get_wordcloud_endpoint(intencion: Optional[str] = None):
     df = DataEngine.get_instance().get_messages()
     img_base64 = generate_wordcloud_image(df, intencion=intencion)
@@ -62,97 +136,89 @@ def get_wordcloud_endpoint(intencion: Optional[str] = None):
 
 
 @app.get("/api/summary")
+@cached_response("/api/summary")
 def get_summary_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
-    df = DataEngine.get_instance().get_messages()
-    return get_general_summary(df, start_date=start_date, end_date=end_date)
+    engine = DataEngine.get_instance()
+    df = engine.get_messages(start_date, end_date)
+    return get_general_summary(df, thread_facts=engine.get_thread_facts(start_date, end_date),
+                               referral_index=engine.referral_index)
 
 @app.get("/api/analysis/uncategorized")
-def get_uncategorized_endpoint(page: int = 1, limit: int = 20, start_date: Optional[str] = None, end_date: Optional[str] = None):
-    df = DataEngine.get_instance().get_messages()
-    return get_uncategorized_threads(df, page=page, limit=limit, start_date=start_date, end_date=end_date)
+@cached_response("/api/analysis/uncategorized")
+def get_uncategorized_endpoint(page: int = 1, limit: int = 20, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                               cursor: Optional[str] = None, include_total: bool = True):
+    engine = DataEngine.get_instance()
+    df = engine.get_messages(start_date, end_date)
+    return get_uncategorized_threads(df, page=page, limit=limit,
+                                     thread_facts=engine.get_thread_facts(start_date, end_date),
+                                     cursor=cursor, include_total=include_total,
+                                     referral_index=engine.referral_index)
 
 @app.get("/api/analysis/surveys")
+@cached_response("/api/analysis/surveys")
 def get_surveys_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
-    df = DataEngine.get_instance().get_messages()
-    return get_survey_stats(df, start_date=start_date, end_date=end_date)
+    df = DataEngine.get_instance().get_messages(start_date, end_date)
+    return get_survey_stats(df)
 
 @app.get("/api/reports/volumes")
+@cached_response("/api/reports/volumes")
 def get_report_volumes_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
     df = DataEngine.get_instance().get_messages(start_date=start_date, end_date=end_date)
     return get_volume_report(df)
 
 @app.get("/api/reports/surveys/logic")
+@cached_response("/api/reports/surveys/logic")
 def get_report_surveys_logic_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
     df = DataEngine.get_instance().get_messages(start_date=start_date, end_date=end_date)
     return get_survey_utility_analysis(df)
 
 
 @app.get("/api/kpis")
-def get_kpis_endpoint():
-    df = DataEngine.get_instance().get_messages()
-    return get_general_kpis(df)
+@cached_response("/api/kpis")
+def get_kpis_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
+    engine = DataEngine.get_instance()
+    cube = engine.get_cube(start_date, end_date)
+    if cube is not None:
+        return cube_kpis(cube)
+    return get_general_kpis(engine.get_messages(start_date, end_date))
 
 @app.get("/api/failures")
-def get_failures_endpoint(page: int = 1, limit: int = 20, start_date: Optional[str] = None, end_date: Optional[str] = None):
-    failures_df = DataEngine.get_instance().get_failures()
-    
-    # Filter by Date
-    if (start_date or end_date) and not failures_df.empty and 'fecha' in failures_df.columns:
-        mask = pd.Series(True, index=failures_df.index)
-        if start_date:
-            mask &= (failures_df['fecha'] >= start_date)
-        if end_date:
-            mask &= (failures_df['fecha'] <= end_date)
-        failures_df = failures_df[mask]
-
-    # Pagination
-    total = len(failures_df)
-    start = (page - 1) * limit
-    end = start + limit
-    
-    data = failures_df.iloc[start:end].to_dict(orient="records")
-    
-    return {
-        "data": data,
-        "total": total,
-        "page": page,
-        "limit": limit
-    }
+def get_failures_endpoint(page: int = 1, limit: int = 20, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                        cursor: Optional[str] = None, include_total: bool = True):
+    failures_df = DataEngine.get_instance().get_failures(start_date, end_date)
+    return paginate_table(failures_df, page=page, limit=limit, cursor=cursor, include_total=include_total)
 
 @app.post("/api/admin/ingest")
-def trigger_ingest_endpoint():
+def trigger_ingest_endpoint(incremental: bool = False):
     """Triggers data ingestion and memory reload."""
-    report = ingest_data()
+    report = ingest_data(incremental=incremental)
     DataEngine.get_instance().reload()
     return {"status": "success", "report": report}
 
 
 @app.get("/api/referrals")
-def get_referrals_endpoint(page: int = 1, limit: int = 20, start_date: Optional[str] = None, end_date: Optional[str] = None):
-    referrals_df = DataEngine.get_instance().get_referrals()
-    
-    # Filter by Date
-    if (start_date or end_date) and not referrals_df.empty and 'fecha' in referrals_df.columns:
-        mask = pd.Series(True, index=referrals_df.index)
-        if start_date:
-            mask &= (referrals_df['fecha'] >= start_date)
-        if end_date:
-            mask &= (referrals_df['fecha'] <= end_date)
-        referrals_df = referrals_df[mask]
-
-    # Pagination
-    total = len(referrals_df)
-    start = (page - 1) * limit
-    end = start + limit
-    
-    data = referrals_df.iloc[start:end].to_dict(orient="records")
-    
-    return {
-        "data": data,
-        "total": total,
-        "page": page,
-        "limit": limit
-    }
+def get_referrals_endpoint(page: int = 1, limit: int = 20, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                        cursor: Optional[str] = None, include_total: bool = True):
+    referrals_df = DataEngine.get_instance().get_referrals(start_date, end_date)
+    return paginate_table(referrals_df, page=page, limit=limit, cursor=cursor, include_total=include_total)
+
+def _message_sort(df, sort_by, thread_id):
+    """
+    Sort key of the explorer for a request: (columns, directions). Always ends
+    with rowid so the order is total (keyset cursors, stable pages).
+    """
+    ts_col = 'timestamp' if 'timestamp' in df.columns else 'fecha'
+    if sort_by in ['length_asc', 'length_desc']:
+        return ['thread_length', 'rowid'], [sort_by == 'length_asc', True]
+    if sort_by in ['date_asc', 'date_desc']:
+        return [ts_col, 'rowid'], [sort_by == 'date_asc', True]
+    if thread_id:
+        # When viewing a single thread, always sort chronologically
+        # (fallback: fecha + hora when the timestamp column doesn't exist yet)
+        cols = ['timestamp'] if 'timestamp' in df.columns else ['fecha', 'hora']
+        return cols + ['rowid'], [True] * (len(cols) + 1)
+    return ['rowid'], [True]
+
 
 @app.get("/api/messages")
 def get_messages_endpoint(
@@ -169,123 +235,87 @@ def get_messages_endpoint(
     sort_by: Optional[str] = None,  # 'length_asc', 'length_desc'
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
-    survey_result: Optional[str] = None # 'useful', 'not_useful'
+    survey_result: Optional[str] = None, # 'useful', 'not_useful'
+    cursor: Optional[str] = None,  # next_cursor of the previous page (replaces page)
+    include_total: bool = True,
 ):
     engine = DataEngine.get_instance()
     df = engine.get_messages()
-    
-    # Pre-filter by date if provided (Optimization)
-    if start_date or end_date:
-        if 'fecha' in df.columns:
-             mask = pd.Series(True, index=df.index)
-             if start_date: mask &= (df['fecha'] >= start_date)
-             if end_date: mask &= (df['fecha'] <= end_date)
-             df = df[mask]
-    
-    filtered_df = df.copy()
-
-    # Calculate Thread Metadata (Length, Servilinea) BEFORE filtering rows if we want to sort by them
-    # Because row filtering (e.g. sender_type=human) shouldn't affect "conversation length" logic usually,
-    # but here we might just want to sort the resulting rows?
-    # No, "sort by conversation length" implies we sort the messages based on their thread's total length.
-    
-    # Pre-calc thread lengths using Engine
-    # thread_lengths = df.groupby('thread_id').size() # REMOVE
-    
-    # Pre-calc Servilínea status per thread using Engine
-    # referrals_df = detect_referrals(df) # REMOVE
-    # servilinea_threads = ... # REMOVE
-
-    # Apply Filters for Rows
-    if sender_type:
-         filtered_df = filtered_df[filtered_df['type'] == sender_type]
-    elif not thread_id and not search and not intencion and not sentiment and not product:
-         # Default view: show only human messages to avoid clutter
-         filtered_df = filtered_df[filtered_df['type'] == 'human']
-
-    if thread_id:
-        filtered_df = filtered_df[filtered_df['thread_id'] == thread_id]
-    
-    if macro_categoria:
-        if 'macro_yaml' in filtered_df.columns:
-            filtered_df = filtered_df[filtered_df['macro_yaml'] == macro_categoria]
-    if intencion:
-        # Filter on categoria_yaml (YAML source of truth); fallback to intencion for compatibility
-        if 'categoria_yaml' in filtered_df.columns:
-            filtered_df = filtered_df[filtered_df['categoria_yaml'] == intencion]
-        else:
-            filtered_df = filtered_df[filtered_df['intencion'] == intencion]
-    if sentiment:
-        filtered_df = filtered_df[filtered_df['sentiment'] == sentiment]
-    if product:
-        if 'product_yaml' in filtered_df.columns:
-            filtered_df = filtered_df[filtered_df['product_yaml'] == product]
-        else:
-            filtered_df = filtered_df[filtered_df['product_type'] == product]
-    if search:
-        # Search match either text or thread_id
-        text_match = filtered_df['text'].str.contains(search, case=False, na=False)
-        thread_match = filtered_df['thread_id'].str.contains(search, case=False, na=False)
-        filtered_df = filtered_df[text_match | thread_match]
-    
-    if exclude_empty:
-        # Filter out empty or whitespace-only messages
-        filtered_df = filtered_df[filtered_df['text'].str.strip() != '']
-
-    if survey_result:
-        # 1. Identify threads with the specific survey result
-        # Logic from reports.py: Identify survey messages and their result
-        survey_mask = df['text'].str.contains(r'\[survey\]', case=False, na=False)
-        survey_df = df[survey_mask].copy()
-
-        def classify_survey(text):
-            text = str(text).lower()
-            if "no me fue útil" in text: return "not_useful"
-            if "me fue útil" in text: return "useful"
-            return "unknown"
-
-        survey_df['survey_status'] = survey_df['text'].apply(classify_survey)
-        
-        # Filter threads that have at least one message matching the requested status
-        matching_threads = survey_df[survey_df['survey_status'] == survey_result]['thread_id'].unique()
-        filtered_df = filtered_df[filtered_df['thread_id'].isin(matching_threads)]
-
-    # Apply Sorting
-    if sort_by in ['length_asc', 'length_desc']:
-        filtered_df['thread_length'] = filtered_df['thread_id'].map(lambda x: engine.get_thread_length(x))
-        ascending = sort_by == 'length_asc'
-        filtered_df = filtered_df.sort_values(by=['thread_length', 'rowid'], ascending=[ascending, True])
-    elif sort_by in ['date_asc', 'date_desc']:
-        ts_col = 'timestamp' if 'timestamp' in filtered_df.columns else 'fecha'
-        ascending = sort_by == 'date_asc'
-        filtered_df = filtered_df.sort_values(by=[ts_col], ascending=ascending)
-    elif thread_id:
-        # When viewing a single thread, always sort chronologically
-        if 'timestamp' in filtered_df.columns:
-            filtered_df = filtered_df.sort_values(by=['timestamp'], ascending=True)
-        else:
-            # Fallback: sort by fecha + hora when timestamp column doesn't exist yet
-            filtered_df = filtered_df.sort_values(by=['fecha', 'hora'], ascending=True)
-
-    start = (page - 1) * limit
+    sort_cols, ascending = _message_sort(df, sort_by, thread_id)
+
+    def ordered_matches():
+        # Exact-match filters resolve through the engine's message index: no copy
+        # of the frame, no per-filter masks, only the matching rows are touched
+        equals = {}
+        if sender_type:
+            equals['type'] = sender_type
+        elif not thread_id and not search and not intencion and not sentiment and not product:
+            # Default view: show only human messages to avoid clutter
+            equals['type'] = 'human'
+        if macro_categoria and 'macro_yaml' in df.columns:
+            equals['macro_yaml'] = macro_categoria
+        if intencion:
+            # Filter on categoria_yaml (YAML source of truth); fallback to intencion for compatibility
+            equals['categoria_yaml' if 'categoria_yaml' in df.columns else 'intencion'] = intencion
+        if sentiment:
+            equals['sentiment'] = sentiment
+        if product:
+            equals['product_yaml' if 'product_yaml' in df.columns else 'product_type'] = product
+
+        positions = engine.find_messages(
+            equals,
+            start_date=start_date,
+            end_date=end_date,
+            thread_id=thread_id,
+            exclude_empty=exclude_empty,
+            survey_result=survey_result,
+            search=search,
+        )
+        # Sort keys of the matching rows only, indexed by frame position
+        keys = df[[c for c in sort_cols if c in df.columns]].iloc[positions].set_axis(positions)
+        if 'thread_length' in sort_cols:
+            keys['thread_length'] = engine.get_thread_lengths(df['thread_id'].iloc[positions]).to_numpy()
+        if sort_cols != ['rowid']:
+            keys = keys[sort_cols].sort_values(by=sort_cols, ascending=ascending, kind='stable')
+        return keys
+
+    # Matches in page order, computed once per filter signature and data version:
+    # next pages (and totals) don't filter or sort again
+    filters = dict(intencion=intencion, macro_categoria=macro_categoria, sentiment=sentiment, product=product,
+                   search=search, sender_type=sender_type, thread_id=thread_id, exclude_empty=exclude_empty,
+                   sort_by=sort_by, start_date=start_date, end_date=end_date, survey_result=survey_result)
+    keys = ordering_cache.get_or_compute("/api/messages", filters, ordered_matches)
+    positions = keys.index.to_numpy()
+
+    sort_signature = ','.join(f"{c}:{'asc' if a else 'desc'}" for c, a in zip(sort_cols, ascending))
+    if cursor:
+        start = seek([keys[c].to_numpy() for c in sort_cols], decode_cursor(cursor, sort_signature), ascending)
+    else:
+        start = (page - 1) * limit
     end = start + limit
-    
-    result = filtered_df.iloc[start:end].copy()
+    next_cursor = encode_cursor(sort_signature, keys.iloc[end - 1].tolist()) if 0 < end < len(keys) else None
+
+    result = df.iloc[positions[start:end]].copy()
 
     # Enrich Result with Metadata
     # Use Engine for fast lookups on the PAGINATED result only
     result['thread_length'] = result['thread_id'].apply(lambda x: engine.get_thread_length(x))
     result['is_servilinea'] = result['thread_id'].apply(lambda x: engine.is_servilinea(x))
+    if search and 'rowid' in result.columns:
+        # Highlighted fragment of each matching text (None for thread id matches)
+        snippets = engine.get_search_snippets(search, result['rowid'].tolist())
+        result['search_snippet'] = pd.Series([snippets.get(r) for r in result['rowid']], index=result.index, dtype=object)
 
     # Convert dates to string for JSON serialization
     if 'fecha' in result.columns and pd.api.types.is_datetime64_any_dtype(result['fecha']):
         result['fecha'] = result['fecha'].dt.strftime('%Y-%m-%d').fillna('')
     
     return {
-        "data": result.to_dict(orient="records"),
-        "total": len(filtered_df),
+        "data": to_records(result),
+        "total": len(positions) if include_total else None,
         "page": page,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": next_cursor,
     }
 
 @app.get("/api/options")
@@ -329,21 +359,25 @@ def get_filter_options():
     }
 
 @app.get("/api/insights")
+@cached_response("/api/insights")
 def get_insights_endpoint():
-    df = DataEngine.get_instance().get_messages()
-    return get_insights_data(df)
+    engine = DataEngine.get_instance()
+    return get_insights_data(engine.get_messages(), referral_index=engine.referral_index)
 
 @app.get("/api/insights/qualitative")
+@cached_response("/api/insights/qualitative")
 def get_qualitative_insights_endpoint():
-    df = DataEngine.get_instance().get_messages()
-    return get_qualitative_insights(df)
+    engine = DataEngine.get_instance()
+    return get_qualitative_insights(engine.get_messages(), referral_index=engine.referral_index)
 
 @app.get("/api/insights/category")
+@cached_response("/api/insights/category")
 def get_category_insights_endpoint(categoria: str):
-    df = DataEngine.get_instance().get_messages()
-    return get_category_insights(df, categoria)
+    engine = DataEngine.get_instance()
+    return get_category_insights(engine.get_messages(), categoria, referral_index=engine.referral_index)
 
 @app.get("/api/advisors")
+@cached_response("/api/advisors")
 def get_advisors_endpoint(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None)
@@ -353,6 +387,7 @@ def get_advisors_endpoint(
 
 
 @app.get("/api/advisor-escalation")
+@cached_response("/api/advisor-escalation")
 def get_advisor_escalation(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
@@ -367,24 +402,20 @@ def get_advisor_escalation(
     df = engine.get_messages(start_date, end_date)
     if df.empty or "type" not in df.columns:
         return {"total": 0, "arrived_seeking": {}, "redirected": {}, "organic_escalation": {}, "bot_failed_then_redirected": {}, "top_categories_organic": [], "top_subcategories_organic": [], "by_channel": {}, "arrived_and_redirected": 0}
-    hdf = df[df["type"] == "human"].copy()
-    all_threads = set(hdf["thread_id"].unique())
+    facts = engine.get_thread_facts(start_date, end_date)
+    facts = facts[facts["human_messages"] > 0]
+    all_threads = set(facts.index)
     total = len(all_threads)
 
     # 1. Arrived seeking advisor (category = Escalamiento a Asesor)
-    esc_col = "categoria_yaml"
-    arrived_seeking = set()
-    if esc_col in hdf.columns:
-        esc_df = hdf[hdf[esc_col] == "Escalamiento a Asesor"]
-        arrived_seeking = set(esc_df["thread_id"].unique())
+    arrived_seeking = thread_set(facts, "asked_for_advisor")
 
     # 2. Ended requesting advisor (redirected to any channel)
     ref_df = engine.referrals_df
     if ref_df is not None and not ref_df.empty:
         # Filter by date range if needed
         if start_date or end_date:
-            ref_threads_in_period = all_threads
-            redirected_threads = set(ref_df[ref_df["thread_id"].isin(ref_threads_in_period)]["thread_id"])
+            redirected_threads = thread_set(facts, "is_referred")
         else:
             redirected_threads = set(ref_df["thread_id"])
         # By channel
@@ -398,9 +429,7 @@ def get_advisor_escalation(
         by_channel = {}
 
     # 3. Bot failed then redirected (excluding those who arrived seeking)
-    fail_df = engine.failures_df
-    fail_threads = set(fail_df["thread_id"]) if fail_df is not None and not fail_df.empty else set()
-    fail_threads_in_scope = fail_threads & all_threads
+    fail_threads_in_scope = thread_set(facts, "has_failure")
     bot_failed_then_redirected = (fail_threads_in_scope & redirected_threads) - arrived_seeking
 
     # 4. Arrived seeking AND were redirected
@@ -410,7 +439,7 @@ def get_advisor_escalation(
     organic_escalation = redirected_threads - arrived_seeking
 
     # 6. Top categories of threads that ended requesting advisor (organic only)
-    organic_hdf = hdf[hdf["thread_id"].isin(organic_escalation)]
+    organic_hdf = df[(df["type"] == "human") & df["thread_id"].isin(organic_escalation)]
     top_categories = []
     if "macro_yaml" in organic_hdf.columns:
         skip = {"Sin Clasificar", "Encuestas", "Atención y Contacto"}
@@ -448,8 +477,8 @@ def get_advisor_escalation(
 
 
 @app.get("/api/feedbacks")
-def api_get_feedbacks(page: int = 1, limit: int = 20):
-    return get_feedback_messages(page=page, limit=limit)
+def api_get_feedbacks(page: int = 1, limit: int = 20, cursor: Optional[str] = None, include_total: bool = True):
+    return get_feedback_messages(page=page, limit=limit, cursor=cursor, include_total=include_total)
 
 @app.post("/api/feedbacks/categorize")
 def api_post_categorize(req: CategorizeRequest):
@@ -465,6 +494,7 @@ def api_get_feedback_options():
     }
 
 @app.get("/api/faqs")
+@cached_response("/api/faqs")
 def api_get_faqs(top_n: int = 5):
     """
     Returns the top most frequent phrases per category (Test Cases).
@@ -473,9 +503,10 @@ def api_get_faqs(top_n: int = 5):
     return get_faqs_by_category(df, top_n)
 
 @app.post("/api/etl/run")
-def api_run_etl(background_tasks: BackgroundTasks):
+def api_run_etl(background_tasks: BackgroundTasks, incremental: bool = False):
     """
     Triggers the ETL pipeline to re-process data asynchronously.
+    With incremental=true only threads with new or changed rows are re-derived.
     """
     engine = DataEngine.get_instance()
     status = engine.get_etl_status()
@@ -490,7 +521,7 @@ def api_run_etl(background_tasks: BackgroundTasks):
 
     def task_wrapper():
         try:
-            ingest_data()
+            ingest_data(incremental=incremental)
             engine.reload()
             engine.update_etl_state({"last_status": "success"})
         except Exception as e:
@@ -506,6 +537,7 @@ def api_run_etl(background_tasks: BackgroundTasks):
     return {"message": "ETL process started in the background."}
 
 @app.get("/api/config/category-discovery")
+@cached_response("/api/config/category-discovery")
 def api_category_discovery():
     """
     Runs the category discovery analysis and returns a structured report with:
@@ -521,6 +553,14 @@ def api_category_discovery():
     return run_category_discovery(df=df)
 
 
+@app.get("/api/engine/status")
+def api_get_engine_status():
+    """Readiness of the in-memory data: state (idle/loading/ready/error), current stage, elapsed time."""
+    status = DataEngine.get_instance().get_load_status()
+    status["ready"] = status["state"] == "ready"
+    status["response_cache"] = response_cache.stats()
+    return status
+
 @app.get("/api/etl/status")
 def api_get_etl_status():
     engine = DataEngine.get_instance()
@@ -537,14 +577,19 @@ def api_get_etl_status():
     }
 
 @app.get("/api/analysis/gaps")
+@cached_response("/api/analysis/gaps")
 def get_gaps_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
     df = DataEngine.get_instance().get_messages(start_date, end_date)
     return analyze_gaps_and_referrals(df)
 
 @app.get("/api/dashboard/funnel")
+@cached_response("/api/dashboard/funnel")
 def get_funnel_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
-    df = DataEngine.get_instance().get_messages(start_date, end_date)
-    return get_extended_funnel(df, start_date, end_date)
+    engine = DataEngine.get_instance()
+    df = engine.get_messages(start_date, end_date)
+    return get_extended_funnel(df, thread_facts=engine.get_thread_facts(start_date, end_date),
+                               detected_failures=engine.get_failure_threads(start_date, end_date),
+                               referral_index=engine.referral_index)
 
 @app.get("/api/info/data-period")
 def get_data_period_endpoint():
@@ -552,32 +597,41 @@ def get_data_period_endpoint():
 
 
 @app.get("/api/reports/kpis-detailed")
+@cached_response("/api/reports/kpis-detailed")
 def api_kpis_detailed(start_date: str = None, end_date: str = None):
-    df = DataEngine.get_instance().get_messages(start_date, end_date)
-    return get_kpis_detailed(df, start_date, end_date)
+    engine = DataEngine.get_instance()
+    df = engine.get_messages(start_date, end_date)
+    return get_kpis_detailed(df, start_date, end_date, thread_facts=engine.get_thread_facts(start_date, end_date),
+                             detected_failures=engine.get_failure_threads(start_date, end_date),
+                             referral_index=engine.referral_index)
 
 
 @app.get("/api/reports/categories-detailed")
+@cached_response("/api/reports/categories-detailed")
 def api_categories_detailed(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None)
 ):
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    return get_categories_detailed(df, engine.get_referrals(), engine.get_failures())
+    return get_categories_detailed(df, engine.get_referrals(), engine.get_failures(),
+                                   thread_facts=engine.get_thread_facts(start_date, end_date))
 
 
 @app.get("/api/reports/products-detailed")
+@cached_response("/api/reports/products-detailed")
 def api_products_detailed(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None)
 ):
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    return get_products_detailed(df, engine.get_referrals(), engine.get_failures())
+    return get_products_detailed(df, engine.get_referrals(), engine.get_failures(),
+                                 thread_facts=engine.get_thread_facts(start_date, end_date))
 
 
 @app.get("/api/reports/category-threads")
+@cached_response("/api/reports/category-threads")
 def api_category_threads(
     macro: str = Query(""),
     subcategory: Optional[str] = Query(None),
@@ -606,24 +660,19 @@ def api_category_threads(
         exclude_greetings=exclude_greetings,
         product_macro=product_macro,
         failures_only=failures_only,
+        thread_facts=engine.get_thread_facts(start_date, end_date),
     )
 
 
 @app.get("/api/reports/failures-detailed")
+@cached_response("/api/reports/failures-detailed")
 def api_failures_detailed(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None)
 ):
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    failures_df = engine.get_failures()
-    if (start_date or end_date) and failures_df is not None and not failures_df.empty and "fecha" in failures_df.columns:
-        mask = pd.Series(True, index=failures_df.index)
-        if start_date:
-            mask &= failures_df["fecha"].astype(str) >= start_date
-        if end_date:
-            mask &= failures_df["fecha"].astype(str) <= end_date
-        failures_df = failures_df[mask]
+    failures_df = engine.get_failures(start_date, end_date)
     return get_failures_detailed(df, failures_df)
 
 
@@ -681,25 +730,12 @@ def api_dimension_report_markdown(
 
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    failures_df = engine.get_failures()
-    referrals_df = engine.get_referrals()
+    failures_df = engine.get_failures(start_date, end_date)
+    referrals_df = engine.get_referrals(start_date, end_date)
     period = engine.get_data_period()
 
-    if start_date or end_date:
-        for frame_name in ("failures_df", "referrals_df"):
-            frame = failures_df if frame_name == "failures_df" else referrals_df
-            if frame is not None and not frame.empty and "fecha" in frame.columns:
-                mask = pd.Series(True, index=frame.index)
-                if start_date:
-                    mask &= frame["fecha"].astype(str) >= start_date
-                if end_date:
-                    mask &= frame["fecha"].astype(str) <= end_date
-                if frame_name == "failures_df":
-                    failures_df = frame[mask]
-                else:
-                    referrals_df = frame[mask]
-
-    report = get_dimension_report(df, referrals_df, failures_df, dimension, value)
+    report = get_dimension_report(df, referrals_df, failures_df, dimension, value,
+                                  thread_facts=engine.get_thread_facts(start_date, end_date))
     content = build_dimension_report_md(report, period)
 
     dim_label = "producto" if dimension == "product" else "categoria"
@@ -725,22 +761,9 @@ def api_dimension_report_csv(
 
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    failures_df = engine.get_failures()
-    referrals_df = engine.get_referrals()
-
-    if start_date or end_date:
-        for frame_name in ("failures_df", "referrals_df"):
-            frame = failures_df if frame_name == "failures_df" else referrals_df
-            if frame is not None and not frame.empty and "fecha" in frame.columns:
-                mask = pd.Series(True, index=frame.index)
-                if start_date:
-                    mask &= frame["fecha"].astype(str) >= start_date
-                if end_date:
-                    mask &= frame["fecha"].astype(str) <= end_date
-                if frame_name == "failures_df":
-                    failures_df = frame[mask]
-                else:
-                    referrals_df = frame[mask]
+    failures_df = engine.get_failures(start_date, end_date)
+    referrals_df = engine.get_referrals(start_date, end_date)
+    thread_facts = engine.get_thread_facts(start_date, end_date)
 
     # Use get_category_threads with the right filter
     if dimension == "product":
@@ -754,12 +777,14 @@ def api_dimension_report_csv(
             df, referrals_df, failures_df,
             product_macro=product_macro, product=value,
             page=1, limit=999999,
+            thread_facts=thread_facts,
         )
     else:
         threads_result = get_category_threads(
             df, referrals_df, failures_df,
             macro=value,
             page=1, limit=999999,
+            thread_facts=thread_facts,
         )
 
     csv_bytes = build_dimension_csv(threads_result.get("data", []))
@@ -787,15 +812,7 @@ def api_export_failures_questions_md(
 
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    failures_df = engine.get_failures()
-
-    if (start_date or end_date) and failures_df is not None and not failures_df.empty and "fecha" in failures_df.columns:
-        mask = pd.Series(True, index=failures_df.index)
-        if start_date:
-            mask &= failures_df["fecha"].astype(str) >= start_date
-        if end_date:
-            mask &= failures_df["fecha"].astype(str) <= end_date
-        failures_df = failures_df[mask]
+    failures_df = engine.get_failures(start_date, end_date)
 
     subcats = None
     product_threads = None
@@ -834,23 +851,8 @@ def api_export_failures_referrals_excel(
 
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    failures_df = engine.get_failures()
-    referrals_df = engine.get_referrals()
-
-    # Date filter
-    for frame_name in ("failures_df", "referrals_df"):
-        frame = failures_df if frame_name == "failures_df" else referrals_df
-        if frame is not None and not frame.empty and "fecha" in frame.columns:
-            if start_date or end_date:
-                mask = pd.Series(True, index=frame.index)
-                if start_date:
-                    mask &= frame["fecha"].astype(str) >= start_date
-                if end_date:
-                    mask &= frame["fecha"].astype(str) <= end_date
-                if frame_name == "failures_df":
-                    failures_df = frame[mask]
-                else:
-                    referrals_df = frame[mask]
+    failures_df = engine.get_failures(start_date, end_date)
+    referrals_df = engine.get_referrals(start_date, end_date)
 
     # Dimension filter
     subcats = None
@@ -0,0 +1,71 @@
+"""
+Row-position index of the messages frame behind the /api/messages explorer.
+
+The explorer used to copy the whole frame on every request and narrow it with
+one boolean mask per filter. The DataEngine now keeps, per data version:
+
+    values        column -> {value: sorted row positions} for the filterable
+                  columns (type, sentiment, categoria_yaml, macro_yaml, ...,
+                  survey_status)
+    thread_codes  thread number of every row (see DataEngine._build_thread_index)
+    non_empty     positions of the rows whose text is not blank
+
+A filter is a list of sorted position arrays; intersect() walks them smallest
+first, so a request only ever touches the rows it could return.
+"""
+import numpy as np
+import pandas as pd
+
+INDEXED_COLUMNS = ['type', 'sentiment', 'categoria_yaml', 'macro_yaml', 'product_yaml', 'product_type', 'intencion',
+                   'survey_status']
+
+
+def _value_positions(values):
+    """{value: sorted positions of the rows holding it}; missing values are left out."""
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')
+    order = order[int((codes < 0).sum()):]
+    ends = np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))
+    starts = np.concatenate(([0], ends[:-1])).astype(int)
+    return {value: order[start:end] for value, start, end in zip(uniques, starts, ends)}
+
+
+def build_message_index(df):
+    """Builds the index for df (see module docstring)."""
+    if df is None or df.empty:
+        return None
+    index = {
+        'size': len(df),
+        'values': {col: _value_positions(df[col]) for col in INDEXED_COLUMNS if col in df.columns},
+    }
+    if 'thread_id' in df.columns:
+        index['thread_codes'] = pd.factorize(df['thread_id'])[0]
+    if 'text' in df.columns:
+        text = df['text']
+        index['non_empty'] = np.flatnonzero((text.str.strip() != '').to_numpy(dtype=bool, na_value=True))
+    return index
+
+
+def value_positions(index, col, value):
+    """Sorted positions of the rows where col == value (empty when the value or column is missing)."""
+    return index['values'].get(col, {}).get(value, np.empty(0, dtype=np.intp))
+
+
+def intersect(position_sets):
+    """Intersection of sorted position arrays, walking them from the smallest."""
+    position_sets = sorted(position_sets, key=len)
+    result = position_sets[0]
+    for positions in position_sets[1:]:
+        if not len(result):
+            break
+        found = np.minimum(np.searchsorted(positions, result), len(positions) - 1)
+        result = result[positions[found] == result]
+    return result
+
+
+def in_threads_of(index, rows, candidates):
+    """Candidates that share a thread with some row of `rows`."""
+    codes = index['thread_codes']
+    marked = np.zeros(int(codes.max()) + 1 if len(codes) else 0, dtype=bool)
+    marked[codes[rows]] = True
+    return candidates[marked[codes[candidates]]]
@@ -1,5 +1,6 @@
 
 import pandas as pd
+from .thread_stats import value_counts
 
 def get_general_kpis(df: pd.DataFrame):
     """
@@ -24,7 +25,7 @@ def get_general_kpis(df: pd.DataFrame):
     
     # Messages by type
     if 'type' in df.columns:
-        messages_by_type = df['type'].value_counts().to_dict()
+        messages_by_type = value_counts(df['type']).to_dict()
     else:
         messages_by_type = {}
 
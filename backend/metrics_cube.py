@@ -0,0 +1,231 @@
+"""
+Pre-aggregated daily metrics cube behind the dashboard panels.
+
+/api/kpis, /api/analysis/temporal and /api/analysis/categorical used to
+recompute everything from the raw messages on each request. The engine now
+builds, once per data version, a few compact tables sorted by `fecha`:
+
+    cells     message / token counts per (fecha, hora, type, sentiment,
+              categoria_yaml, macro_yaml, product_type, product_yaml,
+              is_servilinea), with the position of the first message of the cell
+    threads   messages and human messages per (thread_id, fecha)
+    users     distinct (client_ip, fecha) pairs
+    trends    fecha and category of every categorized human message, in frame order
+
+A date range is a searchsorted slice of each table (a mask for `trends`) and
+every panel is a rollup of the slice. `first_pos` keeps value_counts ties in order of first
+appearance, so the rollups give exactly what the per-message code returns.
+"""
+import numpy as np
+import pandas as pd
+
+from .categorical import NOISE_MACROS, category_trends
+from .metrics import get_general_kpis
+
+CUBE_DIMENSIONS = ['fecha', 'hora', 'type', 'sentiment', 'categoria_yaml', 'macro_yaml',
+                   'product_type', 'product_yaml', 'is_servilinea']
+# Columns the rollups can't do without; older databases fall back to the raw path
+REQUIRED_COLUMNS = CUBE_DIMENSIONS + ['thread_id', 'input_tokens', 'output_tokens']
+DAY_NAMES = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+PRODUCT_NOISE = ['', 'ninguno', 'nan', 'none', 'desconocido']
+
+
+def build_cube(df):
+    """Builds the cube tables for df; None when df lacks the columns the rollups need."""
+    if df is None or df.empty or any(col not in df.columns for col in REQUIRED_COLUMNS):
+        return None
+    base = df[REQUIRED_COLUMNS + (['client_ip'] if 'client_ip' in df.columns else [])].assign(
+        pos=np.arange(len(df)), is_human=(df['type'] == 'human').astype(int)
+    )
+
+    cells = base.groupby(CUBE_DIMENSIONS, dropna=False, observed=True, sort=False).agg(
+        messages=('pos', 'size'),
+        input_tokens=('input_tokens', 'sum'),
+        output_tokens=('output_tokens', 'sum'),
+        first_pos=('pos', 'min'),
+    ).reset_index()
+
+    threads = base.groupby(['thread_id', 'fecha'], dropna=False, sort=False).agg(
+        messages=('pos', 'size'),
+        human_messages=('is_human', 'sum'),
+    ).reset_index()
+
+    if 'client_ip' in base.columns:
+        users = base.loc[base['client_ip'].notna(), ['client_ip', 'fecha']].drop_duplicates()
+    else:
+        users = None
+
+    human = base[(base['type'] == 'human') & base['categoria_yaml'].notna() & ~base['macro_yaml'].isin(NOISE_MACROS)]
+    trends = human[['fecha', 'categoria_yaml']]
+
+    return {
+        'cells': _sort_by_date(cells),
+        'threads': _sort_by_date(threads),
+        'users': _sort_by_date(users),
+        # Kept in frame order: trends need it and a mask over this column is cheap
+        'trends': trends.reset_index(drop=True),
+    }
+
+
+def _sort_by_date(frame):
+    if frame is None:
+        return None
+    return frame.sort_values('fecha', kind='stable', na_position='last').reset_index(drop=True)
+
+
+def _date_slice(frame, start_date=None, end_date=None):
+    """Rows of a fecha-sorted table with start_date <= fecha <= end_date."""
+    if frame is None or not (start_date or end_date):
+        return frame
+    dates = frame['fecha'].to_numpy()
+    lo = np.searchsorted(dates, np.datetime64(pd.to_datetime(start_date)), side='left') if start_date else 0
+    hi = (np.searchsorted(dates, np.datetime64(pd.to_datetime(end_date)), side='right') if end_date
+          else len(dates) - int(np.isnat(dates).sum()))
+    return frame.iloc[lo:hi]
+
+
+def _date_mask(frame, start_date=None, end_date=None):
+    """Same as _date_slice for a table that is not sorted by fecha."""
+    dates = frame['fecha']
+    mask = dates.notna()
+    if start_date:
+        mask &= dates >= pd.to_datetime(start_date)
+    if end_date:
+        mask &= dates <= pd.to_datetime(end_date)
+    return frame[mask]
+
+
+def slice_cube(cube, start_date=None, end_date=None):
+    """The cube restricted to a date range (both ends inclusive, missing dates left out)."""
+    if cube is None or not (start_date or end_date):
+        return cube
+    sliced = {name: _date_slice(cube[name], start_date, end_date) for name in ('cells', 'threads', 'users')}
+    sliced['trends'] = _date_mask(cube['trends'], start_date, end_date)
+    return sliced
+
+
+def _rolled_counts(cells, col):
+    """value_counts(col) over the messages behind `cells`: count desc, ties by first appearance."""
+    grouped = cells.groupby(col, observed=True, sort=False)
+    counts = grouped['messages'].sum().rename('count')
+    first_seen = grouped['first_pos'].min()
+    return counts[first_seen.sort_values().index].sort_values(ascending=False, kind='stable')
+
+
+def cube_kpis(cube):
+    """get_general_kpis() from the cube."""
+    cells, threads, users = cube['cells'], cube['threads'], cube['users']
+    if cells.empty:
+        return get_general_kpis(None)
+
+    per_thread = threads.groupby('thread_id', sort=False)[['messages', 'human_messages']].sum()
+    total_conversations = len(per_thread)
+    total_messages = int(cells['messages'].sum())
+    messages_by_type = _rolled_counts(cells, 'type').to_dict()
+
+    avg_messages_per_thread = total_messages / total_conversations if total_conversations > 0 else 0
+    median_messages_per_thread = float(per_thread['messages'].median())
+
+    if users is not None:
+        total_users = users['client_ip'].nunique()
+        avg_conversations_per_user = total_conversations / total_users if total_users > 0 else 0
+    else:
+        total_users = 0
+        avg_conversations_per_user = 0
+
+    ai_cells = cells[cells['type'] == 'ai']
+    ai_count = ai_cells['messages'].sum()
+    avg_input_tokens = ai_cells['input_tokens'].sum() / ai_count if ai_count > 0 else 0
+    avg_output_tokens = ai_cells['output_tokens'].sum() / ai_count if ai_count > 0 else 0
+
+    human_msgs_per_thread = per_thread.loc[per_thread['human_messages'] > 0, 'human_messages']
+    abandoned_threads = human_msgs_per_thread[human_msgs_per_thread <= 1].count()
+    abandonment_rate = (abandoned_threads / total_conversations) * 100 if total_conversations > 0 else 0
+    avg_human_messages = human_msgs_per_thread.mean() if not human_msgs_per_thread.empty else 0
+
+    return {
+        "total_conversations": int(total_conversations),
+        "total_messages": int(total_messages),
+        "messages_by_type": messages_by_type,
+        "avg_messages_per_thread": round(avg_messages_per_thread, 2),
+        "avg_human_messages_per_thread": round(avg_human_messages, 2),
+        "abandonment_rate": round(abandonment_rate, 2),
+        "median_messages_per_thread": round(median_messages_per_thread, 2),
+        "total_users": int(total_users),
+        "avg_conversations_per_user": round(avg_conversations_per_user, 2),
+        "total_input_tokens": int(cells['input_tokens'].sum()),
+        "total_output_tokens": int(cells['output_tokens'].sum()),
+        "avg_input_tokens_per_ai_msg": round(avg_input_tokens, 2),
+        "avg_output_tokens_per_ai_msg": round(avg_output_tokens, 2)
+    }
+
+
+def cube_temporal(cube):
+    """get_temporal_analysis() from the cube."""
+    cells = cube['cells']
+    if cells.empty:
+        return {"daily_volume": {}, "hourly_volume": {}, "day_of_week_volume": {}, "heatmap": []}
+
+    day_index = cells['fecha'].dt.dayofweek.rename('day_index')
+    heatmap_data = cells.groupby([day_index, 'hora'])['messages'].sum()
+    heatmap_list = [
+        {"day": DAY_NAMES[int(day)], "hour": int(hour), "count": int(count)}
+        for (day, hour), count in heatmap_data.items()
+    ]
+
+    daily_volume = cells.groupby(cells['fecha'].dt.date)['messages'].sum().to_dict()
+    daily_volume = {str(k): v for k, v in daily_volume.items()}
+
+    hourly_volume = cells.groupby('hora')['messages'].sum().to_dict()
+
+    dow_volume = _rolled_counts(cells.assign(day_name=cells['fecha'].dt.day_name()), 'day_name').to_dict()
+
+    return {
+        "daily_volume": daily_volume,
+        "hourly_volume": hourly_volume,
+        "day_of_week_volume": dow_volume,
+        "heatmap": heatmap_list
+    }
+
+
+def cube_categorical(cube):
+    """get_categorical_analysis() from the cube."""
+    cells, trend_rows = cube['cells'], cube['trends']
+    if cells.empty:
+        return {"top_intents": {}, "top_products": {}, "sentiment_distribution": {}, "sentiment_by_intent": {}}
+
+    cat_col = 'categoria_yaml'
+    human_cells = cells[
+        (cells['type'] == 'human') &
+        cells[cat_col].notna() &
+        ~cells['macro_yaml'].isin(NOISE_MACROS)
+    ]
+    intent_counts = _rolled_counts(human_cells, cat_col)
+    top_intents = intent_counts.head(20).to_dict()
+    top_macros = _rolled_counts(human_cells, 'macro_yaml').head(10).to_dict()
+
+    product_cells = cells[~cells['product_type'].str.lower().isin(PRODUCT_NOISE)]
+    top_products = _rolled_counts(product_cells, 'product_type').head(10).to_dict()
+
+    sentiment_dist = _rolled_counts(cells, 'sentiment').to_dict()
+
+    top_10_list = intent_counts.head(10).index
+    cross_cells = human_cells[human_cells[cat_col].isin(top_10_list)]
+    sentiment_x_intent = cross_cells.groupby([cat_col, 'sentiment'])['messages'].sum().unstack(fill_value=0)
+    sentiment_x_intent_data = sentiment_x_intent.to_dict(orient='index')
+
+    # Trends split the categorized human messages in two halves by position,
+    # which only the per-message rows can answer
+    winners, losers = category_trends(trend_rows[cat_col])
+
+    return {
+        "top_intents": top_intents,
+        "top_macros": top_macros,
+        "top_products": top_products,
+        "sentiment_distribution": sentiment_dist,
+        "sentiment_by_intent": sentiment_x_intent_data,
+        "trends": {
+            "winners": winners,
+            "losers": losers
+        }
+    }
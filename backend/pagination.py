@@ -0,0 +1,114 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+Offset pages (`page`, `limit`) re-filter and re-sort the whole result just
+to keep rows [start, end), and rows move between pages when the underlying
+set changes (a reviewed message leaving the HITL queue shifts every later
+page). The list endpoints also accept `cursor`: an opaque token holding the
+sort key of the last row returned, so the next page starts right after that
+row whatever happened before it. Every response carries `next_cursor`
+(None on the last page); `page` keeps working for existing clients.
+
+The sort key always ends with a unique column (rowid, table position), so
+the order is total and a cursor names exactly one place in it.
+"""
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+from fastapi import HTTPException
+
+
+def _plain(value):
+    if value is None or (not isinstance(value, (list, tuple, str)) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def encode_cursor(sort, key):
+    """Opaque cursor for the row with sort key `key` under the sort signature `sort`."""
+    payload = json.dumps({'s': sort, 'k': [_plain(v) for v in key]}, separators=(',', ':'), ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """Sort key stored in `cursor`; 400 if it is malformed or was issued for another sort."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        key, cursor_sort = payload['k'], payload['s']
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort:
+        raise HTTPException(status_code=400, detail="Cursor belongs to another filter or sort order")
+    return key
+
+
+def _present_count(values):
+    """Number of leading non-missing values (sorted keys put missing values last)."""
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pd.isna(values[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _tie_range(values, key, ascending):
+    """[lo, hi) of the rows equal to `key` in sorted `values`; missing values sort last."""
+    present = _present_count(values)
+    if key is None:
+        return present, len(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        key = np.datetime64(pd.Timestamp(key))
+    known = values[:present]
+    if ascending:
+        return int(np.searchsorted(known, key, side='left')), int(np.searchsorted(known, key, side='right'))
+    # Descending: search the reversed (ascending) view
+    flipped = known[::-1]
+    return (present - int(np.searchsorted(flipped, key, side='right')),
+            present - int(np.searchsorted(flipped, key, side='left')))
+
+
+def seek(key_columns, key, ascending):
+    """
+    Index of the first row strictly after `key` in rows sorted by key_columns
+    (list of arrays, compared in order, with the given directions). Binary
+    search on each component, within the rows tied on the previous ones.
+    """
+    lo, hi = 0, len(key_columns[0]) if key_columns else 0
+    for values, value, asc in zip(key_columns, key, ascending):
+        tie_lo, tie_hi = _tie_range(np.asarray(values)[lo:hi], value, asc)
+        lo, hi = lo + tie_lo, lo + tie_hi
+        if lo == hi:
+            break
+    # Rows after the cursor are one contiguous tail, starting after its ties
+    return hi
+
+
+def paginate_table(frame, page=1, limit=20, cursor=None, include_total=True):
+    """
+    Page of one of the engine's derived tables (referrals, failures) in table
+    order. Their index is the row position in the full table, which is the key.
+    """
+    labels = frame.index.to_numpy()
+    if cursor:
+        (last,) = decode_cursor(cursor, 'position')
+        start = int(np.searchsorted(labels, last, side='right'))
+    else:
+        start = (page - 1) * limit
+    end = start + limit
+    return {
+        "data": frame.iloc[start:end].to_dict(orient="records"),
+        "total": len(frame) if include_total else None,
+        "page": page,
+        "limit": limit,
+        "next_cursor": encode_cursor('position', [labels[end - 1]]) if 0 < end < len(frame) else None,
+    }
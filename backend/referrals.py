@@ -1,32 +1,79 @@
 import pandas as pd
 
-def detect_referrals(df: pd.DataFrame):
+# Channel -> keywords of a bot message that sends the user there
+REFERRAL_CHANNELS = {
+    "serviline": ["servilínea", "servilinea", "línea de atención", "linea de atencion", "llamar al", "marcar al"],
+    "digital": ["banca móvil", "banca movil", "banca virtual", "portal", "página web", "app bolívar", "descarga la app"],
+    "office": ["oficina", "sucursal", "punto físico"]
+}
+
+
+def referral_channel(texts):
+    """
+    Channel of each referral text: the first of REFERRAL_CHANNELS with a
+    keyword in it, 'other' when none (the priority the reports use).
+    """
+    channel = pd.Series('other', index=texts.index, dtype=object)
+    pending = pd.Series(True, index=texts.index)
+    for name, kws in REFERRAL_CHANNELS.items():
+        hit = pending & texts.str.contains('|'.join(kws), case=False, na=False, regex=True)
+        channel[hit] = name
+        pending &= ~hit
+    return channel
+
+
+def build_referral_index(df: pd.DataFrame):
+    """
+    Referral messages of df: the AI messages with a referral keyword, keeping
+    df's index labels, with thread_id, fecha, text and channel (referral_channel).
+    This is the one regex pass over the AI texts; the DataEngine keeps the
+    result per data version and detect_referrals / referral_threads reuse it
+    for any slice or filter of that frame.
+    """
+    if df.empty or 'text' not in df.columns:
+        return pd.DataFrame(columns=['thread_id', 'fecha', 'text', 'channel'])
+    cols = [c for c in ['thread_id', 'fecha', 'text', 'rowid'] if c in df.columns]
+    combined_regex = '|'.join(kw for kws in REFERRAL_CHANNELS.values() for kw in kws)
+    ai_mask = (df['type'] == 'ai') & df['text'].str.contains(combined_regex, case=False, na=False, regex=True)
+    messages = df.loc[ai_mask, cols].copy()
+    messages['channel'] = referral_channel(messages['text'])
+    return messages
+
+
+def _referral_messages(df, referral_index):
+    """Rows of the referral index that are messages of df (detected from df when no index is given)."""
+    if referral_index is None:
+        return build_referral_index(df)
+    return referral_index[referral_index.index.isin(df.index)]
+
+
+def referral_threads(df: pd.DataFrame, referral_index: pd.DataFrame = None):
+    """
+    Threads of df with a referral message in df, indexed by thread_id, with the
+    fecha and channel of their first one. referral_index: build_referral_index
+    of the frame df was sliced or filtered from (DataEngine.referral_index).
+    """
+    messages = _referral_messages(df, referral_index)
+    if 'rowid' in messages.columns:
+        messages = messages.sort_values('rowid')
+    first = messages.drop_duplicates(subset=['thread_id']).set_index('thread_id')
+    return first[[c for c in ['fecha', 'channel'] if c in first.columns]]
+
+
+def detect_referrals(df: pd.DataFrame, referral_index: pd.DataFrame = None):
     """
     Identifies conversations where the bot referred the user to Servílinea.
-    Vectorized version.
+    Vectorized version. referral_index: see referral_threads; the keyword
+    search runs over df when it is not given.
     """
     if df.empty:
         return pd.DataFrame()
 
-    # Keywords and Channels
-    referral_map = {
-        "serviline": ["servilínea", "servilinea", "línea de atención", "linea de atencion", "llamar al", "marcar al"],
-        "digital": ["banca móvil", "banca movil", "banca virtual", "portal", "página web", "app bolívar", "descarga la app"],
-        "office": ["oficina", "sucursal", "punto físico"]
-    }
-    
-    # Combined regex for initial filtering
-    all_keywords = [kw for channel in referral_map.values() for kw in channel]
-    combined_regex = '|'.join(all_keywords)
-    
-    # 1. Vectorized Filter: AI messages containing any keyword
-    ai_mask = (df['type'] == 'ai') & df['text'].str.contains(combined_regex, case=False, na=False, regex=True)
-    if not ai_mask.any():
+    # 1. Referral messages: AI messages containing any keyword
+    referral_msgs = _referral_messages(df, referral_index).drop(columns=['channel'])
+    if referral_msgs.empty:
         return pd.DataFrame()
-        
-    # Get all threads that have at least one referral message
-    referral_msgs = df[ai_mask].copy()
-    
+
     # Optimization: If we only need the thread_ids (as used by get_general_summary), 
     # we could stop early, but we'll maintain the full DataFrame return for compatibility.
     
@@ -39,7 +86,7 @@ def detect_referrals(df: pd.DataFrame):
     
     # Map channels vectorized
     first_referrals['channel'] = 'other'
-    for channel, kws in referral_map.items():
+    for channel, kws in REFERRAL_CHANNELS.items():
         channel_regex = '|'.join(kws)
         mask = first_referrals['text'].str.contains(channel_regex, case=False, na=False, regex=True)
         first_referrals.loc[mask, 'channel'] = channel
@@ -62,22 +109,10 @@ def detect_referrals(df: pd.DataFrame):
     
     result = meta_df.merge(thread_first_rows[['thread_id', 'categoria_yaml', 'intencion', 'product_type', 'sentiment']], on='thread_id', how='left')
     result.rename(columns={'categoria_yaml': 'intencion_ref', 'intencion': 'intencion_old'}, inplace=True)
-    result['intencion'] = result['intencion_ref'].fillna(result['intencion_old']).fillna('N/A')
+    result['intencion'] = result['intencion_ref'].astype(object).fillna(result['intencion_old'].astype(object)).fillna('N/A')
     
     # Dummy customer_request to avoid expensive context extraction (usually not used in bulk summary)
     result['customer_request'] = "Contexto simplificado"
     result['msg_count'] = 0 # Placeholder
     
     return result
-
-# Simple cache system
-_referrals_cache = None
-_last_df_len_ref = 0
-
-def get_referrals_cached(df: pd.DataFrame):
-    global _referrals_cache, _last_df_len_ref
-    if _referrals_cache is not None and len(df) == _last_df_len_ref:
-        return _referrals_cache
-    _referrals_cache = detect_referrals(df)
-    _last_df_len_ref = len(df)
-    return _referrals_cache
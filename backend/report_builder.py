@@ -12,11 +12,11 @@ Data is loaded via:
 """
 from __future__ import annotations
 
-import pandas as pd
 from collections import defaultdict
 from datetime import datetime
 
 from .report_helpers import N, pct, md_table, trunc, dict_to_table, hourly_to_shifts, split_criteria_counts
+from .thread_stats import value_counts
 from .engine import DataEngine
 from .metrics import get_general_kpis
 from .temporal import get_temporal_analysis
@@ -45,25 +45,11 @@ def load_report_data(
     """
     engine = DataEngine.get_instance()
     df = engine.get_messages(start_date, end_date)
-    failures_df = engine.get_failures()
-    referrals_df = engine.get_referrals()
+    failures_df = engine.get_failures(start_date, end_date)
+    referrals_df = engine.get_referrals(start_date, end_date)
+    thread_facts = engine.get_thread_facts(start_date, end_date)
     period = engine.get_data_period()
 
-    # Apply date filter to failures_df and referrals_df
-    if start_date or end_date:
-        for name in ("failures_df", "referrals_df"):
-            frame = failures_df if name == "failures_df" else referrals_df
-            if frame is not None and not frame.empty and "fecha" in frame.columns:
-                mask = pd.Series(True, index=frame.index)
-                if start_date:
-                    mask &= frame["fecha"].astype(str) >= start_date
-                if end_date:
-                    mask &= frame["fecha"].astype(str) <= end_date
-                if name == "failures_df":
-                    failures_df = frame[mask]
-                else:
-                    referrals_df = frame[mask]
-
     total_msgs = len(df)
     total_convs = df['thread_id'].nunique() if not df.empty else 0
 
@@ -71,7 +57,9 @@ def load_report_data(
     temporal = get_temporal_analysis(df)
     categorical = get_categorical_analysis(df)
     survey_stats = get_survey_stats(df)
-    funnel = get_extended_funnel(df)
+    detected_failures = engine.get_failure_threads(start_date, end_date)
+    funnel = get_extended_funnel(df, thread_facts=thread_facts, detected_failures=detected_failures,
+                                 referral_index=engine.referral_index)
     funnel_kpis = funnel.get("kpis", {})
     survey_util = get_survey_utility_analysis(df)
     volume_rpt = get_volume_report(df)
@@ -80,9 +68,10 @@ def load_report_data(
     faqs = get_faqs_by_category(df, top_n=top_n) if include_faqs else {}
 
     # Detailed data for the expanded brief report
-    kpis_detailed = get_kpis_detailed(df)
-    categories_detailed = get_categories_detailed(df, referrals_df, failures_df)
-    products_detailed = get_products_detailed(df, referrals_df, failures_df)
+    kpis_detailed = get_kpis_detailed(df, thread_facts=thread_facts, detected_failures=detected_failures,
+                                      referral_index=engine.referral_index)
+    categories_detailed = get_categories_detailed(df, referrals_df, failures_df, thread_facts=thread_facts)
+    products_detailed = get_products_detailed(df, referrals_df, failures_df, thread_facts=thread_facts)
     failures_detailed = get_failures_detailed(df, failures_df)
 
     return {
@@ -1089,7 +1078,7 @@ def _deep_referrals(data: dict) -> str:
             ch_df = referrals_df[referrals_df['channel'] == ch_key]
             if ch_df.empty:
                 continue
-            top_intents = ch_df['intencion'].value_counts().head(10)
+            top_intents = value_counts(ch_df['intencion']).head(10)
             if top_intents.empty:
                 continue
             rows = [[cat, N(cnt)] for cat, cnt in top_intents.items()]
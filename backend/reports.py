@@ -1,5 +1,8 @@
 import pandas as pd
 
+from .text_features import survey_statuses
+from .thread_stats import dominant_values
+
 def get_volume_report(df: pd.DataFrame):
     """
     Returns volume stats for human messages grouped by macro, category and product.
@@ -16,9 +19,10 @@ def get_volume_report(df: pd.DataFrame):
         if col not in human_df.columns:
             human_df[col] = "N/A"
     
-    human_df['macro_yaml'] = human_df['macro_yaml'].fillna('Sin Clasificar')
-    human_df['categoria_yaml'] = human_df['categoria_yaml'].fillna('Sin Categoría')
-    human_df['product_yaml'] = human_df['product_yaml'].fillna('N/A')
+    # Plain object columns: a category column cannot take the fill labels
+    human_df['macro_yaml'] = human_df['macro_yaml'].astype(object).fillna('Sin Clasificar')
+    human_df['categoria_yaml'] = human_df['categoria_yaml'].astype(object).fillna('Sin Categoría')
+    human_df['product_yaml'] = human_df['product_yaml'].astype(object).fillna('N/A')
     
     group_cols = ['macro_yaml', 'categoria_yaml', 'product_yaml']
     volumes = human_df.groupby(group_cols).size().reset_index(name='count')
@@ -39,24 +43,14 @@ def get_survey_utility_analysis(df: pd.DataFrame):
     if df is None or df.empty:
         return []
 
-    # 1. Identify survey messages and their result
+    # 1. Identify answered survey messages and their result (survey_status, set by the ETL)
     if 'text' not in df.columns:
         return []
-        
-    survey_mask = df['text'].str.contains(r'\[survey\]', case=False, na=False)
-    survey_df = df[survey_mask].copy()
-    
-    if survey_df.empty:
-        return []
-
-    def classify_survey(text):
-        text = str(text).lower()
-        if "no me fue útil" in text: return "not_useful"
-        if "me fue útil" in text: return "useful"
-        return "unknown"
 
-    survey_df['status'] = survey_df['text'].apply(classify_survey)
-    survey_df = survey_df[survey_df['status'] != "unknown"]
+    status = survey_statuses(df)
+    answered = status.isin(['useful', 'not_useful'])
+    survey_df = df[answered].copy()
+    survey_df['status'] = status[answered].astype(str)
 
     if survey_df.empty:
         return []
@@ -73,19 +67,14 @@ def get_survey_utility_analysis(df: pd.DataFrame):
         for col in ['categoria_yaml', 'macro_yaml', 'product_yaml']:
             if col not in relevant_df.columns:
                 relevant_df[col] = "N/A"
-            relevant_df[col] = relevant_df[col].fillna("N/A")
+            relevant_df[col] = relevant_df[col].astype(object).fillna("N/A")
 
-        grouped = relevant_df.groupby('thread_id')
-        for tid, group in grouped:
-            cat_mode = group['categoria_yaml'].mode()
-            macro_mode = group['macro_yaml'].mode()
-            prod_mode = group['product_yaml'].mode()
-            
-            thread_cats[tid] = {
-                "categoria": cat_mode.iloc[0] if not cat_mode.empty else "Sin Categoría",
-                "macro": macro_mode.iloc[0] if not macro_mode.empty else "Sin Clasificar",
-                "producto": prod_mode.iloc[0] if not prod_mode.empty else "N/A"
-            }
+        modes = pd.DataFrame({
+            'categoria': dominant_values(relevant_df, 'categoria_yaml')['value'],
+            'macro': dominant_values(relevant_df, 'macro_yaml')['value'],
+            'producto': dominant_values(relevant_df, 'product_yaml')['value'],
+        })
+        thread_cats = modes.to_dict(orient='index')
 
     # 3. Join survey status with thread categories
     results = []
@@ -4,8 +4,10 @@ import pandas as pd
 from .metrics import get_general_kpis
 from .dashboard_metrics import get_extended_funnel
 from .summary import get_survey_stats
-from .faqs import get_faqs_by_category
-from .referrals import detect_referrals
+from .faqs import get_faqs_by_category, _is_noise, _is_system_or_survey
+from .referrals import referral_channel
+from .thread_facts import build_thread_facts, thread_set
+from .thread_stats import dominant_values, value_counts
 
 
 # ---------------------------------------------------------------------------
@@ -19,14 +21,6 @@ GREETING_PREFIXES = sorted([
     "hey", "hi", "hello",
 ], key=len, reverse=True)
 
-REFERRAL_CHANNEL_KEYWORDS = {
-    "serviline": ["servilínea", "servilinea", "línea de atención",
-                   "linea de atencion", "llamar al", "marcar al"],
-    "digital": ["banca móvil", "banca movil", "banca virtual", "portal",
-                "página web", "app bolívar", "descarga la app"],
-    "office": ["oficina", "sucursal", "punto físico"],
-}
-
 
 def _strip_greeting_prefix(text: str) -> str:
     lower = text.lower().strip()
@@ -40,34 +34,39 @@ def _is_pure_greeting(text: str) -> bool:
     return len(_strip_greeting_prefix(text)) < 5
 
 
-def _compute_survey_sets(df: pd.DataFrame):
+_TEXT_FLAG_FALLBACKS = {
+    "is_noise": _is_noise,
+    "is_system_leak": _is_system_or_survey,
+    "is_pure_greeting": _is_pure_greeting,
+}
+
+
+def _text_flag(df: pd.DataFrame, col: str) -> pd.Series:
+    """Boolean text flag precomputed by the ETL, or its row-wise fallback."""
+    if col in df.columns:
+        return df[col]
+    return df["text"].apply(_TEXT_FLAG_FALLBACKS[col]).astype(bool)
+
+
+def _word_count(df: pd.DataFrame) -> pd.Series:
+    if "word_count" in df.columns:
+        return df["word_count"]
+    return df["text"].str.strip().str.split().str.len()
+
+
+def _compute_survey_sets(df: pd.DataFrame, thread_facts: pd.DataFrame = None):
     """Return sets of thread_ids classified as useful / not_useful."""
-    survey_mask = df["text"].str.contains(r"\[survey\]", case=False, na=False)
-    survey_df = df[survey_mask]
-    if survey_df.empty:
-        return set(), set()
-    not_useful_mask = survey_df["text"].str.contains("no me fue útil", case=False, na=False)
-    useful_mask = (
-        survey_df["text"].str.contains("me fue útil", case=False, na=False)
-        & ~not_useful_mask
-    )
-    return set(survey_df.loc[useful_mask, "thread_id"]), set(survey_df.loc[not_useful_mask, "thread_id"])
+    if thread_facts is None:
+        thread_facts = build_thread_facts(df)
+    return thread_set(thread_facts, "survey_useful"), thread_set(thread_facts, "survey_not_useful")
 
 
 def _build_referral_channel_map(referrals_df: pd.DataFrame) -> dict:
     """Map thread_id -> channel from referral_response text."""
     if referrals_df is None or referrals_df.empty:
         return {}
-    channel_map = {}
-    for _, row in referrals_df.iterrows():
-        txt = str(row.get("referral_response", "")).lower()
-        ch = "other"
-        for channel, kws in REFERRAL_CHANNEL_KEYWORDS.items():
-            if any(kw in txt for kw in kws):
-                ch = channel
-                break
-        channel_map[row["thread_id"]] = ch
-    return channel_map
+    channels = referral_channel(referrals_df["referral_response"])
+    return dict(zip(referrals_df["thread_id"], channels))
 
 
 # Categories that represent "user wants a human advisor"
@@ -111,8 +110,8 @@ def _enrich_subcategory(sub_name, sub_threads, hdf_with_pos,
     first_texts = hdf_with_pos[
         (hdf_with_pos["thread_id"].isin(sub_threads))
         & (hdf_with_pos[filter_col] == sub_name)
-    ].drop_duplicates("thread_id")["text"]
-    pure = int(first_texts.apply(_is_pure_greeting).sum())
+    ].drop_duplicates("thread_id")
+    pure = int(_text_flag(first_texts, "is_pure_greeting").sum())
 
     # 3. Redirections
     redirected = sub_threads & referral_threads
@@ -212,7 +211,9 @@ def _enrich_subcategory(sub_name, sub_threads, hdf_with_pos,
     }
 
 
-def get_kpis_detailed(df: pd.DataFrame, start_date: str = None, end_date: str = None) -> dict:
+def get_kpis_detailed(df: pd.DataFrame, start_date: str = None, end_date: str = None,
+                      thread_facts: pd.DataFrame = None, detected_failures: pd.DataFrame = None,
+                      referral_index: pd.DataFrame = None) -> dict:
     """
     Returns KPIs with methodology explanations and drill-down data.
     Extracts values from the metrics[] array produced by get_extended_funnel().
@@ -221,7 +222,9 @@ def get_kpis_detailed(df: pd.DataFrame, start_date: str = None, end_date: str =
         return {"kpis": {}, "funnel": {}, "surveys": {}, "methodology": {}}
 
     kpis = get_general_kpis(df)
-    funnel_data = get_extended_funnel(df, start_date, end_date)
+    # df arrives already sliced to the date range (DataEngine.get_messages)
+    funnel_data = get_extended_funnel(df, thread_facts=thread_facts, detected_failures=detected_failures,
+                                      referral_index=referral_index)
     surveys = get_survey_stats(df)
 
     # Build lookup from metrics array
@@ -306,7 +309,8 @@ def get_kpis_detailed(df: pd.DataFrame, start_date: str = None, end_date: str =
 
 def get_categories_detailed(df: pd.DataFrame,
                             referrals_df: pd.DataFrame = None,
-                            failures_df: pd.DataFrame = None) -> list:
+                            failures_df: pd.DataFrame = None,
+                            thread_facts: pd.DataFrame = None) -> list:
     """
     Returns macro -> subcategory -> product breakdown with user phrase examples
     and outcome metrics (intent position, redirections, utility, bot failures,
@@ -338,7 +342,7 @@ def get_categories_detailed(df: pd.DataFrame,
         if failures_df is not None and not failures_df.empty and "criteria" in failures_df.columns
         else {}
     )
-    survey_useful, survey_not_useful = _compute_survey_sets(df)
+    survey_useful, survey_not_useful = _compute_survey_sets(df, thread_facts)
 
     # Get FAQs (user phrases per subcategory)
     faqs = get_faqs_by_category(df, top_n=5)
@@ -393,7 +397,7 @@ def get_categories_detailed(df: pd.DataFrame,
             # Sentiments
             sent_counts = {"positivo": 0, "neutral": 0, "negativo": 0}
             if "sentiment" in sub_hdf.columns:
-                for s, cnt in sub_hdf["sentiment"].value_counts().items():
+                for s, cnt in value_counts(sub_hdf["sentiment"]).items():
                     if s in sent_counts:
                         sent_counts[s] = int(cnt)
 
@@ -439,7 +443,8 @@ def get_category_threads(df: pd.DataFrame,
                          limit: int = 20,
                          exclude_greetings: bool = False,
                          product_macro: str = None,
-                         failures_only: bool = False) -> dict:
+                         failures_only: bool = False,
+                         thread_facts: pd.DataFrame = None) -> dict:
     """
     Returns paginated thread list for a macro/subcategory/product combination
     with per-thread outcome indicators.
@@ -448,6 +453,7 @@ def get_category_threads(df: pd.DataFrame,
     AND this cross_category appear (underlying intent drill-down).
     product_macro: if set, filters by product_macro_yaml instead of macro_yaml.
     failures_only: if True, only returns threads that are in failures_df.
+    thread_facts: fact table of the threads in df (DataEngine.get_thread_facts).
     """
     if df is None or df.empty:
         return {"data": [], "total": 0, "page": page, "limit": limit}
@@ -481,7 +487,7 @@ def get_category_threads(df: pd.DataFrame,
 
     # Optional greeting exclusion
     if exclude_greetings:
-        filtered = filtered[~filtered["text"].apply(_is_pure_greeting)]
+        filtered = filtered[~_text_flag(filtered, "is_pure_greeting")]
 
     # Pre-compute outcome lookups
     referral_threads = set(referrals_df["thread_id"]) if referrals_df is not None and not referrals_df.empty else set()
@@ -512,29 +518,33 @@ def get_category_threads(df: pd.DataFrame,
         if failures_df is not None and not failures_df.empty and "last_user_message" in failures_df.columns
         else {}
     )
-    survey_useful, survey_not_useful = _compute_survey_sets(df)
+    survey_useful, survey_not_useful = _compute_survey_sets(df, thread_facts)
 
     # Get unique threads and first human message per thread
     thread_ids = filtered["thread_id"].unique()
     first_msgs = filtered.sort_index().drop_duplicates("thread_id")
 
+    # Per-thread lookups: first position of the category and message count (all types)
+    cat_filter = subcategory if subcategory else macro
+    col = "categoria_yaml" if subcategory else "macro_yaml"
+    cat_min_pos = hdf_sorted[hdf_sorted[col] == cat_filter].groupby("thread_id")["msg_pos"].min().to_dict()
+    if thread_facts is None:
+        thread_facts = build_thread_facts(df)
+    thread_sizes = thread_facts["messages"].to_dict()
+
     # Thread-level aggregation
     thread_data = []
     for _, row in first_msgs.iterrows():
         tid = row["thread_id"]
 
         # Intent position for this thread
-        thread_pos = hdf_sorted[hdf_sorted["thread_id"] == tid]
-        cat_filter = subcategory if subcategory else macro
-        col = "categoria_yaml" if subcategory else "macro_yaml"
-        cat_msgs = thread_pos[thread_pos[col] == cat_filter]
-        min_pos = int(cat_msgs["msg_pos"].min()) if not cat_msgs.empty else 0
+        min_pos = int(cat_min_pos.get(tid, 0))
         intent_pos = "first_intent" if min_pos <= 2 else "post_consultation"
 
-        # Thread message count (all types)
-        msg_count = int(df[df["thread_id"] == tid].shape[0])
+        msg_count = int(thread_sizes.get(tid, 0))
 
         prod_col = "product_yaml" if "product_yaml" in row.index else "product_type"
+        product = row.get(prod_col, "")
         fecha = row.get("fecha", "")
         if pd.notna(fecha) and hasattr(fecha, "strftime"):
             fecha = fecha.strftime("%Y-%m-%d")
@@ -546,7 +556,7 @@ def get_category_threads(df: pd.DataFrame,
             "first_human_message": str(row.get("text", ""))[:300],
             "message_count": msg_count,
             "intent_position": intent_pos,
-            "product": str(row.get(prod_col, "") or ""),
+            "product": str(product) if pd.notna(product) and product else "",
             "sentiment": str(row.get("sentiment", "neutral")),
             "fecha": fecha,
             "was_redirected": tid in referral_threads,
@@ -586,7 +596,7 @@ def get_failures_detailed(df: pd.DataFrame, failures_df: pd.DataFrame) -> dict:
         return {"total": 0, "total_conversations": 0, "criteria_global": {}, "by_category": []}
 
     total_failures = len(failures_df)
-    cat_counts = failures_df["intencion"].value_counts()
+    cat_counts = value_counts(failures_df["intencion"])
     total_convs = df["thread_id"].nunique() if df is not None and not df.empty else 0
 
     # Global criteria totals
@@ -602,11 +612,7 @@ def get_failures_detailed(df: pd.DataFrame, failures_df: pd.DataFrame) -> dict:
     if df is not None and not df.empty and "product_yaml" in df.columns:
         prod_df = df[df["product_yaml"].notna() & (df["product_yaml"] != "")]
         if not prod_df.empty:
-            thread_product = (
-                prod_df.groupby("thread_id")["product_yaml"]
-                .agg(lambda x: x.mode().iloc[0] if len(x.mode()) > 0 else "")
-                .to_dict()
-            )
+            thread_product = dominant_values(prod_df, "product_yaml")["value"].to_dict()
 
     by_category = []
     for cat, count in cat_counts.items():
@@ -699,7 +705,8 @@ SKIP_PRODUCTS = {"Ninguno", "General", "", None}
 
 def get_products_detailed(df: pd.DataFrame,
                           referrals_df: pd.DataFrame = None,
-                          failures_df: pd.DataFrame = None) -> list:
+                          failures_df: pd.DataFrame = None,
+                          thread_facts: pd.DataFrame = None) -> list:
     """
     Returns product_macro -> product -> category breakdown with outcome metrics.
     Mirror of get_categories_detailed but with products as primary axis.
@@ -735,7 +742,7 @@ def get_products_detailed(df: pd.DataFrame,
         if failures_df is not None and not failures_df.empty and "criteria" in failures_df.columns
         else {}
     )
-    survey_useful, survey_not_useful = _compute_survey_sets(df)
+    survey_useful, survey_not_useful = _compute_survey_sets(df, thread_facts)
 
     total_h_convs = hdf_prod["thread_id"].nunique()
 
@@ -787,15 +794,14 @@ def get_products_detailed(df: pd.DataFrame,
             # Sentiments
             sent_counts = {"positivo": 0, "neutral": 0, "negativo": 0}
             if "sentiment" in prod_hdf.columns:
-                for s, cnt in prod_hdf["sentiment"].value_counts().items():
+                for s, cnt in value_counts(prod_hdf["sentiment"]).items():
                     if s in sent_counts:
                         sent_counts[s] = int(cnt)
 
             # User phrases — top 5 most frequent human messages for this product
             phrase_df = prod_hdf[prod_hdf["text"].str.strip().str.len() >= 4]
-            from .faqs import _is_noise, _is_system_or_survey
-            phrase_df = phrase_df[~phrase_df["text"].apply(_is_noise)]
-            phrase_df = phrase_df[~phrase_df["text"].apply(_is_system_or_survey)]
+            phrase_df = phrase_df[~_text_flag(phrase_df, "is_noise")]
+            phrase_df = phrase_df[~_text_flag(phrase_df, "is_system_leak")]
             phrase_counts = (
                 phrase_df["text"].str.strip()
                 .value_counts()
@@ -843,7 +849,8 @@ def get_dimension_report(df: pd.DataFrame,
                          referrals_df: pd.DataFrame = None,
                          failures_df: pd.DataFrame = None,
                          dimension: str = "product",
-                         value: str = "") -> dict:
+                         value: str = "",
+                         thread_facts: pd.DataFrame = None) -> dict:
     """
     Build a comprehensive report for a single product (product_yaml) or
     macro-category (macro_yaml).
@@ -899,7 +906,7 @@ def get_dimension_report(df: pd.DataFrame,
         if failures_df is not None and not failures_df.empty and "criteria" in failures_df.columns
         else {}
     )
-    survey_useful, survey_not_useful = _compute_survey_sets(df)
+    survey_useful, survey_not_useful = _compute_survey_sets(df, thread_facts)
 
     # --- KPIs ---
     surveyed_threads = dim_threads & (survey_useful | survey_not_useful)
@@ -974,21 +981,20 @@ def get_dimension_report(df: pd.DataFrame,
     # --- Sentiments ---
     sent_counts = {"positivo": 0, "neutral": 0, "negativo": 0}
     if "sentiment" in filtered.columns:
-        for s, cnt in filtered["sentiment"].value_counts().items():
+        for s, cnt in value_counts(filtered["sentiment"]).items():
             if s in sent_counts:
                 sent_counts[s] = int(cnt)
 
     # --- User phrases ---
-    from .faqs import _is_noise, _is_system_or_survey
     phrase_df = filtered[filtered["text"].str.strip().str.len() >= 4]
-    phrase_df = phrase_df[~phrase_df["text"].apply(_is_noise)]
-    phrase_df = phrase_df[~phrase_df["text"].apply(_is_system_or_survey)]
+    phrase_df = phrase_df[~_text_flag(phrase_df, "is_noise")]
+    phrase_df = phrase_df[~_text_flag(phrase_df, "is_system_leak")]
     phrase_text = phrase_df["text"].str.strip()
     phrase_counts = phrase_text.value_counts().head(10)
     user_phrases = [{"phrase": str(p), "count": int(c)} for p, c in phrase_counts.items()]
 
     # --- Real user questions (longer phrases showing actual pain points) ---
-    questions_df = phrase_df[phrase_df["text"].str.strip().str.split().str.len() >= 4]
+    questions_df = phrase_df[_word_count(phrase_df) >= 4]
     question_counts = questions_df["text"].str.strip().value_counts().head(15)
     user_questions = [{"phrase": str(p), "count": int(c)} for p, c in question_counts.items()]
 
@@ -1012,10 +1018,10 @@ def get_dimension_report(df: pd.DataFrame,
             # Sub: user questions (>= 3 words, no noise/system)
             sub_phrase_df = sub_filtered[
                 (sub_filtered["text"].str.strip().str.len() >= 4)
-                & (~sub_filtered["text"].apply(_is_noise))
-                & (~sub_filtered["text"].apply(_is_system_or_survey))
+                & (~_text_flag(sub_filtered, "is_noise"))
+                & (~_text_flag(sub_filtered, "is_system_leak"))
             ]
-            sub_q_df = sub_phrase_df[sub_phrase_df["text"].str.strip().str.split().str.len() >= 3]
+            sub_q_df = sub_phrase_df[_word_count(sub_phrase_df) >= 3]
             sub_q_text = sub_q_df["text"].str.strip()
             sub_q_counts = sub_q_text.value_counts().head(10)
             sub_questions = [{"phrase": str(p), "count": int(c)} for p, c in sub_q_counts.items()]
@@ -1030,9 +1036,9 @@ def get_dimension_report(df: pd.DataFrame,
             if sub_fail_threads:
                 sub_fail_msgs = sub_filtered[sub_filtered["thread_id"].isin(sub_fail_threads)]
                 sub_fail_msgs = sub_fail_msgs[sub_fail_msgs["text"].str.strip().str.len() >= 4]
-                sub_fail_msgs = sub_fail_msgs[~sub_fail_msgs["text"].apply(_is_system_or_survey)]
-                sub_fail_msgs = sub_fail_msgs[~sub_fail_msgs["text"].apply(_is_noise)]
-                sub_fail_msgs = sub_fail_msgs[sub_fail_msgs["text"].str.strip().str.split().str.len() >= 3]
+                sub_fail_msgs = sub_fail_msgs[~_text_flag(sub_fail_msgs, "is_system_leak")]
+                sub_fail_msgs = sub_fail_msgs[~_text_flag(sub_fail_msgs, "is_noise")]
+                sub_fail_msgs = sub_fail_msgs[_word_count(sub_fail_msgs) >= 3]
                 sub_unanswered_counts = sub_fail_msgs["text"].str.strip().value_counts().head(10)
                 sub_unanswered = [{"phrase": str(p), "count": int(c)} for p, c in sub_unanswered_counts.items()]
 
@@ -1052,9 +1058,9 @@ def get_dimension_report(df: pd.DataFrame,
         dim_fail_threads = dim_threads & failure_threads
         fail_msgs = filtered[filtered["thread_id"].isin(dim_fail_threads)].copy()
         fail_msgs = fail_msgs[fail_msgs["text"].str.strip().str.len() >= 4]
-        fail_msgs = fail_msgs[~fail_msgs["text"].apply(_is_system_or_survey)]
-        fail_msgs = fail_msgs[~fail_msgs["text"].apply(_is_noise)]
-        fail_msgs = fail_msgs[fail_msgs["text"].str.strip().str.split().str.len() >= 3]
+        fail_msgs = fail_msgs[~_text_flag(fail_msgs, "is_system_leak")]
+        fail_msgs = fail_msgs[~_text_flag(fail_msgs, "is_noise")]
+        fail_msgs = fail_msgs[_word_count(fail_msgs) >= 3]
         fail_phrase_counts = fail_msgs["text"].str.strip().value_counts().head(50)
         unanswered_questions = [
             {"phrase": str(p), "count": int(c)} for p, c in fail_phrase_counts.items()
@@ -1089,16 +1095,16 @@ def get_dimension_report(df: pd.DataFrame,
 
     # --- Sample threads (most recent 50, with first substantive message) ---
     # For each thread, find the first human message that isn't noise/greeting
-    substantive = filtered[~filtered["text"].apply(_is_noise) & ~filtered["text"].apply(_is_system_or_survey)]
+    substantive = filtered[~_text_flag(filtered, "is_noise") & ~_text_flag(filtered, "is_system_leak")]
     # Fallback to any message if all are noise
+    first_substantive = substantive.drop_duplicates("thread_id").set_index("thread_id")["text"].to_dict()
+    first_any = filtered.drop_duplicates("thread_id").set_index("thread_id")["text"].to_dict()
     first_msg_map = {}
     for tid in dim_threads:
-        t_msgs = substantive[substantive["thread_id"] == tid]
-        if not t_msgs.empty:
-            first_msg_map[tid] = str(t_msgs.iloc[0]["text"])[:200]
+        if tid in first_substantive:
+            first_msg_map[tid] = str(first_substantive[tid])[:200]
         else:
-            t_all = filtered[filtered["thread_id"] == tid]
-            first_msg_map[tid] = str(t_all.iloc[0]["text"])[:200] if not t_all.empty else ""
+            first_msg_map[tid] = str(first_any[tid])[:200] if tid in first_any else ""
 
     sample_data = filtered.sort_values("fecha", ascending=False).drop_duplicates("thread_id").head(50)
     sample_threads = []
@@ -0,0 +1,162 @@
+"""
+In-process cache of analytics responses.
+
+The dashboard tabs request the same endpoints with the same parameters over
+and over, and each request recomputed its answer from the messages. Results
+are now kept in a size-bounded LRU keyed by
+
+    (endpoint, normalized params, data version, YAML rules version)
+
+The data version comes from the DataEngine, which bumps it and clears the
+cache when it reloads or applies a HITL correction; the rules version is the
+hash of categorias.yml / productos.yml (see keyword_matcher.file_hash), so
+editing the taxonomy also misses. A request that started before an
+invalidation stores its result under the old version, where nothing reads it.
+
+The same versions give each GET response a strong ETag, so a client that
+already has the payload gets a 304 before any pandas work runs.
+"""
+import functools
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from .keyword_matcher import file_hash
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+RULES_FILES = [os.path.join(BASE_DIR, "categorias.yml"), os.path.join(BASE_DIR, "productos.yml")]
+# Entries kept before the least recently used is evicted
+MAX_ENTRIES = 256
+# Orderings of list endpoints (one position array per filter signature) are bigger: keep fewer
+ORDERING_ENTRIES = 16
+# Data versions restart at each process start: ETags also carry the process
+PROCESS_TOKEN = uuid.uuid4().hex
+
+
+def _normalize(value):
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted((_normalize(v) for v in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    return value
+
+
+def normalize_params(params):
+    """Hashable, argument-order independent form of a params dict."""
+    return tuple(sorted((k, _normalize(v)) for k, v in params.items()))
+
+
+# path -> ((mtime_ns, size), sha1): a file is only re-hashed when it changes on disk
+_rules_hashes = {}
+
+
+def _rules_hash(path):
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return ""
+    cached = _rules_hashes.get(path)
+    if cached is None or cached[0] != stamp:
+        cached = _rules_hashes[path] = (stamp, file_hash(path))
+    return cached[1]
+
+
+def rules_version():
+    return tuple(_rules_hash(path) for path in RULES_FILES)
+
+
+class ResponseCache:
+    """Thread-safe LRU of computed results with hit/miss counters."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.data_version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, endpoint, params, compute):
+        """Cached result of compute() for (endpoint, params) at the current data and rules versions."""
+        key = (endpoint, normalize_params(params), self.data_version, rules_version())
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        result = compute()
+
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def invalidate(self, data_version):
+        """Drops every entry; results computed for older versions are never served again."""
+        with self._lock:
+            self.data_version = data_version
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "data_version": self.data_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+response_cache = ResponseCache()
+# Sorted matches of the list endpoints per filter signature (see pagination)
+ordering_cache = ResponseCache(max_entries=ORDERING_ENTRIES)
+
+
+def invalidate_caches(data_version):
+    """Called by the DataEngine when the data in memory changes."""
+    response_cache.invalidate(data_version)
+    ordering_cache.invalidate(data_version)
+
+
+def response_etag(endpoint, params):
+    """
+    Strong ETag of the response to (endpoint, params) for the data and rules
+    in memory now: it changes exactly when the cache key would.
+    """
+    key = repr((PROCESS_TOKEN, endpoint, normalize_params(params), response_cache.data_version, rules_version()))
+    return '"' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check (weak comparison, as RFC 9110 asks for GET)."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def cached_response(endpoint):
+    """
+    Decorator for read-only GET handlers: the result is served from
+    response_cache for the same query parameters. Handlers must be called
+    with keyword arguments (FastAPI does) and must not mutate what they return.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(**kwargs):
+            return response_cache.get_or_compute(endpoint, kwargs, lambda: fn(**kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,135 @@
+"""
+Full-text search over the message texts (SQLite FTS5) for the explorer.
+
+`search` in /api/messages used to run a case-insensitive regex over every
+text of the frame: it missed accent variants ("credito" / "crédito") and
+grew with the dataset. The ETL now keeps `messages_fts`, an FTS5 index over
+messages.text with the unicode61 tokenizer removing diacritics (rebuilt by a
+full run, updated for the touched threads by an incremental one), and the
+engine creates it on databases built before it existed.
+
+Query syntax (see to_match_expression):
+
+    credito tarjeta     every term, in any order
+    "tarjeta de credito" the exact phrase
+    tarj*               prefix; the last bare term is always a prefix, so
+                        results follow the user while typing
+
+Without FTS5 in the local SQLite build search falls back to the old scan, and
+so does a search that reaches a database swapped in by an ETL before the
+engine reloaded (its rowids name other messages; see DataEngine.build_id).
+"""
+import re
+import sqlite3
+
+SEARCH_TABLE = 'messages_fts'
+SEARCH_DDL = (
+    f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+    "text, content='messages', content_rowid='rowid', "
+    "tokenize='unicode61 remove_diacritics 2')"
+)
+SNIPPET_MARKS = ('<mark>', '</mark>')
+SNIPPET_ELLIPSIS = '…'
+SNIPPET_TOKENS = 12
+_QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+_WORD = re.compile(r'\w+')
+
+
+def _has_fts5():
+    try:
+        sqlite3.connect(':memory:').execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        return True
+    except sqlite3.Error:
+        return False
+
+
+HAS_FTS5 = _has_fts5()
+
+
+def search_index_exists(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,)
+    ).fetchone() is not None
+
+
+def build_search_index(conn):
+    """(Re)builds messages_fts from the messages table. Returns False without FTS5."""
+    if not HAS_FTS5:
+        return False
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+        conn.execute(SEARCH_DDL)
+        conn.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES('rebuild')")
+    return True
+
+
+def remove_from_search_index(conn, where):
+    """
+    Drops the messages matching the SQL condition `where` from messages_fts;
+    run it before they change. Returns False when there is no index to update.
+    """
+    if not HAS_FTS5 or not search_index_exists(conn):
+        return False
+    conn.execute(
+        f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, text) "
+        f"SELECT 'delete', rowid, text FROM messages WHERE {where}"
+    )
+    return True
+
+
+def add_to_search_index(conn, where):
+    """Indexes the messages matching `where` (see remove_from_search_index)."""
+    conn.execute(f"INSERT INTO {SEARCH_TABLE}(rowid, text) SELECT rowid, text FROM messages WHERE {where}")
+
+
+def ensure_search_index(conn):
+    """Builds messages_fts on databases that predate it. True when the index is usable."""
+    if not HAS_FTS5:
+        return False
+    if search_index_exists(conn):
+        return True
+    print("Search index not found in DB. Building...")
+    return build_search_index(conn)
+
+
+def to_match_expression(search):
+    """
+    FTS5 MATCH expression for a user query; None if it has no searchable words.
+    Every term is quoted, so FTS5 operators typed by the user are plain words.
+    """
+    parts = []
+    for phrase, term in _QUERY_TOKEN.findall(search or ''):
+        words = _WORD.findall(phrase or term)
+        if words:
+            parts.append(['"' + ' '.join(words) + '"', term.endswith('*'), bool(phrase)])
+    if not parts:
+        return None
+    if not parts[-1][2]:
+        # Search as you type: the last bare term also matches longer words
+        parts[-1][1] = True
+    return ' '.join(quoted + ('*' if prefix else '') for quoted, prefix, _ in parts)
+
+
+def search_rowids(conn, search):
+    """messages rowids whose text matches `search`, ascending."""
+    expression = to_match_expression(search)
+    if expression is None:
+        return []
+    rows = conn.execute(
+        f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH ? ORDER BY rowid", (expression,)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+def search_snippets(conn, search, rowids):
+    """{rowid: text fragment around the matches, matches wrapped in <mark>} for some rowids."""
+    expression = to_match_expression(search)
+    if expression is None or not rowids:
+        return {}
+    placeholders = ', '.join('?' * len(rowids))
+    rows = conn.execute(
+        f"SELECT rowid, snippet({SEARCH_TABLE}, 0, ?, ?, ?, ?) FROM {SEARCH_TABLE} "
+        f"WHERE {SEARCH_TABLE} MATCH ? AND rowid IN ({placeholders})",
+        (*SNIPPET_MARKS, SNIPPET_ELLIPSIS, SNIPPET_TOKENS, expression, *rowids),
+    ).fetchall()
+    return dict(rows)
@@ -0,0 +1,111 @@
+"""
+Columnar snapshot of the in-memory messages frame for fast DataEngine startup.
+
+Loading from SQLite means read_sql over every row, re-parsing `fecha`, filling
+NaNs and recomputing the per-thread metadata. The ETL (and any load that had
+to go through SQLite) also writes the prepared frame as Arrow IPC files:
+
+    messages.arrow   DataEngine.df exactly as prepare_messages leaves it
+    threads.arrow    thread fact table (thread_facts.build_thread_facts)
+
+The snapshot is keyed by the ETL build id and the last HITL correction rowid
+of the database it was taken from; any mismatch means it is stale and the
+loader falls back to SQLite (then rewrites it). pyarrow is optional: without
+it every load goes through SQLite as before.
+"""
+import json
+import os
+
+from .thread_facts import build_thread_facts
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401  (registers pa.ipc)
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "snapshot")
+MESSAGES_SNAPSHOT = os.path.join(SNAPSHOT_DIR, "messages.arrow")
+THREADS_SNAPSHOT = os.path.join(SNAPSHOT_DIR, "threads.arrow")
+# Bump when the layout of the snapshot files changes
+SNAPSHOT_FORMAT = '4'
+_KEY_FIELD = b'snapshot_key'
+
+
+def snapshot_key(conn):
+    """
+    Identity of the data in the database behind `conn`: ETL build id, last HITL
+    correction and snapshot format. None when the database predates build ids.
+    """
+    try:
+        row = conn.execute("SELECT value FROM etl_metadata WHERE key = 'build_id'").fetchone()
+    except Exception:
+        return None
+    if not row or not row[0]:
+        return None
+    try:
+        hitl_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM hitl_corrections").fetchone()[0]
+    except Exception:
+        hitl_rowid = 0
+    return {'format': SNAPSHOT_FORMAT, 'build_id': row[0], 'hitl_rowid': int(hitl_rowid)}
+
+
+def _write_table(frame, path, key):
+    table = pa.Table.from_pandas(frame, preserve_index=True)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), _KEY_FIELD: json.dumps(key).encode()})
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def _read_table(path, key):
+    """Memory-maps an Arrow IPC file; None if it is missing or was written for another key."""
+    if not os.path.exists(path):
+        return None
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    stored = (table.schema.metadata or {}).get(_KEY_FIELD)
+    if stored is None or json.loads(stored) != key:
+        return None
+    frame = table.to_pandas()
+    # Arrow has no object type: text columns that held None come back as str
+    object_cols = [c['name'] for c in table.schema.pandas_metadata['columns']
+                   if c['numpy_type'] == 'object' and c['name'] in frame.columns]
+    for col in object_cols:
+        frame[col] = frame[col].astype(object).where(frame[col].notna(), None)
+    return frame
+
+
+def write_snapshot(df, key, meta=None):
+    """Writes df and its thread fact table for `key`. Returns False when not possible."""
+    if not HAS_PYARROW or key is None:
+        return False
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    try:
+        _write_table(df, MESSAGES_SNAPSHOT, key)
+        _write_table(meta if meta is not None else build_thread_facts(df), THREADS_SNAPSHOT, key)
+    except Exception as e:
+        print(f"Could not write columnar snapshot: {e}")
+        return False
+    return True
+
+
+def read_snapshot(key):
+    """
+    Returns (df, thread_facts) from the snapshot taken for `key`, or None when
+    it is missing, stale or unreadable.
+    """
+    if not HAS_PYARROW or key is None:
+        return None
+    try:
+        df = _read_table(MESSAGES_SNAPSHOT, key)
+        meta = _read_table(THREADS_SNAPSHOT, key) if df is not None else None
+    except Exception as e:
+        print(f"Could not read columnar snapshot: {e}")
+        return None
+    if df is None or meta is None:
+        return None
+    return df, meta
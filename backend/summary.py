@@ -1,10 +1,21 @@
+import numpy as np
 import pandas as pd
-from .referrals import detect_referrals
+from .pagination import encode_cursor, decode_cursor, seek
+from .referrals import referral_threads
+from .text_features import survey_statuses, NO_SURVEY
+from .thread_facts import build_thread_facts, thread_set
 
-def get_general_summary(df: pd.DataFrame, start_date: str = None, end_date: str = None):
+# Sort signature of the uncategorized threads list (see pagination)
+UNCATEGORIZED_SORT = 'first_fecha:desc,thread_id'
+
+def get_general_summary(df: pd.DataFrame, start_date: str = None, end_date: str = None, thread_facts: pd.DataFrame = None,
+                        referral_index: pd.DataFrame = None):
     """
     ULTRA-OPTIMIZED and THREAD-SAFE version of get_general_summary.
     Uses external series for aggregation to avoid modifying the shared singleton 'df'.
+    thread_facts: fact table of the threads in df (DataEngine.get_thread_facts);
+    built from df when not given or when a date filter is applied here.
+    referral_index: DataEngine.referral_index (see referrals.referral_threads).
     """
     if df.empty:
         return []
@@ -19,20 +30,20 @@ def get_general_summary(df: pd.DataFrame, start_date: str = None, end_date: str
 
     if df.empty:
         return []
+    if thread_facts is None or start_date or end_date:
+        thread_facts = build_thread_facts(df)
 
     # 1. Determine Thread Metadata (Category, Intention, Product)
     has_yaml = 'categoria_yaml' in df.columns and 'macro_yaml' in df.columns
     
     if has_yaml:
-        human_msgs = df[(df['type'] == 'human') & (df['categoria_yaml'].notna())]
-        if not human_msgs.empty:
-            thread_meta = human_msgs.drop_duplicates(subset=['thread_id'])[['thread_id', 'macro_yaml', 'categoria_yaml']].copy()
-            thread_meta.rename(columns={'macro_yaml': 'category', 'categoria_yaml': 'intention'}, inplace=True)
-            
-            prod_col = 'product_yaml' if 'product_yaml' in human_msgs.columns else 'product_type'
-            if prod_col in human_msgs.columns:
-                prod_meta = human_msgs[human_msgs[prod_col].notna()].drop_duplicates(subset=['thread_id'])[['thread_id', prod_col]]
-                thread_meta = thread_meta.merge(prod_meta.rename(columns={prod_col: 'product'}), on='thread_id', how='left')
+        # First categorized human message of each thread (and first product among them)
+        categorized = thread_facts[thread_facts['first_category'].notna()]
+        if not categorized.empty:
+            thread_meta = categorized[['first_macro', 'first_category']].rename_axis('thread_id').reset_index()
+            thread_meta.rename(columns={'first_macro': 'category', 'first_category': 'intention'}, inplace=True)
+            if 'first_product' in categorized.columns:
+                thread_meta['product'] = categorized['first_product'].reset_index(drop=True)
             else:
                 thread_meta['product'] = 'N/A'
         else:
@@ -73,13 +84,12 @@ def get_general_summary(df: pd.DataFrame, start_date: str = None, end_date: str
     stats_df['total_interactions'] = 1 # Each row is an interaction
 
     # 4. Referrals (Thread-level)
-    referrals_df = detect_referrals(df)
-    ref_threads = set() if referrals_df.empty else set(referrals_df['thread_id'].unique())
+    ref_threads = set(referral_threads(df, referral_index).index)
     
     thread_level = thread_meta.copy() if not thread_meta.empty else pd.DataFrame(columns=['thread_id', 'category', 'intention', 'product'])
     
     # If some threads are missing in thread_meta (uncategorized), we add them
-    all_threads = df['thread_id'].unique()
+    all_threads = thread_facts.index
     missing_threads = set(all_threads) - set(thread_level['thread_id'])
     if missing_threads:
         missing_df = pd.DataFrame({
@@ -122,42 +132,57 @@ def get_general_summary(df: pd.DataFrame, start_date: str = None, end_date: str
     
     return final_df.to_dict(orient='records')
 
-def get_uncategorized_threads(df: pd.DataFrame, page: int = 1, limit: int = 20, start_date: str = None, end_date: str = None):
-    if df.empty: return {"data": [], "total": 0, "stats": {"servilinea": 0, "empty_msgs": 0}}
+def get_uncategorized_threads(df: pd.DataFrame, page: int = 1, limit: int = 20, start_date: str = None, end_date: str = None, thread_facts: pd.DataFrame = None,
+                              cursor: str = None, include_total: bool = True, referral_index: pd.DataFrame = None):
+    """
+    Threads without any category, newest first (ties by thread_id), one page
+    at a time: `page` or the `next_cursor` of the previous page.
+    referral_index: DataEngine.referral_index (see referrals.referral_threads).
+    """
+    if df.empty: return {"data": [], "total": 0, "stats": {"servilinea": 0, "empty_msgs": 0}, "next_cursor": None}
     if start_date or end_date:
         if 'fecha' in df.columns:
             mask = pd.Series(True, index=df.index)
             if start_date: mask &= (df['fecha'] >= pd.to_datetime(start_date))
             if end_date: mask &= (df['fecha'] <= pd.to_datetime(end_date))
             df = df[mask].copy()
-    if df.empty: return {"data": [], "total": 0, "stats": {"servilinea": 0, "empty_msgs": 0}}
+    if df.empty: return {"data": [], "total": 0, "stats": {"servilinea": 0, "empty_msgs": 0}, "next_cursor": None}
+    if thread_facts is None or start_date or end_date:
+        thread_facts = build_thread_facts(df)
+
+    # Categorized: a human message with a real category or an AI message with a product
+    categorized_threads = thread_set(thread_facts, 'is_categorized')
+    uncategorized_ids = list(set(thread_facts.index) - categorized_threads)
+    if not uncategorized_ids: return {"data": [], "total": 0, "stats": {"servilinea": 0, "empty_msgs": 0}, "next_cursor": None}
+
+    uncat_df = df[df['thread_id'].isin(uncategorized_ids)]
+    ref_threads = set(referral_threads(uncat_df, referral_index).index)
+    uncat_facts = thread_facts.loc[uncategorized_ids]
+    empty_threads = set(uncat_facts.index[uncat_facts['has_empty']])
+
+    # Pagination sorting: date desc, then thread_id (a total order for the cursor)
+    date_map = uncat_facts['first_fecha'].dropna().to_dict() if 'first_fecha' in uncat_facts.columns else {}
+    uncategorized_ids.sort()
+    uncategorized_ids.sort(key=lambda x: str(date_map.get(x, '')), reverse=True)
 
-    if 'categoria_yaml' in df.columns:
-        valid_mask = (
-            ((df['type'] == 'ai') & (df['product_type'].notna()) & (~df['product_type'].isin(['', 'ninguno', 'nan', 'None', 'sin intencion clara']))) |
-            ((df['type'] == 'human') & (df['categoria_yaml'].notna()) & (~df['categoria_yaml'].isin(['', 'uncategorized', 'sin intención clara', 'sin intencion clara', 'nan', 'None'])))
-        )
+    total = len(uncategorized_ids) if include_total else None
+    stats = {"servilinea": len(ref_threads), "empty_msgs": len(empty_threads)}
+    if cursor:
+        dates = np.array([str(date_map.get(x, '')) for x in uncategorized_ids], dtype=object)
+        start = seek([dates, np.array(uncategorized_ids, dtype=object)],
+                     decode_cursor(cursor, UNCATEGORIZED_SORT), [False, True])
     else:
-        valid_mask = (df['type'] == 'ai') & (df['product_type'].notna()) & (~df['product_type'].isin(['', 'ninguno', 'nan', 'None', 'sin intencion clara']))
-        
-    categorized_threads = set(df[valid_mask]['thread_id'].unique())
-    uncategorized_ids = list(set(df['thread_id'].unique()) - categorized_threads)
-    if not uncategorized_ids: return {"data": [], "total": 0, "stats": {"servilinea": 0, "empty_msgs": 0}}
-
-    uncat_df = df[df['thread_id'].isin(uncategorized_ids)].copy()
-    ref_threads = set(detect_referrals(uncat_df)['thread_id'].unique()) if not detect_referrals(uncat_df).empty else set()
-    empty_threads = set(uncat_df[uncat_df['text'].str.strip() == '']['thread_id'].unique())
-
-    # Pagination sorting
-    date_map = uncat_df.sort_values('rowid').groupby('thread_id')['fecha'].first().to_dict()
-    uncategorized_ids.sort(key=lambda x: str(date_map.get(x, '')), reverse=True)
-    
-    total = len(uncategorized_ids)
-    p_ids = uncategorized_ids[(page-1)*limit:page*limit]
-    if not p_ids: return {"data": [], "total": total, "stats": {"servilinea": len(ref_threads), "empty_msgs": len(empty_threads)}}
+        start = (page - 1) * limit
+    end = start + limit
+    p_ids = uncategorized_ids[start:end]
+    next_cursor = None
+    if 0 < end < len(uncategorized_ids):
+        last = uncategorized_ids[end - 1]
+        next_cursor = encode_cursor(UNCATEGORIZED_SORT, [str(date_map.get(last, '')), last])
+    if not p_ids: return {"data": [], "total": total, "stats": stats, "next_cursor": None}
 
     p_df = uncat_df[uncat_df['thread_id'].isin(p_ids)]
-    msg_counts = p_df.groupby('thread_id').size()
+    msg_counts = uncat_facts['messages']
     first_texts = p_df[p_df['type'] == 'human'].sort_values('rowid').groupby('thread_id')['text'].first()
     
     results = [{
@@ -165,7 +190,7 @@ def get_uncategorized_threads(df: pd.DataFrame, page: int = 1, limit: int = 20,
         "msg_count": int(msg_counts.get(tid, 0)), "sample_text": str(first_texts.get(tid, '')),
         "is_servilinea": tid in ref_threads, "has_empty_msg": tid in empty_threads
     } for tid in p_ids]
-    return {"data": results, "total": total, "stats": {"servilinea": len(ref_threads), "empty_msgs": len(empty_threads)}}
+    return {"data": results, "total": total, "stats": stats, "next_cursor": next_cursor}
 
 def get_survey_stats(df: pd.DataFrame, start_date: str = None, end_date: str = None):
     if df.empty: return {"stats": {"total": 0, "useful": 0, "not_useful": 0}, "conversations": []}
@@ -177,18 +202,15 @@ def get_survey_stats(df: pd.DataFrame, start_date: str = None, end_date: str = N
             df = df[mask].copy()
     if df.empty: return {"stats": {"total": 0, "useful": 0, "not_useful": 0}, "conversations": []}
     
-    s_mask = df['text'].str.contains(r'\[survey\]', case=False, na=False)
+    status = survey_statuses(df)
+    s_mask = status != NO_SURVEY
     s_df = df[s_mask].copy()
     if s_df.empty: return {"stats": {"total": 0, "useful": 0, "not_useful": 0}, "conversations": []}
 
-    t_low = s_df['text'].str.lower()
-    is_not = t_low.str.contains("no me fue útil")
-    is_use = t_low.str.contains("me fue útil") & ~is_not
-    s_df['status'] = 'unknown'
-    s_df.loc[is_not, 'status'] = 'not_useful'
-    s_df.loc[is_use, 'status'] = 'useful'
-    
+    s_df['status'] = status[s_mask].astype(str)
+
     return {
-        "stats": {"total": len(s_df), "useful": int(is_use.sum()), "not_useful": int(is_not.sum())},
+        "stats": {"total": len(s_df), "useful": int((s_df['status'] == 'useful').sum()),
+                  "not_useful": int((s_df['status'] == 'not_useful').sum())},
         "conversations": s_df[['thread_id', 'fecha', 'text', 'status']].rename(columns={'text': 'feedback', 'fecha': 'date'}).to_dict(orient='records')
     }
@@ -0,0 +1,145 @@
+"""
+Per-message text features computed once at ingest time.
+
+FAQs, deep reports and category discovery used to re-normalize every message
+(per-character NFD loop) and run the noise / system-leak / greeting checks
+row by row on every request. The ETL now stores the results as columns of
+`messages`:
+
+    text_norm         lowercased, stripped, accents removed
+    is_noise          phrase made only of greeting/filler tokens (faqs._is_noise)
+    is_system_leak    survey vote, prompt leak or < 4 chars (faqs._is_system_or_survey)
+    is_pure_greeting  < 5 chars left after a greeting prefix (reports_deep._is_pure_greeting)
+    word_count        whitespace-separated tokens of the stripped text
+    survey_status     outcome of a [survey] message: 'useful' ("Me fue útil"),
+                      'not_useful' ("No me fue útil"), 'unknown' (other
+                      answers, e.g. skipped) or 'none' for every other message
+
+Everything is computed with vectorized pandas string ops and gives exactly
+the same answer as the row-wise helpers, which are kept for single texts.
+pandas' str dtype runs on Arrow kernels, whose whitespace (RE2's ASCII \\s),
+stripping and lowercasing differ from Python's str / re on some characters
+(NBSP, U+2028, 'İ', final sigma...): only texts made of _PLAIN_CHARS use
+them, the rest are computed on Python strings (object dtype).
+"""
+import re
+import sys
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from .faqs import _NOISE_TOKENS, _SYSTEM_PATTERNS
+from .keyword_matcher import GREETING_PREFIXES
+
+TEXT_FEATURE_COLUMNS = ['text_norm', 'is_noise', 'is_system_leak', 'is_pure_greeting', 'word_count', 'survey_status']
+FLAG_COLUMNS = ['is_noise', 'is_system_leak', 'is_pure_greeting']
+SURVEY_STATUSES = ['useful', 'not_useful', 'unknown', 'none']
+NO_SURVEY = 'none'
+SURVEY_TAG_RE = r'\[survey\]'
+
+_NOISE_ONLY_RE = '(?<!\\S)(?:' + '|'.join(sorted(_NOISE_TOKENS, key=len, reverse=True)) + ')(?!\\S)'
+_SYSTEM_RE = '|'.join(re.escape(p) for p in _SYSTEM_PATTERNS)
+# Longest prefix first: the alternation is tried left to right, like the original loop
+_GREETING_RE = '^(?:' + '|'.join(re.escape(p) for p in GREETING_PREFIXES) + ')'
+# ASCII without the control chars Python counts as whitespace (\v, \f, \x1c-\x1f) and Latin-1
+# without NBSP: both engines strip, split, lowercase and match them alike
+_PLAIN_CHARS = r'[\t\n\r\x20-\x7e\xa1-\xff]*'
+
+
+@lru_cache(maxsize=1)
+def _combining_marks_re():
+    """Character class of every Unicode 'Mn' code point (what the NFD loops drop)."""
+    ranges, start = [], None
+    for cp in range(sys.maxunicode + 2):
+        is_mn = cp <= sys.maxunicode and unicodedata.category(chr(cp)) == 'Mn'
+        if is_mn and start is None:
+            start = cp
+        elif not is_mn and start is not None:
+            ranges.append(re.escape(chr(start)) + '-' + re.escape(chr(cp - 1)))
+            start = None
+    return '[' + ''.join(ranges) + ']'
+
+
+def _by_string_semantics(text, compute):
+    """
+    compute(texts) in text's order, on pandas' str dtype for the texts made of
+    _PLAIN_CHARS and on Python strings (object dtype) for the others.
+    """
+    text = text.fillna('').astype(str)
+    plain = text.str.fullmatch(_PLAIN_CHARS).to_numpy(dtype=bool)
+    if plain.all():
+        return compute(text)
+    positions = np.concatenate([np.flatnonzero(plain), np.flatnonzero(~plain)])
+    result = pd.concat([compute(text[plain]), compute(text[~plain].astype(object))], ignore_index=True)
+    return result.iloc[np.argsort(positions, kind='stable')].set_axis(text.index)
+
+
+def _normalize(text):
+    norm = text.str.lower().str.strip().str.normalize('NFD')
+    # A class of literal code points: the same matches in both engines
+    return norm.astype(str).str.replace(_combining_marks_re(), '', regex=True)
+
+
+def normalize_series(text):
+    """Vectorized faqs._normalize: lower + strip, then NFD without combining marks."""
+    return _by_string_semantics(text, _normalize).astype(str)
+
+
+def survey_status(text):
+    """survey_status of every text in a Series; only [survey] messages are scanned past the tag."""
+    text = text.fillna('').astype(str)
+    status = pd.Series(NO_SURVEY, index=text.index, dtype=object)
+    is_survey = text.str.contains(SURVEY_TAG_RE, case=False, regex=True)
+    answers = text[is_survey].str.lower()
+    not_useful = answers.str.contains('no me fue útil', regex=False)
+    useful = answers.str.contains('me fue útil', regex=False) & ~not_useful
+    status[is_survey] = np.select([not_useful, useful], ['not_useful', 'useful'], 'unknown')
+    return status
+
+
+def survey_statuses(df):
+    """The survey_status column of df, computed from `text` for frames that lack it."""
+    if 'survey_status' in df.columns:
+        return df['survey_status']
+    if 'text' not in df.columns:
+        return pd.Series(NO_SURVEY, index=df.index, dtype=object)
+    return survey_status(df['text'])
+
+
+def _text_features(text):
+    """text_norm and the flag / word_count columns of texts, with text's string semantics."""
+    stripped = text.str.strip()
+    lower = stripped.str.lower()
+    features = pd.DataFrame({'text_norm': _normalize(text)}, index=text.index)
+
+    # Noise: after dropping non [a-z0-9] chars, nothing but noise tokens remains
+    tokens = features['text_norm'].astype(text.dtype).str.replace(r'[^a-z0-9\s]', '', regex=True)
+    features['is_noise'] = tokens.str.replace(_NOISE_ONLY_RE, '', regex=True).str.strip() == ''
+
+    features['is_system_leak'] = (
+        (stripped.str.len() < 4)
+        | lower.str.startswith('[survey]')
+        | lower.str.contains(_SYSTEM_RE, regex=True)
+    )
+
+    greeted = lower.str.match(_GREETING_RE)
+    remainder = lower.where(~greeted, lower.str.replace(_GREETING_RE, '', n=1, regex=True)
+                                      .str.lstrip(' ,.:;!?').str.strip())
+    features['is_pure_greeting'] = remainder.str.len() < 5
+
+    features['word_count'] = stripped.str.split().str.len().fillna(0).astype(int)
+    return features
+
+
+def add_text_features(df):
+    """Adds TEXT_FEATURE_COLUMNS to df (in place) from its `text` column."""
+    if 'text' not in df.columns:
+        return df
+    features = _by_string_semantics(df['text'], _text_features)
+    for column in features.columns:
+        df[column] = features[column]
+    # The ETL sets it earlier (the sentiment step needs it)
+    df['survey_status'] = survey_statuses(df)
+    return df
@@ -0,0 +1,147 @@
+"""
+Thread-level fact table: one row per thread, computed once per data version.
+
+The funnel, advisor escalation, summary, uncategorized list and deep reports
+are mostly questions about threads, but each of them rebuilt the same
+per-thread properties from the messages on every request (greeting-only via
+a groupby-apply that split every text, survey result via regex, first
+category via drop_duplicates...). The DataEngine now keeps this table next
+to the messages frame; it is stored with the columnar snapshot and, for a
+date range, rebuilt from the sliced messages in one vectorized pass.
+
+Columns (index: thread_id, in order of first appearance):
+
+    first_fecha        first non-null fecha of the thread
+    messages           message count
+    human_messages     human message count
+    has_empty          some message is empty text
+    greeting_only      has human messages and all of them are <= 5 words
+    first_macro        macro_yaml / categoria_yaml of the first categorized
+    first_category       human message
+    first_product      first product among the categorized human messages
+    has_product        some human message names a product (product_yaml)
+    asked_for_advisor  some human message is 'Escalamiento a Asesor'
+    is_categorized     some categorized human message or AI message with a product
+    surveyed           reached the survey block ([survey] message)
+    survey_useful      answered 'Me fue útil'
+    survey_not_useful  answered 'No me fue útil'
+                       (the three from the messages' survey_status column)
+    is_referred        in the referrals table      (mark_outcomes)
+    has_failure        in the failures table       (mark_outcomes)
+"""
+import pandas as pd
+
+from .text_features import survey_statuses, NO_SURVEY
+
+ADVISOR_CATEGORY = 'Escalamiento a Asesor'
+GREETING_MAX_WORDS = 5
+NO_PRODUCT_VALUES = ['', 'Sin Producto']
+INVALID_PRODUCT_TYPES = ['', 'ninguno', 'nan', 'None', 'sin intencion clara']
+INVALID_CATEGORIES = ['', 'uncategorized', 'sin intención clara', 'sin intencion clara', 'nan', 'None']
+OUTCOME_COLUMNS = ['is_referred', 'has_failure']
+
+
+def survey_flags(df):
+    """(is_survey, useful, not_useful) masks over the messages of df (survey_status)."""
+    status = survey_statuses(df)
+    return status != NO_SURVEY, status == 'useful', status == 'not_useful'
+
+
+def _first_values(df, mask, cols, index):
+    """Values of `cols` on the first row of each thread where mask holds."""
+    first = df.loc[mask, ['thread_id'] + cols].drop_duplicates('thread_id').set_index('thread_id')
+    return first.reindex(index)
+
+
+def build_thread_facts(df):
+    """Thread fact table (see module docstring) for the messages in df."""
+    if df is None or df.empty or 'thread_id' not in df.columns:
+        return pd.DataFrame(index=pd.Index([], name='thread_id'))
+
+    is_human = df['type'] == 'human' if 'type' in df.columns else pd.Series(False, index=df.index)
+    text = df['text'] if 'text' in df.columns else pd.Series('', index=df.index)
+    if 'word_count' in df.columns:
+        words = df['word_count']
+    else:
+        words = text.astype(str).str.split().str.len()
+    is_survey, useful, not_useful = survey_flags(df)
+
+    flags = pd.DataFrame({
+        'thread_id': df['thread_id'],
+        'human_messages': is_human.astype(int),
+        'has_empty': text.str.strip() == '',
+        'long_human': is_human & (words > GREETING_MAX_WORDS),
+        'surveyed': is_survey,
+        'survey_useful': useful,
+        'survey_not_useful': not_useful,
+    })
+    if 'fecha' in df.columns:
+        flags['first_fecha'] = df['fecha']
+
+    grouped = flags.groupby('thread_id', sort=False)
+    facts = grouped.size().to_frame('messages')
+    if 'fecha' in df.columns:
+        facts['first_fecha'] = grouped['first_fecha'].first()
+    facts['human_messages'] = grouped['human_messages'].sum()
+    for col in ['has_empty', 'surveyed', 'survey_useful', 'survey_not_useful']:
+        facts[col] = grouped[col].any()
+    facts['greeting_only'] = (facts['human_messages'] > 0) & ~grouped['long_human'].any()
+
+    has_yaml = 'categoria_yaml' in df.columns and 'macro_yaml' in df.columns
+    if has_yaml:
+        categorized = is_human & df['categoria_yaml'].notna()
+        first = _first_values(df, categorized, ['macro_yaml', 'categoria_yaml'], facts.index)
+        facts['first_macro'] = first['macro_yaml']
+        facts['first_category'] = first['categoria_yaml']
+
+        prod_col = 'product_yaml' if 'product_yaml' in df.columns else 'product_type'
+        if prod_col in df.columns:
+            facts['first_product'] = _first_values(df, categorized & df[prod_col].notna(), [prod_col], facts.index)[prod_col]
+
+        advisor = is_human & (df['categoria_yaml'] == ADVISOR_CATEGORY)
+        facts['asked_for_advisor'] = facts.index.isin(df.loc[advisor, 'thread_id'].unique())
+
+    if 'product_yaml' in df.columns:
+        named = is_human & df['product_yaml'].notna() & ~df['product_yaml'].isin(NO_PRODUCT_VALUES)
+        facts['has_product'] = facts.index.isin(df.loc[named, 'thread_id'].unique())
+
+    if 'product_type' in df.columns:
+        valid = (df['type'] == 'ai') & df['product_type'].notna() & ~df['product_type'].isin(INVALID_PRODUCT_TYPES)
+        if 'categoria_yaml' in df.columns:
+            valid |= is_human & df['categoria_yaml'].notna() & ~df['categoria_yaml'].isin(INVALID_CATEGORIES)
+        facts['is_categorized'] = facts.index.isin(df.loc[valid, 'thread_id'].unique())
+
+    return facts
+
+
+def update_thread_facts(facts, df, thread_ids):
+    """
+    facts (build_thread_facts of an earlier version of df) with the rows of
+    thread_ids rebuilt from their messages in df, in df's thread order.
+    """
+    thread_ids = list(thread_ids)
+    fresh = build_thread_facts(df[df['thread_id'].isin(thread_ids)])
+    kept = facts[~facts.index.isin(thread_ids)]
+    if not fresh.empty:
+        # Category columns of fresh carry the categories of the whole new df
+        kept = kept.astype(fresh.dtypes.to_dict())
+    merged = pd.concat([kept, fresh]) if not fresh.empty else kept
+    return merged.reindex(pd.Index(df['thread_id'].unique(), name='thread_id'))
+
+
+def mark_outcomes(facts, referrals_df=None, failures_df=None):
+    """Adds is_referred / has_failure from the engine's referrals and failures tables."""
+    facts = facts.copy()
+    for col, table in [('is_referred', referrals_df), ('has_failure', failures_df)]:
+        if table is not None and not table.empty and 'thread_id' in table.columns:
+            facts[col] = facts.index.isin(table['thread_id'].unique())
+        else:
+            facts[col] = False
+    return facts
+
+
+def thread_set(facts, col):
+    """Set of thread ids where the boolean fact `col` holds."""
+    if facts is None or col not in facts.columns:
+        return set()
+    return set(facts.index[facts[col]])
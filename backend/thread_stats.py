@@ -0,0 +1,45 @@
+"""
+Vectorized aggregations (per thread, per value) shared by the ETL and the analysis modules.
+"""
+import numpy as np
+import pandas as pd
+
+
+def dominant_values(df, col, key='thread_id'):
+    """
+    Dominant (most frequent) non-null value of `col` per `key`, i.e. the
+    vectorized form of `groupby(key)[col].agg(lambda x: x.mode()[0])`.
+    Ties go to the smallest value, exactly like Series.mode()[0].
+
+    Returns a frame indexed by key with columns:
+        value   dominant value
+        count   rows of the group holding it (agreement count)
+        share   count / non-null rows of the group
+    Groups whose values are all null are absent.
+    """
+    valid = df.loc[df[col].notna(), [key, col]]
+    counts = valid.groupby([key, col], sort=False, observed=True).size().reset_index(name='count')
+    totals = counts.groupby(key, sort=False, observed=True)['count'].transform('sum')
+    counts['share'] = counts['count'] / totals
+    counts = counts.sort_values([key, 'count', col], ascending=[True, False, True], kind='mergesort')
+    top = counts.drop_duplicates(key).set_index(key)
+    return top.rename(columns={col: 'value'})[['value', 'count', 'share']]
+
+
+def value_counts(s, normalize=False):
+    """
+    Series.value_counts() that gives the same result for category columns as
+    for the plain text column: only observed values, ties in order of first
+    appearance (a categorical lists every category, ties in category order).
+    """
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return s.value_counts(normalize=normalize)
+    codes = s.cat.codes.to_numpy()
+    codes = codes[codes >= 0]
+    seen = pd.unique(codes)
+    counts = pd.Series(np.bincount(codes, minlength=len(s.cat.categories))[seen],
+                       index=pd.Index(s.cat.categories.take(seen), name=s.name), name='count')
+    counts = counts.sort_values(ascending=False, kind='stable')
+    if normalize:
+        counts = (counts / len(codes)).rename('proportion')
+    return counts
@@ -3,6 +3,21 @@ import axios from 'axios';
 
 const API_URL = 'http://127.0.0.1:8000/api';
 
+// While the backend is still loading its data it answers 503 + Retry-After: wait and retry
+const MAX_LOADING_RETRIES = 40;
+axios.interceptors.response.use(undefined, async (error) => {
+  const res = error.response;
+  const config = error.config;
+  if (config && res?.status === 503 && res.headers['retry-after']) {
+    config._loadingRetries = (config._loadingRetries || 0) + 1;
+    if (config._loadingRetries <= MAX_LOADING_RETRIES) {
+      await new Promise(resolve => setTimeout(resolve, Number(res.headers['retry-after']) * 1000));
+      return axios(config);
+    }
+  }
+  return Promise.reject(error);
+});
+
 export const api = {
     getKPIs: (): Promise<{
     total_conversations: number;